@@ -0,0 +1,26 @@
+"""教員・管理者向けページ (pages/ 以下) で共通に使う索引の取得と閲覧の制限"""
+import streamlit as st
+
+import analytics
+from settings import get_setting
+
+
+@st.cache_resource
+def get_analytics_index():
+    """ページ間・閲覧者間で共有する分析用索引 (アプリ本体と同じファイルを読む)"""
+    return analytics.AnalyticsIndex(analytics.configured_index_path())
+
+
+def require_password():
+    """ANALYTICS_PASSWORD を入力するまで、ページの以降の表示を止める (一度通ればセッション内の他のページでも有効)"""
+    password = get_setting("ANALYTICS_PASSWORD")
+    if not password:
+        st.info("このページを使うには、ANALYTICS_PASSWORD を設定してください。")
+        st.stop()
+    if not st.session_state.get("analytics_authorized"):
+        entered = st.text_input("パスワード", type="password", key="analytics_password")
+        if entered != password:
+            if entered:
+                st.error("パスワードが違います。")
+            st.stop()
+        st.session_state.analytics_authorized = True
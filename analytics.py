@@ -0,0 +1,357 @@
+"""クラス全体の分析用ロールアップ索引
+
+要素ごとの合格率・総合実践の点数分布・学習時間の合計・LLMの利用量を、全ユーザーのファイルを開かずに集計できるよう、
+ユーザー単位の小さな集計行を1つのSQLiteファイル (既定では user_data/analytics.db) に保持する。
+
+- アプリは進捗・学習時間・チャット履歴・利用量を保存するたびに、該当ユーザーの行だけを更新する (増分更新)
+- 分析ページ (pages/1_クラス分析.py) と利用状況ページ (pages/2_利用状況.py) はこの索引だけを読む
+- 索引が古くなった・壊れた場合は、保存済みデータ全体から作り直せる:
+
+    python analytics.py rebuild user_data
+    python analytics.py rebuild user_data/refuse_ai.db --backend sqlite --index user_data/analytics.db
+"""
+import argparse
+import os
+import sqlite3
+import threading
+
+import storage
+
+INDEX_FILENAME = "analytics.db"
+
+ANALYTICS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_progress (
+    user_id TEXT NOT NULL,
+    element TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    PRIMARY KEY (user_id, element)
+);
+CREATE TABLE IF NOT EXISTS user_study_time (
+    user_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    seconds INTEGER NOT NULL,
+    PRIMARY KEY (user_id, date)
+);
+CREATE INDEX IF NOT EXISTS idx_user_study_time_date ON user_study_time (date);
+CREATE TABLE IF NOT EXISTS user_token_usage (
+    user_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    cached_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    PRIMARY KEY (user_id, date)
+);
+CREATE INDEX IF NOT EXISTS idx_user_token_usage_date ON user_token_usage (date);
+CREATE TABLE IF NOT EXISTS chat_session_stats (
+    session_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    message_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chat_session_stats_user ON chat_session_stats (user_id);
+CREATE TABLE IF NOT EXISTS evaluations (
+    session_id TEXT NOT NULL,
+    turn INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    element TEXT,
+    verdict TEXT,
+    expression INTEGER,
+    content INTEGER,
+    total INTEGER,
+    source TEXT,
+    PRIMARY KEY (session_id, turn)
+);
+CREATE INDEX IF NOT EXISTS idx_evaluations_kind ON evaluations (kind, element);
+"""
+
+EVALUATION_COLUMNS = [
+    "session_id", "turn", "user_id", "timestamp", "kind", "element", "verdict", "expression", "content", "total", "source"
+]
+
+
+def default_index_path(backend, storage_path):
+    """保存先の設定から、索引ファイルの既定のパスを決める (保存先と同じディレクトリに置く)"""
+    if backend == "sqlite":
+        return os.path.join(os.path.dirname(storage_path or storage.DEFAULT_DB_PATH), INDEX_FILENAME)
+    return os.path.join(storage_path or storage.DEFAULT_LOGS_DIR, INDEX_FILENAME)
+
+
+def configured_index_path():
+    """アプリと同じ設定 (STORAGE_BACKEND / STORAGE_PATH / ANALYTICS_INDEX_PATH) から索引ファイルのパスを決める"""
+    from settings import get_setting
+    return get_setting("ANALYTICS_INDEX_PATH") or default_index_path(
+        get_setting("STORAGE_BACKEND", "json"), get_setting("STORAGE_PATH")
+    )
+
+
+def evaluation_rows(user_id, session):
+    """保存された1セッションから、構造化された評価 (evaluation.py) を1ターン1行で取り出す"""
+    rows = []
+    for turn, message in enumerate(session["history"]):
+        result = message.get("evaluation") if message.get("role") == "assistant" else None
+        if not result:
+            continue
+        scores = result.get("scores") or {}
+        rows.append((
+            session["session_id"], turn, user_id, session["timestamp"], result["kind"], result.get("element"),
+            result.get("verdict"), scores.get("expression"), scores.get("content"), scores.get("total"),
+            result.get("source")
+        ))
+    return rows
+
+
+class AnalyticsIndex:
+    """ロールアップ索引の更新と集計 (SQLite, WALモード)
+
+    アプリのプロセス内で共有されるため、接続はスレッドごとに作成する。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(ANALYTICS_SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    # --- 増分更新 (保存のたびに呼ばれる) ---
+    def record_progress(self, user_id, status):
+        """ユーザーの進捗 (要素 -> 合格済みか) を置き換える"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM user_progress WHERE user_id = ?", (user_id,))
+            conn.executemany(
+                "INSERT INTO user_progress (user_id, element, passed) VALUES (?, ?, ?)",
+                [(user_id, element, int(passed)) for element, passed in status.items()]
+            )
+
+    def add_study_time(self, user_id, date_key, seconds):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO user_study_time (user_id, date, seconds) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, date) DO UPDATE SET seconds = seconds + excluded.seconds",
+                (user_id, date_key, int(seconds))
+            )
+
+    def add_token_usage(self, user_id, date_key, usage):
+        counters = storage.TOKEN_USAGE_COUNTERS
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT INTO user_token_usage (user_id, date, {', '.join(counters)}) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, date) DO UPDATE SET "
+                + ", ".join(f"{counter} = {counter} + excluded.{counter}" for counter in counters),
+                (user_id, date_key, *(int(usage.get(counter, 0)) for counter in counters))
+            )
+
+    def record_chat_session(self, user_id, session):
+        """保存したセッションの件数と、各ターンの評価を追加する"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_session_stats (session_id, user_id, timestamp, message_count) "
+                "VALUES (?, ?, ?, ?)",
+                (session["session_id"], user_id, session["timestamp"], len(session["history"]))
+            )
+            conn.executemany(
+                f"INSERT OR REPLACE INTO evaluations ({', '.join(EVALUATION_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(EVALUATION_COLUMNS))})",
+                evaluation_rows(user_id, session)
+            )
+
+    def remove_chat_session(self, session_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chat_session_stats WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM evaluations WHERE session_id = ?", (session_id,))
+
+    # --- 集計 (分析ページ用) ---
+    def summary(self):
+        """ユーザー数・保存済みセッション数・評価数・学習時間の合計"""
+        conn = self._connect()
+        users = conn.execute(
+            "SELECT COUNT(*) FROM (SELECT user_id FROM user_progress UNION SELECT user_id FROM user_study_time "
+            "UNION SELECT user_id FROM chat_session_stats)"
+        ).fetchone()[0]
+        sessions = conn.execute("SELECT COUNT(*) FROM chat_session_stats").fetchone()[0]
+        evaluations = conn.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+        study_seconds = conn.execute("SELECT COALESCE(SUM(seconds), 0) FROM user_study_time").fetchone()[0]
+        return {"users": users, "sessions": sessions, "evaluations": evaluations, "study_seconds": study_seconds}
+
+    def element_pass_rates(self):
+        """要素ごとの合格済みユーザー数と、進捗を持つユーザー数"""
+        rows = self._connect().execute(
+            "SELECT element, SUM(passed), COUNT(*) FROM user_progress GROUP BY element ORDER BY element"
+        ).fetchall()
+        return [{"element": element, "passed_users": passed, "users": users} for element, passed, users in rows]
+
+    def element_attempts(self):
+        """要素別トレーニングの評価ごとの回答数と合格数 (保存済みのセッションのみ)"""
+        rows = self._connect().execute(
+            "SELECT element, COUNT(*), SUM(verdict = '合格'), SUM(source = 'local') FROM evaluations "
+            "WHERE kind = 'element' GROUP BY element ORDER BY element"
+        ).fetchall()
+        return [
+            {"element": element, "attempts": attempts, "passed": passed, "local": local}
+            for element, attempts, passed, local in rows
+        ]
+
+    def score_distribution(self):
+        """総合実践の合計点ごとの件数と、表現面・内容面の平均点"""
+        conn = self._connect()
+        totals = conn.execute(
+            "SELECT total, COUNT(*) FROM evaluations WHERE kind = 'full' AND total IS NOT NULL "
+            "GROUP BY total ORDER BY total"
+        ).fetchall()
+        averages = conn.execute(
+            "SELECT AVG(expression), AVG(content), AVG(total) FROM evaluations WHERE kind = 'full'"
+        ).fetchone()
+        return {
+            "totals": {total: count for total, count in totals},
+            "average_expression": averages[0],
+            "average_content": averages[1],
+            "average_total": averages[2],
+        }
+
+    def study_time_by_date(self, limit_days=60):
+        """日ごとの学習時間の合計と学習したユーザー数 (新しい順に limit_days 日分)"""
+        rows = self._connect().execute(
+            "SELECT date, SUM(seconds), COUNT(*) FROM user_study_time GROUP BY date ORDER BY date DESC LIMIT ?",
+            (limit_days,)
+        ).fetchall()
+        return [{"date": date, "seconds": seconds, "users": users} for date, seconds, users in reversed(rows)]
+
+    def study_time_by_user(self, limit=50):
+        """ユーザーごとの学習時間の合計 (多い順)"""
+        rows = self._connect().execute(
+            "SELECT user_id, SUM(seconds) FROM user_study_time GROUP BY user_id ORDER BY 2 DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [{"user_id": user_id, "seconds": seconds} for user_id, seconds in rows]
+
+
+    def token_usage_by_user(self, since_date=None, limit=50):
+        """ユーザーごとの利用量の合計 (since_date 以降。入力 + 出力トークン数の多い順)"""
+        rows = self._connect().execute(
+            "SELECT user_id, SUM(requests), SUM(input_tokens), SUM(cached_tokens), SUM(output_tokens) "
+            "FROM user_token_usage WHERE date >= ? GROUP BY user_id ORDER BY SUM(input_tokens + output_tokens) DESC LIMIT ?",
+            (since_date or "", limit)
+        ).fetchall()
+        return [dict(zip(("user_id",) + storage.TOKEN_USAGE_COUNTERS, row)) for row in rows]
+
+    def token_usage_by_date(self, limit_days=60):
+        """日ごとの利用量の合計と利用したユーザー数 (新しい順に limit_days 日分)"""
+        rows = self._connect().execute(
+            "SELECT date, SUM(requests), SUM(input_tokens), SUM(cached_tokens), SUM(output_tokens), COUNT(*) "
+            "FROM user_token_usage GROUP BY date ORDER BY date DESC LIMIT ?",
+            (limit_days,)
+        ).fetchall()
+        return [dict(zip(("date",) + storage.TOKEN_USAGE_COUNTERS + ("users",), row)) for row in reversed(rows)]
+
+
+def _melt_logs(pd, logs_by_user, key_name, value_name):
+    """{user_id: {key: value}} を (user_id, key, value) の行の DataFrame にする"""
+    frame = pd.DataFrame.from_dict(logs_by_user, orient="index").rename_axis("user_id").reset_index()
+    return frame.melt(id_vars="user_id", var_name=key_name, value_name=value_name).dropna(subset=[value_name])
+
+
+def _explode_records(pd, records_by_user, columns):
+    """{user_id: [dict, ...]} を、user_id 列を持つ1つの DataFrame にする"""
+    exploded = pd.Series(records_by_user, dtype=object).explode().dropna()
+    frame = pd.DataFrame(exploded.tolist(), index=exploded.index.rename("user_id")).reset_index()
+    return frame.reindex(columns=["user_id", *columns]).astype(object)
+
+
+def _evaluation_frame(pd, sessions):
+    """セッションの DataFrame から、構造化された評価を1ターン1行で取り出す (evaluation_rows と同じ列)"""
+    messages = sessions[["session_id", "user_id", "timestamp", "history"]].explode("history")
+    messages["turn"] = messages.groupby(level=0).cumcount()
+    results = messages["history"].str.get("evaluation")
+    is_evaluation = (messages["history"].str.get("role") == "assistant") & results.notna() & results.astype(bool)
+    messages = messages[is_evaluation].reset_index(drop=True)
+    details = pd.json_normalize(results[is_evaluation].tolist()).reindex(columns=[
+        "kind", "element", "verdict", "scores.expression", "scores.content", "scores.total", "source"
+    ])
+    details.columns = ["kind", "element", "verdict", "expression", "content", "total", "source"]
+    return pd.concat([messages, details], axis=1)[EVALUATION_COLUMNS]
+
+
+def rebuild_index(store, db_path):
+    """保存済みの全ユーザーのデータから索引を作り直し、対象ユーザー数を返す
+
+    保存層からの読み込みはユーザー単位だが、読み込んだデータは種類ごとに1つの DataFrame にまとめ、
+    展開・ターン番号の付与・重複の除去は DataFrame の演算 (melt / explode / groupby) で一括して行う。
+    索引は1トランザクションで置き換える (処理中もアプリからは古い索引が読める)。
+    """
+    import pandas as pd
+
+    counters = list(storage.TOKEN_USAGE_COUNTERS)
+    user_ids = store.list_user_ids()
+    progress_logs, study_logs, usage_logs, session_logs = {}, {}, {}, {}
+    for user_id in user_ids:
+        progress_logs[user_id] = store.load_progress(user_id)
+        study_logs[user_id] = store.load_study_logs(user_id)
+        usage_logs[user_id] = store.load_token_usage_logs(user_id)
+        session_logs[user_id] = store.load_chat_sessions(user_id)
+
+    progress = _melt_logs(pd, progress_logs, "element", "passed")
+    progress["passed"] = progress["passed"].astype(bool).astype(int)
+    study = _melt_logs(pd, study_logs, "date", "seconds")
+    study["seconds"] = study["seconds"].astype(int)
+    usage = _melt_logs(pd, usage_logs, "date", "usage")
+    usage_counts = pd.DataFrame(usage["usage"].tolist(), index=usage.index).reindex(columns=counters)
+    usage = pd.concat([usage[["user_id", "date"]], usage_counts.fillna(0).astype(int)], axis=1)
+    sessions = _explode_records(pd, session_logs, ["session_id", "timestamp", "history"])
+    sessions = sessions.drop_duplicates("session_id", keep="last")
+    evaluations = _evaluation_frame(pd, sessions).drop_duplicates(["session_id", "turn"], keep="last")
+    for column in ("expression", "content", "total"):
+        evaluations[column] = evaluations[column].astype("Int64")
+    sessions["message_count"] = sessions["history"].str.len()
+    sessions = sessions[["session_id", "user_id", "timestamp", "message_count"]]
+
+    def records(frame):
+        # pandas の欠損値 (NA) を SQLite の NULL にする
+        return list(frame.astype(object).where(frame.notna(), None).itertuples(index=False, name=None))
+
+    index = AnalyticsIndex(db_path)
+    with index._connect() as conn:
+        for table in ("user_progress", "user_study_time", "user_token_usage", "chat_session_stats", "evaluations"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.executemany("INSERT INTO user_progress VALUES (?, ?, ?)", records(progress))
+        conn.executemany("INSERT INTO user_study_time VALUES (?, ?, ?)", records(study))
+        conn.executemany("INSERT INTO user_token_usage VALUES (?, ?, ?, ?, ?, ?)", records(usage))
+        conn.executemany("INSERT INTO chat_session_stats VALUES (?, ?, ?, ?)", records(sessions))
+        conn.executemany(
+            f"INSERT INTO evaluations VALUES ({', '.join('?' * len(EVALUATION_COLUMNS))})", records(evaluations)
+        )
+    return len(user_ids)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="誘いを断る練習AI のクラス分析用索引の管理ツール")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_parser = subparsers.add_parser("rebuild", help="保存済みの全データから索引を作り直す")
+    rebuild_parser.add_argument("path", nargs="?", help="保存先のディレクトリ (json) またはDBファイル (sqlite)")
+    rebuild_parser.add_argument("--backend", choices=["json", "sqlite"], default="json", help="データ保存方式")
+    rebuild_parser.add_argument("--index", help="索引ファイル (省略時は保存先と同じディレクトリの analytics.db)")
+
+    args = parser.parse_args(argv)
+    if args.command == "rebuild":
+        index_path = args.index or default_index_path(args.backend, args.path)
+        count = rebuild_index(storage.create_storage(args.backend, args.path), index_path)
+        print(f"{count} 人分のデータから {index_path} を作り直しました。")
+
+
+if __name__ == "__main__":
+    main()
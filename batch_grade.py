@@ -0,0 +1,220 @@
+"""収集した回答の一括採点 (研究用)
+
+断りの回答をまとめて、アプリと同じシステムプロンプト (要素別トレーニングは create_focused_prompt、
+総合実践は SYSTEM_PROMPT_FULL_TEMPLATE) と構造化出力で採点し、1回答1行のJSONLに書き出す。
+採点はスレッドプールで並行して行い、LLMの呼び出しは llm_client の上限 (同時実行数・1分あたりの回数) に従う。
+
+    python batch_grade.py answers.csv results.jsonl --workers 8 --rpm 120
+    LLM_BACKEND=fake python batch_grade.py answers.jsonl results.jsonl   # APIを呼ばずに動作確認
+
+入力 (CSV またはJSONL。拡張子 .jsonl / .json ならJSONL、それ以外はCSVとして読む):
+    answer      採点する回答 (必須)
+    element     要素名 (例: "謝罪")。空欄または "総合実践" の場合は総合実践として採点する
+    scenario    シナリオ (任意)
+    invitation  回答の直前のAIの誘い (任意。ない場合はシナリオを誘いとして渡す)
+    id          行の識別子 (任意。ない場合はデータ行の番号)
+
+出力 (JSONL。採点が終わった順に1行ずつ追記する):
+    id, element, verdict, expression, content, total, evaluation, usage, status ("ok" / "error"), error, seconds
+
+同じ出力ファイルを指定して再実行すると、status が "ok" の行は飛ばして残りだけを採点する
+(中断しても続きから再開できる)。同じ id の行が複数ある場合は最後の行が有効。
+"""
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import evaluation
+import llm_client
+import prompts
+from settings import get_setting
+
+DEFAULT_MODEL_NAME = "models/gemini-pro-latest"
+DEFAULT_WORKERS = 8
+# 入力にシナリオも誘いもない場合に、最初の誘いの代わりに渡す文
+MISSING_INVITATION = "（誘いの本文は記録されていません。回答の内容から状況を推測して評価してください。）"
+
+
+def read_rows(path):
+    """入力ファイルを1行ずつ辞書として返す (id がない行にはデータ行の番号を振る)"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if os.path.splitext(path)[1].lower() in (".jsonl", ".json"):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for number, row in enumerate(rows, start=1):
+            row_id = row.get("id")
+            row["id"] = str(row_id) if row_id not in (None, "") else str(number)
+            yield row
+
+
+def load_done_ids(path):
+    """出力ファイルのうち、採点が完了している (status が ok の) 行の id"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 中断時に書きかけになった最終行は採点し直す
+                continue
+            if record.get("status") == "ok":
+                done.add(record["id"])
+    return done
+
+
+def load_genai():
+    if os.environ.get("LLM_BACKEND") == "fake":
+        import fake_genai as genai
+        return genai
+    import google.generativeai as genai
+    api_key = get_setting("GOOGLE_API_KEY")
+    if not api_key:
+        raise SystemExit("GOOGLE_API_KEY が設定されていません。環境変数を確認してください。")
+    genai.configure(api_key=api_key)
+    return genai
+
+
+class Grader:
+    """1件の回答を、アプリの評価ターンと同じ形 (シナリオ指定 → 誘い → 回答) で採点する"""
+
+    def __init__(self, genai, model_name=DEFAULT_MODEL_NAME):
+        self._genai = genai
+        self.model_name = model_name
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get_model(self, mode_key):
+        """モードごとのモデル (スレッド間で共有する)"""
+        with self._lock:
+            if mode_key not in self._models:
+                self._models[mode_key] = self._genai.GenerativeModel(
+                    self.model_name, system_instruction=prompts.get_system_prompt(mode_key, True)
+                )
+            return self._models[mode_key]
+
+    def grade(self, row):
+        mode_key = (row.get("element") or "").strip() or "総合実践"
+        if prompts.get_system_prompt(mode_key) is None:
+            raise ValueError(f"不明な要素です: {mode_key}")
+        scenario = (row.get("scenario") or "").strip()
+        invitation = (row.get("invitation") or "").strip() or scenario or MISSING_INVITATION
+        chat = self.get_model(mode_key).start_chat(history=[
+            {"role": "user", "parts": [prompts.build_initial_message(scenario)]},
+            {"role": "model", "parts": [invitation]}
+        ])
+        response = llm_client.send_message(
+            chat, row["answer"], labels={"stage": "batch", "mode": "full" if mode_key == "総合実践" else "element"},
+            generation_config=evaluation.generation_config(mode_key)
+        )
+        result = evaluation.parse_evaluation(response.text, mode_key)
+        scores = (result or {}).get("scores") or {}
+        return {
+            "element": mode_key,
+            "verdict": result["verdict"] if result else evaluation.extract_verdict(response.text),
+            "expression": scores.get("expression"),
+            "content": scores.get("content"),
+            "total": scores.get("total"),
+            # 構造化された評価を解析できなかった場合は、応答の本文をそのまま残す
+            "evaluation": result if result else {"raw_text": response.text},
+            "usage": llm_client.get_token_usage(response),
+        }
+
+
+def grade_row(grader, row):
+    """1行を採点し、出力する1レコードを返す (失敗しても例外は送出しない)"""
+    started = time.perf_counter()
+    record = {"id": row["id"]}
+    try:
+        if not (row.get("answer") or "").strip():
+            raise ValueError("answer が空です")
+        record.update(grader.grade(row))
+        record["status"] = "ok"
+    except Exception as e:
+        record.update({"element": row.get("element"), "status": "error", "error": f"{type(e).__name__}: {e}"})
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def run(rows, grader, out_path, workers=DEFAULT_WORKERS, on_record=None):
+    """未採点の行を並行して採点し、終わった順に out_path へ追記する。採点した件数を返す。
+
+    同時に実行中・待機中の行は workers の2倍までに抑え、入力全体をメモリに読み込まない。
+    """
+    done = load_done_ids(out_path)
+    max_pending = workers * 2
+    pending = set()
+    count = 0
+    with open(out_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        def drain(block_until):
+            nonlocal pending, count
+            while len(pending) > block_until:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record = future.result()
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                    count += 1
+                    if on_record:
+                        on_record(record)
+
+        try:
+            for row in rows:
+                if row["id"] in done:
+                    continue
+                pending.add(executor.submit(grade_row, grader, row))
+                drain(max_pending - 1)
+            drain(0)
+        except KeyboardInterrupt:
+            for future in pending:
+                future.cancel()
+            raise
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="誘いを断る練習AI の回答を一括で採点する")
+    parser.add_argument("input", help="回答のファイル (CSV または JSONL)")
+    parser.add_argument("output", help="結果を追記するJSONLファイル (既存の結果は再開に使う)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="同時に採点する数")
+    parser.add_argument("--rpm", type=int, default=llm_client.DEFAULT_REQUESTS_PER_MINUTE, help="1分あたりのLLM呼び出しの上限")
+    parser.add_argument("--model", default=get_setting("EVALUATION_MODEL_NAME") or get_setting("MODEL_NAME", DEFAULT_MODEL_NAME),
+                        help="使用するモデル (既定はアプリの評価用モデル)")
+    args = parser.parse_args(argv)
+
+    llm_client.configure(args.workers, args.rpm)
+    grader = Grader(load_genai(), args.model)
+    statuses = Counter()
+    verdicts = Counter()
+    started = time.perf_counter()
+
+    def on_record(record):
+        statuses[record["status"]] += 1
+        if record.get("verdict"):
+            verdicts[(record["element"], record["verdict"])] += 1
+        if sum(statuses.values()) % 100 == 0:
+            print(f"  {sum(statuses.values())} 件採点 (失敗 {statuses['error']} 件)", flush=True)
+
+    try:
+        count = run(read_rows(args.input), grader, args.output, args.workers, on_record)
+    except KeyboardInterrupt:
+        print(f"中断しました ({sum(statuses.values())} 件採点済み)。同じコマンドで続きから再開できます。")
+        return
+
+    print(f"{count} 件を採点しました ({time.perf_counter() - started:.1f}秒, 失敗 {statuses['error']} 件) → {args.output}")
+    for element in sorted({element for element, _ in verdicts}):
+        passed, failed = verdicts[(element, "合格")], verdicts[(element, "不合格")]
+        print(f"  {element}: 合格 {passed} / 不合格 {failed}")
+    if statuses["error"]:
+        print("失敗した行は、同じコマンドを再実行すると採点し直します。")
+
+
+if __name__ == "__main__":
+    main()
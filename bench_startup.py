@@ -0,0 +1,109 @@
+"""起動時間と再実行時間のベンチマーク
+
+新しいプロセスで refuseAI.py を Streamlit の AppTest で動かし、次の時間を計測する。
+    login_first   ログイン画面の初回表示 (プロセス起動直後。モジュールの読み込みを含む)
+    login_rerun   ログイン画面の再実行
+    practice_rerun ログイン後の練習画面の再実行 (疑似バックエンドを使用)
+
+計測値には AppTest 自体の処理時間 (1回あたり数ms〜数十ms) も含まれる。
+
+--app で別のバージョンの refuseAI.py を指定すると、変更前後を比較できる:
+
+    python bench_startup.py
+    git worktree add /tmp/refuse-ai-before HEAD~1
+    python bench_startup.py --app /tmp/refuse-ai-before/refuseAI.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "refuseAI.py")
+
+
+def run_child(app_path, reruns):
+    """子プロセス側: 1プロセス分の計測結果をJSONで標準出力に書く"""
+    from streamlit.testing.v1 import AppTest
+
+    result = {}
+    at = AppTest.from_file(app_path, default_timeout=120)
+    at.secrets["GOOGLE_API_KEY"] = "bench-dummy-key"
+    start = time.perf_counter()
+    at.run()
+    result["login_first"] = time.perf_counter() - start
+    result["sdk_imported_on_login_page"] = "google.generativeai" in sys.modules
+    result["login_rerun"] = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        at.run()
+        result["login_rerun"].append(time.perf_counter() - start)
+
+    # ログイン後の再実行は、APIを呼ばないよう疑似バックエンドで計測する
+    os.environ["LLM_BACKEND"] = "fake"
+    at = AppTest.from_file(app_path, default_timeout=120)
+    at.run()
+    at.text_input(key="user_id_key").input("bench").run()
+    result["practice_rerun"] = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        at.run()
+        result["practice_rerun"].append(time.perf_counter() - start)
+    if at.exception:
+        result["exception"] = at.exception[0].message
+    print(json.dumps(result))
+
+
+def summarize(values):
+    return {"median_ms": statistics.median(values) * 1000, "min_ms": min(values) * 1000}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="誘いを断る練習AI の起動時間・再実行時間のベンチマーク")
+    parser.add_argument("--app", default=APP_PATH, help="計測する refuseAI.py のパス")
+    parser.add_argument("--runs", type=int, default=3, help="新しいプロセスで計測する回数")
+    parser.add_argument("--reruns", type=int, default=10, help="1プロセスあたりの再実行の回数")
+    parser.add_argument("--json", dest="json_path", help="結果をJSONでも書き出すファイル")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    app_path = os.path.abspath(args.app)
+    if args.child:
+        run_child(app_path, args.reruns)
+        return
+
+    samples = []
+    with tempfile.TemporaryDirectory(prefix="refuse_ai_bench_") as data_dir:
+        env = {**os.environ, "STORAGE_PATH": data_dir, "FAKE_LLM_LATENCY": "0"}
+        env.pop("LLM_BACKEND", None)
+        for _ in range(args.runs):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", "--app", app_path, "--reruns", str(args.reruns)],
+                cwd=os.path.dirname(app_path), env=env, capture_output=True, text=True, check=True
+            ).stdout
+            samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    result = {
+        "app": app_path,
+        "login_first": summarize([sample["login_first"] for sample in samples]),
+        "login_rerun": summarize([value for sample in samples for value in sample["login_rerun"]]),
+        "practice_rerun": summarize([value for sample in samples for value in sample["practice_rerun"]]),
+        "sdk_imported_on_login_page": any(sample["sdk_imported_on_login_page"] for sample in samples),
+        "exceptions": [sample["exception"] for sample in samples if "exception" in sample],
+    }
+    print(f"計測対象: {app_path} ({args.runs} プロセス × 再実行 {args.reruns} 回)")
+    for key in ("login_first", "login_rerun", "practice_rerun"):
+        print(f"  {key:<15} 中央値 {result[key]['median_ms']:7.1f}ms / 最小 {result[key]['min_ms']:7.1f}ms")
+    print(f"  ログイン画面でのSDK読み込み: {'あり' if result['sdk_imported_on_login_page'] else 'なし'}")
+    for exception in result["exceptions"]:
+        print(f"  例外: {exception}")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""評価結果の構造化 (JSONスキーマ) と表示用マークダウンへの変換
+
+評価を含む応答は、LLMの構造化出力 (response_schema) で合否・点数・強調する語句・フィードバックを
+型付きのフィールドとして受け取る。画面にはこのフィールドから組み立てたマークダウンを表示し、
+フィールド自体は会話履歴のメッセージ ("evaluation") として保存する。
+
+評価結果の辞書:
+    kind          "element" (要素別トレーニング) または "full" (総合実践)
+    element       要素名 (総合実践では None)
+    verdict       "合格" / "不合格"
+    scores        総合実践の点数 {"expression": 0-5, "content": 0-5, "total": 0-10} (要素別では None)
+    highlight     ユーザーの回答のうち強調表示する語句
+    reply         誘った相手としての返答
+    feedback      評価の箇条書き (総合実践では表現面・内容面の詳細を含む辞書)
+    improvements  改善提案の箇条書き
+    source        "llm"、"local" (事前チェックによる判定) または "cache" (よく似た回答の評価の再利用)
+
+表示用のHTML (強調表示・合否の色付けを適用したもの) はメッセージの追加時に一度だけ作り、
+メッセージの "html" に持たせる。"html" のない保存済みの履歴は、変換結果を件数上限つきでキャッシュする。
+"""
+import functools
+import html
+import json
+import re
+
+VERDICTS = ("合格", "不合格")
+VERDICT_PATTERN = re.compile(r"【合否判定】:\s*(合格|不合格)")
+
+_STRING_LIST = {"type": "array", "items": {"type": "string"}}
+
+ELEMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "reply": {"type": "string", "description": "誘った相手としての短い返答 (納得して引き下がる、または少し食い下がる)"},
+        "highlight": {"type": "string", "description": "ユーザーの回答のうち、練習目標の要素に最も関連する語句 (回答からそのまま抜き出す)"},
+        "feedback": {**_STRING_LIST, "description": "評価の箇条書き (各1〜2行)"},
+        "improvements": {**_STRING_LIST, "description": "改善提案の箇条書き (各1〜2行)"},
+        "verdict": {"type": "string", "enum": list(VERDICTS)},
+    },
+    "required": ["reply", "highlight", "feedback", "improvements", "verdict"],
+}
+
+FULL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "reply": {"type": "string", "description": "誘った相手としての短い返答"},
+        "highlight": {"type": "string", "description": "ユーザーの回答のうち、評価に最も影響した語句 (回答からそのまま抜き出す)"},
+        "expression_score": {"type": "integer", "description": "表現面の点数 (0〜5)"},
+        "expression_summary": {"type": "string", "description": "表現面の点数の理由の要約"},
+        "content_score": {"type": "integer", "description": "内容面の点数 (0〜5)"},
+        "content_summary": {"type": "string", "description": "内容面の点数の理由の要約"},
+        "expression_details": {**_STRING_LIST, "description": "表現面（詳細）の箇条書き"},
+        "content_details": {**_STRING_LIST, "description": "内容面（詳細）の箇条書き"},
+        "weighting": {"type": "string", "description": "重み付けの考慮 (どちらの面が重要であったか)"},
+        "improvements": {**_STRING_LIST, "description": "改善提案の箇条書き"},
+    },
+    "required": [
+        "reply", "highlight", "expression_score", "expression_summary", "content_score", "content_summary",
+        "expression_details", "content_details", "weighting", "improvements",
+    ],
+}
+
+# システムプロンプトの末尾に追加する、構造化出力用の指示
+STRUCTURED_OUTPUT_INSTRUCTION = """
+**【構造化出力について】**
+ユーザーの断り方を評価する応答は、指定されたJSONスキーマの各フィールドで返してください。
+見出しや合否判定の行などの書式はアプリ側で組み立てるため、各フィールドには本文だけを書いてください。
+- reply: 誘った相手としての返答
+- highlight: ユーザーの回答から、そのまま抜き出した語句
+- 箇条書きのフィールドは、1項目につき1〜2行の簡潔な文にしてください
+"""
+
+
+def get_kind(mode_key):
+    return "full" if mode_key == "総合実践" else "element"
+
+
+# 簡潔な形式 (利用量がソフト上限を超えたユーザー向け) で省くフィールド
+BRIEF_OMITTED_FIELDS = {
+    "element": ("improvements",),
+    "full": ("expression_details", "content_details", "weighting"),
+}
+
+
+def generation_config(mode_key, with_reply=True, brief=False):
+    """評価を求めるターンで send_message に渡す generation_config
+
+    with_reply=False の場合は、相手役の返答 (reply) を別のリクエストで生成するため、スキーマから除く。
+    brief=True の場合は、合否・点数と要点だけの簡潔な形式にして出力トークン数を抑える。
+    """
+    kind = get_kind(mode_key)
+    schema = FULL_SCHEMA if kind == "full" else ELEMENT_SCHEMA
+    omitted = (() if with_reply else ("reply",)) + (BRIEF_OMITTED_FIELDS[kind] if brief else ())
+    if omitted:
+        schema = {
+            **schema,
+            "properties": {name: field for name, field in schema["properties"].items() if name not in omitted},
+            "required": [name for name in schema["required"] if name not in omitted],
+        }
+    return {"response_mime_type": "application/json", "response_schema": schema}
+
+
+def _string_list(value):
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        return []
+    return [str(item).strip() for item in value if str(item).strip()]
+
+
+def _score(value, maximum):
+    try:
+        return min(maximum, max(0, int(value)))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_evaluation(text, mode_key):
+    """構造化出力のJSONを評価結果の辞書に変換する。形式が崩れている場合は None を返す。"""
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    evaluation = {
+        "kind": get_kind(mode_key),
+        "element": None if mode_key == "総合実践" else mode_key,
+        "reply": str(data.get("reply", "")).strip(),
+        "highlight": str(data.get("highlight", "")).strip(),
+        "improvements": _string_list(data.get("improvements")),
+        "source": "llm",
+    }
+    if evaluation["kind"] == "element":
+        if data.get("verdict") not in VERDICTS:
+            return None
+        evaluation["verdict"] = data["verdict"]
+        evaluation["scores"] = None
+        evaluation["feedback"] = _string_list(data.get("feedback"))
+    else:
+        expression = _score(data.get("expression_score"), 5)
+        content = _score(data.get("content_score"), 5)
+        if expression is None or content is None:
+            return None
+        total = expression + content
+        # 10点満点の場合のみ合格
+        evaluation["verdict"] = "合格" if total == 10 else "不合格"
+        evaluation["scores"] = {"expression": expression, "content": content, "total": total}
+        evaluation["feedback"] = {
+            "expression_summary": str(data.get("expression_summary", "")).strip(),
+            "content_summary": str(data.get("content_summary", "")).strip(),
+            "expression_details": _string_list(data.get("expression_details")),
+            "content_details": _string_list(data.get("content_details")),
+            "weighting": str(data.get("weighting", "")).strip(),
+        }
+    return evaluation
+
+
+def extract_verdict(text):
+    """応答の本文から合否を取り出す (構造化出力のJSON・従来のマークダウンの両方に対応)"""
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        data = None
+    if isinstance(data, dict) and data.get("verdict") in VERDICTS:
+        return data["verdict"]
+    match = VERDICT_PATTERN.search(text or "")
+    return match.group(1) if match else None
+
+
+def mark_span(text, span):
+    """span の範囲を、highlight_text が強調表示する _**...**_ でマークアップする"""
+    start, end = span
+    return f"{text[:start]}_**{text[start:end]}**_{text[end:]}"
+
+
+def mark_highlight(answer, highlight):
+    """回答の中の highlight の語句を _**...**_ でマークアップする (見つからない場合はそのまま)"""
+    start = answer.find(highlight) if highlight else -1
+    if start < 0:
+        return answer
+    return mark_span(answer, (start, start + len(highlight)))
+
+
+# 要素別トレーニングの評価の見出し (LLM以外による評価はその旨を添える)
+SOURCE_HEADINGS = {"local": "**評価** (自動チェック)", "cache": "**評価** (よく似た回答の評価)"}
+
+
+def _bullets(items):
+    return "\n".join(f"- {item}" for item in items)
+
+
+def render_markdown(evaluation, answer):
+    """評価結果から、チャット欄に表示するマークダウンを組み立てる
+
+    表示はHTMLを許可して行うため、ユーザーの回答 (と、回答から抜き出した強調する語句) はエスケープしてから埋め込む。
+    """
+    quote = mark_highlight(html.escape(answer), html.escape(evaluation["highlight"]))
+    parts = [evaluation["reply"]] if evaluation["reply"] else []
+    if evaluation["kind"] == "element":
+        heading = SOURCE_HEADINGS.get(evaluation["source"], "**評価**")
+        parts.append(f"{heading}\n- ユーザーの回答: 「{quote}」\n{_bullets(evaluation['feedback'])}".rstrip())
+        if evaluation["improvements"]:
+            parts.append(f"**改善提案**\n{_bullets(evaluation['improvements'])}")
+        parts.append(f"【合否判定】: {evaluation['verdict']}")
+    else:
+        scores, feedback = evaluation["scores"], evaluation["feedback"]
+        parts.append(
+            "# 全体評価\n"
+            f"- ユーザーの回答: 「{quote}」\n"
+            f"- **合計**: {scores['total']}/10点 ({evaluation['verdict']})\n"
+            "- **点数内訳**:\n"
+            f"  - **表現面**: {scores['expression']}/5点 ({feedback['expression_summary']})\n"
+            f"  - **内容面**: {scores['content']}/5点 ({feedback['content_summary']})"
+        )
+        # 簡潔な形式の評価には詳細がない
+        if feedback["expression_details"]:
+            parts.append(f"# 表現面（詳細）\n{_bullets(feedback['expression_details'])}")
+        if feedback["content_details"]:
+            parts.append(f"# 内容面（詳細）\n{_bullets(feedback['content_details'])}")
+        if feedback["weighting"]:
+            parts.append(f"# 重み付けの考慮\n- {feedback['weighting']}")
+        if evaluation["improvements"]:
+            parts.append(f"# 改善提案\n{_bullets(evaluation['improvements'])}")
+    return "\n\n".join(parts)
+
+
+# --- 表示用のHTML ---
+HIGHLIGHT_PATTERN = re.compile(r"_\*\*(.+?)\*\*_")
+HIGHLIGHT_REPLACEMENT = r'<span style="color:red; font-weight:bold; text-decoration: underline;">\1</span>'
+VERDICT_COLORS = {"合格": "green", "不合格": "red"}
+# 保存済みの履歴を表示するときの変換結果のキャッシュ (メッセージ数の上限)
+HTML_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=HTML_CACHE_SIZE)
+def highlight_text(text):
+    """AIが出力する太字斜体下線マークアップ（_**...**_）を赤色に変換する"""
+    return HIGHLIGHT_PATTERN.sub(HIGHLIGHT_REPLACEMENT, text)
+
+
+def color_verdict(text):
+    """本文中の【合否判定】の行を、合格は緑・不合格は赤の太字にする"""
+    for verdict, color in VERDICT_COLORS.items():
+        text = text.replace(f"【合否判定】: {verdict}", f"**【合否判定】: <span style='color:{color};'>{verdict}</span>**")
+    return text
+
+
+def message_html(message):
+    """メッセージの表示用HTML (追加時に作った "html" があればそれを使う)"""
+    return message.get("html") or highlight_text(message["content"])
@@ -0,0 +1,188 @@
+"""研究用の一括エクスポート (CSV / Parquet)
+
+全ユーザーのセッション・ターン (回答と評価)・学習時間・進捗を、フラットな表として書き出す。
+ユーザーごと・セッションごとに読み込みながら一定行数ずつ書き出すため、
+ユーザー数が増えてもメモリ使用量は「1セッション + チャンク1つ分」に収まる。
+
+    python export_data.py exports/2026-10 --format parquet
+    python export_data.py exports/diff --since "2026-10-01 00:00:00"
+    python export_data.py exports/db --backend sqlite --path user_data/refuse_ai.db
+
+出力ファイル (出力先ディレクトリに作成):
+    sessions.{csv,parquet}    1セッション1行
+    turns.{csv,parquet}       1メッセージ1行 (構造化された評価・トークン数を含む)
+    study_time.{csv,parquet}  ユーザー・日付ごとの学習時間
+    progress.{csv,parquet}    ユーザー・要素ごとの合格状況 (エクスポート時点)
+    export_info.json          エクスポートの日時と条件 (exported_at は次回の --since に使える)
+
+--since を指定すると、その日時以降に保存されたセッションと、その日付以降の学習時間だけを書き出す。
+"""
+import argparse
+import csv
+import json
+import os
+import time
+
+import storage
+
+DEFAULT_CHUNK_ROWS = 5000
+
+TABLE_COLUMNS = {
+    "sessions": ["user_id", "session_id", "timestamp", "message_count", "answer_count"],
+    "turns": [
+        "user_id", "session_id", "timestamp", "turn", "role", "content",
+        "kind", "element", "verdict", "expression_score", "content_score", "total_score", "source",
+        "input_tokens", "cached_tokens", "output_tokens",
+    ],
+    "study_time": ["user_id", "date", "seconds"],
+    "progress": ["user_id", "element", "passed"],
+}
+
+# Parquet の列の型 (すべての行が欠損でも型が決まるように明示する)
+PARQUET_TYPES = {
+    "message_count": "int64", "answer_count": "int64", "turn": "int64", "seconds": "int64", "passed": "bool",
+    "expression_score": "int64", "content_score": "int64", "total_score": "int64",
+    "input_tokens": "int64", "cached_tokens": "int64", "output_tokens": "int64",
+}
+
+
+class CsvTableWriter:
+    def __init__(self, path, columns):
+        self._file = open(path, "w", encoding="utf-8", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetTableWriter:
+    """チャンクごとに1つの row group として追記する"""
+
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._columns = columns
+        self._schema = pa.schema([(column, pa.type_for_alias(PARQUET_TYPES.get(column, "string"))) for column in columns])
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, rows):
+        arrays = [list(values) for values in zip(*rows)]
+        table = self._pa.Table.from_arrays(
+            [self._pa.array(values, type=field.type) for values, field in zip(arrays, self._schema)],
+            schema=self._schema
+        )
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
+
+
+class ChunkedExporter:
+    """表ごとに行をためて、chunk_rows 行に達するたびに書き出す"""
+
+    def __init__(self, out_dir, file_format="csv", chunk_rows=DEFAULT_CHUNK_ROWS):
+        os.makedirs(out_dir, exist_ok=True)
+        writer_class = ParquetTableWriter if file_format == "parquet" else CsvTableWriter
+        self.chunk_rows = chunk_rows
+        self.row_counts = {table: 0 for table in TABLE_COLUMNS}
+        self._buffers = {table: [] for table in TABLE_COLUMNS}
+        self._writers = {
+            table: writer_class(os.path.join(out_dir, f"{table}.{file_format}"), columns)
+            for table, columns in TABLE_COLUMNS.items()
+        }
+
+    def add(self, table, row):
+        buffer = self._buffers[table]
+        buffer.append(row)
+        if len(buffer) >= self.chunk_rows:
+            self._flush(table)
+
+    def _flush(self, table):
+        buffer = self._buffers[table]
+        if buffer:
+            self._writers[table].write(buffer)
+            self.row_counts[table] += len(buffer)
+            buffer.clear()
+
+    def close(self):
+        for table, writer in self._writers.items():
+            self._flush(table)
+            writer.close()
+
+
+def turn_rows(user_id, session):
+    """1セッションの会話を、1メッセージ1行に平坦化する"""
+    for turn, message in enumerate(session["history"]):
+        result = message.get("evaluation") or {}
+        scores = result.get("scores") or {}
+        usage = message.get("usage") or {}
+        yield (
+            user_id, session["session_id"], session["timestamp"], turn, message.get("role"), message.get("content"),
+            result.get("kind"), result.get("element"), result.get("verdict"),
+            scores.get("expression"), scores.get("content"), scores.get("total"), result.get("source"),
+            usage.get("input_tokens"), usage.get("cached_tokens"), usage.get("output_tokens"),
+        )
+
+
+def export_all(store, exporter, since=None):
+    """全ユーザーのデータをエクスポートし、対象ユーザー数を返す"""
+    since_date = since[:10] if since else None
+    user_ids = store.list_user_ids()
+    for user_id in user_ids:
+        for element, passed in store.load_progress(user_id).items():
+            exporter.add("progress", (user_id, element, bool(passed)))
+        for date_key, seconds in sorted(store.load_study_logs(user_id).items()):
+            if since_date is None or date_key >= since_date:
+                exporter.add("study_time", (user_id, date_key, int(seconds)))
+
+        # 本文は対象のセッションだけを1件ずつ読み込む
+        headers, _ = store.list_chat_headers(user_id)
+        for header in reversed(headers):
+            if since and header["timestamp"] < since:
+                continue
+            session = store.load_chat_session(user_id, header["session_id"])
+            if session is None:
+                continue
+            answer_count = sum(1 for message in session["history"] if message.get("role") == "user")
+            exporter.add("sessions", (
+                user_id, session["session_id"], session["timestamp"], len(session["history"]), answer_count
+            ))
+            for row in turn_rows(user_id, session):
+                exporter.add("turns", row)
+    return len(user_ids)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="誘いを断る練習AI の研究用データを CSV / Parquet に書き出す")
+    parser.add_argument("out_dir", help="出力先のディレクトリ")
+    parser.add_argument("--format", dest="file_format", choices=["csv", "parquet"], default="csv", help="出力形式")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json", help="データ保存方式")
+    parser.add_argument("--path", help="保存先のディレクトリ (json) またはDBファイル (sqlite)")
+    parser.add_argument("--since", help="この日時 (YYYY-MM-DD または YYYY-MM-DD HH:MM:SS) 以降のデータだけを書き出す")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS, help="1回に書き出す行数")
+    args = parser.parse_args(argv)
+
+    exported_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    exporter = ChunkedExporter(args.out_dir, args.file_format, args.chunk_rows)
+    try:
+        users = export_all(storage.create_storage(args.backend, args.path), exporter, args.since)
+    finally:
+        exporter.close()
+
+    info = {"exported_at": exported_at, "since": args.since, "users": users, "rows": exporter.row_counts}
+    with open(os.path.join(args.out_dir, "export_info.json"), "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=4)
+    counts = " / ".join(f"{table} {count}行" for table, count in exporter.row_counts.items())
+    print(f"{users} 人分のデータを {args.out_dir} に書き出しました ({counts})。")
+    print(f"次回の差分エクスポート: --since \"{exported_at}\"")
+
+
+if __name__ == "__main__":
+    main()
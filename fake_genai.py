@@ -0,0 +1,241 @@
+"""google.generativeai の代わりに使える、オフラインの疑似バックエンド
+
+APIキーなしでアプリを動かしたり、負荷試験 (loadtest.py) を行ったりするためのもの。
+アプリで使っている範囲 (configure / GenerativeModel / ChatSession / caching) だけを同じ形で提供する。
+generation_config に response_mime_type="application/json" を指定すると、評価を構造化出力 (JSON) で返す。
+環境変数 LLM_BACKEND=fake で起動すると、refuseAI.py はこのモジュールを使う。
+
+応答の遅延や合格率は環境変数で調整できる:
+    FAKE_LLM_LATENCY      最初のチャンクまでの秒数 (既定 0.5)
+    FAKE_LLM_CHUNK_DELAY  チャンク間の秒数 (既定 0.02)
+    FAKE_LLM_CHUNK_CHARS  1チャンクあたりの文字数 (既定 20)
+    FAKE_LLM_PASS_RATE    要素別トレーニングで「合格」を返す確率 (既定 0.3)
+    FAKE_LLM_CACHE_MIN_TOKENS  コンテキストキャッシュを作成できる最小トークン数 (既定 0。これ未満は作成に失敗する)
+"""
+import json
+import os
+import random
+import time
+from types import SimpleNamespace
+
+INVITATION_TEMPLATE = """**シチュエーション:** あなたは大学1年生で、{relation}から声をかけられました。
+
+「ねえ、今度の土曜日に{event}があるんだけど、一緒に行かない？ みんなも来るし、絶対楽しいと思うんだ！」"""
+
+REPLIES = [
+    "そっか、残念だけど仕方ないね。また今度誘うよ！",
+    "えー、そうなんだ。ちょっとだけでも顔出せない？",
+    "わかった！また別の機会に声かけるね。",
+]
+
+RELATIONS = ["サークルの先輩", "バイトの同僚", "大学の友人", "新卒の教育担当"]
+EVENTS = ["飲み会", "BBQ", "カラオケ", "勉強会", "ボランティア活動"]
+
+ELEMENT_FEEDBACK_TEMPLATE = """そっか、残念だけど仕方ないね。また今度誘うよ！
+
+**評価**
+- ユーザーの回答: 「_**{quote}**_」
+- {comment}
+
+**改善提案**
+- 理由と代わりの提案を一言添えると、より相手に配慮した断り方になります。
+
+【合否判定】: {verdict}"""
+
+FULL_FEEDBACK_TEMPLATE = """そっか、わかった！また誘うね。
+
+# 全体評価
+- **合計**: {total}/10点 ({verdict})
+- **点数内訳**:
+  - **表現面**: {expression}/5点 (言葉遣いは概ね適切)
+  - **内容面**: {content}/5点 (理由と代替案の具体性に改善の余地あり)
+
+# 表現面（詳細）
+- **評価**: 謝罪の言葉があり、丁寧さが感じられます。
+
+# 内容面（詳細）
+- **評価**: 断りの意思は伝わっていますが、代替案がもう少し具体的だとよいでしょう。
+
+# 重み付けの考慮
+- 親しい先輩からの誘いのため、表現面の自然さがより重要でした。
+
+# 改善提案
+- 「また今度」ではなく、具体的な日程を添える練習をしましょう。"""
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def configure(**kwargs):
+    """google.generativeai.configure と同じ呼び出しを受け付ける (何もしない)"""
+
+
+def _count_tokens(text):
+    # 日本語はおおよそ1〜2文字で1トークンになるため、目安として文字数の半分とする
+    return max(1, len(text) // 2)
+
+
+def _wants_json(generation_config):
+    return bool(generation_config) and generation_config.get("response_mime_type") == "application/json"
+
+
+def _content_text(content):
+    if isinstance(content, str):
+        return content
+    if isinstance(content, dict):
+        return "".join(str(part) for part in content.get("parts", []))
+    return "".join(getattr(part, "text", str(part)) for part in getattr(content, "parts", []))
+
+
+class FakeResponse:
+    """GenerateContentResponse と同じく、.text / .usage_metadata とチャンクの反復を提供する"""
+
+    def __init__(self, text, prompt_tokens, stream, cached_tokens=0):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=_count_tokens(text),
+            cached_content_token_count=cached_tokens,
+            total_token_count=prompt_tokens + _count_tokens(text)
+        )
+        self._stream = stream
+
+    def __iter__(self):
+        chunk_chars = int(_env_float("FAKE_LLM_CHUNK_CHARS", 20))
+        chunk_delay = _env_float("FAKE_LLM_CHUNK_DELAY", 0.02)
+        if not self._stream:
+            yield self
+            return
+        for start in range(0, len(self.text), chunk_chars):
+            if start:
+                time.sleep(chunk_delay)
+            yield SimpleNamespace(text=self.text[start:start + chunk_chars])
+
+    def resolve(self):
+        pass
+
+
+class GenerativeModel:
+    """google.generativeai.GenerativeModel の疑似実装"""
+
+    def __init__(self, model_name="models/fake", system_instruction=None, generation_config=None, **kwargs):
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ""
+        self.generation_config = generation_config
+        # コンテキストキャッシュから作ったモデルでは、システムプロンプト分をキャッシュ済みの入力として数える
+        self.cached_tokens = 0
+
+    @classmethod
+    def from_cached_content(cls, cached_content, **kwargs):
+        model = cls(cached_content.model, system_instruction=cached_content.system_instruction)
+        model.cached_tokens = cached_content.usage_metadata.total_token_count
+        return model
+
+    def start_chat(self, history=None):
+        return ChatSession(self, history or [])
+
+    def generate_content(self, contents, stream=False, request_options=None, generation_config=None, **kwargs):
+        if not isinstance(contents, list):
+            contents = [contents]
+        return self._respond([_content_text(content) for content in contents], stream, _wants_json(generation_config))
+
+    def _respond(self, texts, stream, structured=False):
+        time.sleep(_env_float("FAKE_LLM_LATENCY", 0.5))
+        prompt_tokens = _count_tokens(self.system_instruction) + sum(_count_tokens(text) for text in texts)
+        if len(texts) <= 1:
+            text = INVITATION_TEMPLATE.format(relation=random.choice(RELATIONS), event=random.choice(EVENTS))
+        elif "【相手役の返答】" in self.system_instruction:
+            text = random.choice(REPLIES)
+        elif "【合否判定】" in self.system_instruction:
+            passed = random.random() < _env_float("FAKE_LLM_PASS_RATE", 0.3)
+            if structured:
+                return FakeResponse(json.dumps({
+                    "reply": "そっか、残念だけど仕方ないね。また今度誘うよ！",
+                    "highlight": texts[-1][:8],
+                    "feedback": ["相手に配慮した言葉が選べています。" if passed else "この要素の表現がまだ不足しています。"],
+                    "improvements": ["理由と代わりの提案を一言添えると、より相手に配慮した断り方になります。"],
+                    "verdict": "合格" if passed else "不合格"
+                }, ensure_ascii=False), prompt_tokens, stream, self.cached_tokens)
+            text = ELEMENT_FEEDBACK_TEMPLATE.format(
+                quote=texts[-1][:30],
+                comment="相手に配慮した言葉が選べています。" if passed else "この要素の表現がまだ不足しています。",
+                verdict="合格" if passed else "不合格"
+            )
+        else:
+            expression, content = random.randint(2, 5), random.randint(2, 5)
+            if structured:
+                return FakeResponse(json.dumps({
+                    "reply": "そっか、わかった！また誘うね。",
+                    "highlight": texts[-1][:8],
+                    "expression_score": expression,
+                    "expression_summary": "言葉遣いは概ね適切",
+                    "content_score": content,
+                    "content_summary": "理由と代替案の具体性に改善の余地あり",
+                    "expression_details": ["謝罪の言葉があり、丁寧さが感じられます。"],
+                    "content_details": ["断りの意思は伝わっていますが、代替案がもう少し具体的だとよいでしょう。"],
+                    "weighting": "親しい先輩からの誘いのため、表現面の自然さがより重要でした。",
+                    "improvements": ["「また今度」ではなく、具体的な日程を添える練習をしましょう。"]
+                }, ensure_ascii=False), prompt_tokens, stream, self.cached_tokens)
+            total = expression + content
+            text = FULL_FEEDBACK_TEMPLATE.format(
+                expression=expression, content=content, total=total, verdict="合格" if total == 10 else "不合格"
+            )
+        return FakeResponse(text, prompt_tokens, stream, self.cached_tokens)
+
+
+class ChatSession:
+    """google.generativeai.ChatSession の疑似実装"""
+
+    def __init__(self, model, history):
+        self.model = model
+        self.history = history
+
+    @property
+    def history(self):
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        self._history = [
+            SimpleNamespace(role=content["role"], parts=[SimpleNamespace(text=str(part)) for part in content["parts"]])
+            if isinstance(content, dict) else content
+            for content in history
+        ]
+
+    def send_message(self, content, stream=False, request_options=None, generation_config=None, **kwargs):
+        texts = [_content_text(item) for item in self._history] + [_content_text(content)]
+        response = self.model._respond(texts, stream, _wants_json(generation_config))
+        self._history.append(SimpleNamespace(role="user", parts=[SimpleNamespace(text=_content_text(content))]))
+        self._history.append(SimpleNamespace(role="model", parts=[SimpleNamespace(text=response.text)]))
+        return response
+
+
+class CachedContent:
+    """google.generativeai.caching.CachedContent の疑似実装 (プロセス内に保持するだけで、期限切れにはならない)
+
+    GenerativeModel.from_cached_content に渡せる model / system_instruction / usage_metadata を持つ。
+    """
+
+    def __init__(self, name, model, display_name, system_instruction, ttl):
+        self.name = name
+        self.model = model
+        self.display_name = display_name
+        self.system_instruction = system_instruction or ""
+        self.ttl = ttl
+        self.usage_metadata = SimpleNamespace(total_token_count=_count_tokens(self.system_instruction))
+
+    @classmethod
+    def create(cls, model, display_name=None, system_instruction=None, ttl=None, **kwargs):
+        cached_content = cls(f"cachedContents/fake-{random.getrandbits(32):08x}", model, display_name, system_instruction, ttl)
+        # 実際のAPIと同じく、短すぎるプロンプトはキャッシュできない (アプリは通常のモデルにフォールバックする)
+        min_tokens = int(_env_float("FAKE_LLM_CACHE_MIN_TOKENS", 0))
+        if cached_content.usage_metadata.total_token_count < min_tokens:
+            raise ValueError(f"キャッシュするには {min_tokens} トークン以上が必要です。")
+        return cached_content
+
+    def delete(self):
+        pass
+
+
+caching = SimpleNamespace(CachedContent=CachedContent)
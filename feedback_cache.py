@@ -0,0 +1,136 @@
+"""よく似た回答への評価の再利用 (要素別トレーニング)
+
+同じクラスの学生は、同じ種類のシナリオに対してよく似た断り方をする
+(「すみません、その日は先約があって…」など)。要素別トレーニングの評価について、
+要素・シナリオ・回答がほぼ同じ過去の評価があれば、LLMを呼ばずにそれを返す。
+
+回答の近さは、正規化した回答の文字 n-gram の集合どうしの Jaccard 係数で測る
+(外部の埋め込みサービスは使わない)。係数が threshold 以上の最も近い評価を使う。
+エントリは ttl_seconds で期限切れになり、max_entries を超えると最も長く使われていないものから捨てる。
+"""
+import copy
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 2000
+DEFAULT_TTL_SECONDS = 6 * 60 * 60
+DEFAULT_THRESHOLD = 0.9
+DEFAULT_NGRAM = 2
+
+# 正規化で取り除く文字 (空白・句読点・記号)
+IGNORED_CHARS = re.compile(r"[\s、。，．,.!?！？「」『』（）()…・〜~ー—\-]+")
+
+
+def normalize(text):
+    """全角半角・大文字小文字・空白・句読点の違いをなくす"""
+    return IGNORED_CHARS.sub("", unicodedata.normalize("NFKC", text or "").lower())
+
+
+def fingerprint(text, n=DEFAULT_NGRAM):
+    """正規化した文字列の文字 n-gram の集合"""
+    text = normalize(text)
+    if len(text) <= n:
+        return frozenset([text]) if text else frozenset()
+    return frozenset(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+def similarity(a, b):
+    """2つの n-gram 集合の Jaccard 係数 (0〜1)"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class FeedbackCache:
+    """(要素, 正規化したシナリオ) ごとに、回答の n-gram と評価結果を保持するキャッシュ"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 threshold=DEFAULT_THRESHOLD, ngram=DEFAULT_NGRAM):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.ngram = ngram
+        self._entries = OrderedDict()  # 連番 -> エントリ (先頭ほど長く使われていない)
+        self._buckets = {}             # (要素, シナリオ) -> 連番の集合
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _bucket_key(self, element, scenario):
+        return (element, normalize(scenario))
+
+    def lookup(self, element, scenario, answer):
+        """よく似た回答の評価があれば、そのコピーと類似度を返す。なければ (None, 0.0)。"""
+        answer_ngrams = fingerprint(answer, self.ngram)
+        now = time.time()
+        with self._lock:
+            best_id, best_score = None, 0.0
+            for entry_id in list(self._buckets.get(self._bucket_key(element, scenario), ())):
+                entry = self._entries[entry_id]
+                if entry["created"] < now - self.ttl_seconds:
+                    self._remove(entry_id)
+                    continue
+                score = similarity(answer_ngrams, entry["ngrams"])
+                if score > best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None or best_score < self.threshold:
+                self.misses += 1
+                return None, best_score
+            entry = self._entries[best_id]
+            entry["hits"] += 1
+            entry["last_hit"] = now
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return copy.deepcopy(entry["evaluation"]), best_score
+
+    def store(self, element, scenario, answer, evaluation):
+        """LLMによる評価を登録する (ほぼ同じ回答が登録済みなら何もしない)"""
+        answer_ngrams = fingerprint(answer, self.ngram)
+        if not answer_ngrams:
+            return
+        bucket_key = self._bucket_key(element, scenario)
+        with self._lock:
+            bucket = self._buckets.setdefault(bucket_key, set())
+            if any(similarity(answer_ngrams, self._entries[entry_id]["ngrams"]) >= self.threshold for entry_id in bucket):
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = {
+                "bucket": bucket_key,
+                "answer": answer,
+                "ngrams": answer_ngrams,
+                "evaluation": copy.deepcopy(evaluation),
+                "created": time.time(),
+                "hits": 0,
+                "last_hit": None,
+            }
+            bucket.add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        bucket = self._buckets[entry["bucket"]]
+        bucket.discard(entry_id)
+        if not bucket:
+            del self._buckets[entry["bucket"]]
+
+    def stats(self, top=10):
+        """全体のヒット数・ミス数と、ヒットの多いエントリ (回答・要素・ヒット数) を返す"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            top_entries = sorted(self._entries.values(), key=lambda entry: entry["hits"], reverse=True)[:top]
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "top_entries": [
+                    {"element": entry["bucket"][0], "answer": entry["answer"], "hits": entry["hits"]}
+                    for entry in top_entries if entry["hits"]
+                ],
+            }
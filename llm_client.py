@@ -0,0 +1,263 @@
+"""Gemini API 呼び出しの共通ラッパー
+
+すべてのLLM呼び出しはこのモジュールを通す。
+- 1回の呼び出しごとのタイムアウトと、リトライ全体の締め切り
+- 混雑・一時的な障害 (429 / 5xx / タイムアウト) に対する、ジッター付き指数バックオフでのリトライ
+- プロセス全体で共有する同時実行数の上限 (セマフォ) と、1分あたりのリクエスト数の上限 (トークンバケット)
+
+リトライしても応答が得られない場合は LLMUnavailableError を送出する。
+呼び出しごとの所要時間とトークン数は metrics に記録する (labels で mode / element などを付与できる)。
+"""
+import logging
+import random
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT_SECONDS = 60   # 1回の呼び出しのタイムアウト
+TOTAL_DEADLINE_SECONDS = 120   # 待ち時間・リトライを含めた全体の締め切り
+MAX_RETRIES = 3
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 16.0
+DEGRADED_SECONDS = 60          # リトライが発生してから「混雑中」とみなす時間
+
+DEFAULT_MAX_CONCURRENT = 8
+DEFAULT_REQUESTS_PER_MINUTE = 60
+
+
+class LLMUnavailableError(Exception):
+    """混雑や障害により、締め切りまでに応答が得られなかった"""
+
+
+class RequestLimiter:
+    """同時実行数の上限 (セマフォ) と、1分あたりのリクエスト数の上限 (トークンバケット)"""
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE):
+        self.max_concurrent = max_concurrent
+        self.requests_per_minute = requests_per_minute
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._rate = requests_per_minute / 60.0
+        self._capacity = float(max(1, max_concurrent))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take_token(self):
+        """トークンを1つ取り出す。足りない場合は、補充されるまでの秒数を返す。"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self._rate
+
+    def acquire(self, timeout):
+        """実行枠とトークンを確保する。timeout 秒以内に確保できなければ False を返す。"""
+        deadline = time.monotonic() + timeout
+        if not self._semaphore.acquire(timeout=max(0.0, timeout)):
+            return False
+        while True:
+            wait = self._take_token()
+            if wait == 0.0:
+                return True
+            if time.monotonic() + wait > deadline:
+                self._semaphore.release()
+                return False
+            time.sleep(wait)
+
+    def release(self):
+        self._semaphore.release()
+
+
+_limiter = RequestLimiter()
+_degraded_until = 0.0
+
+
+def configure(max_concurrent=DEFAULT_MAX_CONCURRENT, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE):
+    """プロセス全体の上限を設定する (APIのクォータに合わせる)"""
+    global _limiter
+    if (_limiter.max_concurrent, _limiter.requests_per_minute) != (max_concurrent, requests_per_minute):
+        _limiter = RequestLimiter(max_concurrent, requests_per_minute)
+
+
+def is_degraded():
+    """直近でリトライや失敗が発生しているか (混雑中の案内表示に使う)"""
+    return time.monotonic() < _degraded_until
+
+
+def _mark_degraded():
+    global _degraded_until
+    _degraded_until = time.monotonic() + DEGRADED_SECONDS
+
+
+def _retryable_exceptions():
+    """リトライ対象の例外 (429 / 5xx / タイムアウト / 接続エラー)"""
+    try:
+        from google.api_core import exceptions as core_exceptions
+    except ImportError:
+        return (TimeoutError, ConnectionError)
+    return (
+        core_exceptions.TooManyRequests,
+        core_exceptions.ResourceExhausted,
+        core_exceptions.InternalServerError,
+        core_exceptions.ServiceUnavailable,
+        core_exceptions.DeadlineExceeded,
+        TimeoutError,
+        ConnectionError
+    )
+
+
+def get_token_usage(response):
+    """応答の usage_metadata から、入力・出力・キャッシュ済みのトークン数を取り出す"""
+    usage = getattr(response, "usage_metadata", None)
+    return {
+        "input_tokens": getattr(usage, "prompt_token_count", 0) or 0,
+        "cached_tokens": getattr(usage, "cached_content_token_count", 0) or 0,
+        "output_tokens": getattr(usage, "candidates_token_count", 0) or 0
+    }
+
+
+def _record_usage(response, labels):
+    """応答の usage_metadata から、入力・出力トークン数を記録する"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    input_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    metrics.inc("refuse_ai_llm_input_tokens_total", input_tokens, **labels)
+    metrics.inc("refuse_ai_llm_output_tokens_total", output_tokens, **labels)
+    metrics.observe("refuse_ai_llm_input_tokens", input_tokens, buckets=metrics.TOKEN_BUCKETS, **labels)
+
+
+def _backoff_seconds(retry_count):
+    """フルジッター付きの指数バックオフ"""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** retry_count)))
+
+
+class StreamingResponse:
+    """ストリーミング応答のラッパー
+
+    最初のチャンクは呼び出し時に取得済み (そこまではリトライ可能)。
+    最後まで読み切るか中断された時点で、実行枠を解放する。
+    それ以外の属性 (text, usage_metadata など) は元の応答オブジェクトに委譲する。
+    """
+
+    _END = object()
+
+    def __init__(self, response, chunks, first_chunk, limiter, on_failure, started, labels):
+        self._response = response
+        self._chunks = chunks
+        self._first_chunk = first_chunk
+        self._limiter = limiter
+        self._on_failure = on_failure
+        self._started = started
+        self._labels = labels
+        self._released = False
+
+    def __iter__(self):
+        try:
+            if self._first_chunk is not self._END:
+                yield self._first_chunk
+            for chunk in self._chunks:
+                yield chunk
+            metrics.observe("refuse_ai_llm_call_seconds", time.perf_counter() - self._started, outcome="ok", **self._labels)
+            _record_usage(self._response, self._labels)
+        except _retryable_exceptions() as e:
+            # 途中まで受信した応答はリトライできないため、会話履歴を戻して失敗として扱う
+            metrics.observe("refuse_ai_llm_call_seconds", time.perf_counter() - self._started, outcome="error", **self._labels)
+            _mark_degraded()
+            if self._on_failure:
+                self._on_failure()
+            raise LLMUnavailableError("応答の受信中に接続が切れました。") from e
+        finally:
+            self._release()
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self._limiter.release()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+def _call(attempt, stream=False, timeout=None, deadline=None, on_failure=None, labels=None):
+    """attempt(request_timeout) を、上限・タイムアウト・リトライ付きで実行する"""
+    labels = labels or {}
+    started = time.perf_counter()
+    timeout = timeout or REQUEST_TIMEOUT_SECONDS
+    end_time = time.monotonic() + (deadline or TOTAL_DEADLINE_SECONDS)
+    retryable = _retryable_exceptions()
+    limiter = _limiter
+    last_error = None
+
+    for retry_count in range(MAX_RETRIES + 1):
+        remaining = end_time - time.monotonic()
+        if remaining <= 0:
+            break
+        if not limiter.acquire(remaining):
+            last_error = TimeoutError("リクエスト数の上限により、締め切りまでに実行できませんでした。")
+            break
+        try:
+            response = attempt(min(timeout, remaining))
+            if not stream:
+                limiter.release()
+                metrics.observe("refuse_ai_llm_call_seconds", time.perf_counter() - started, outcome="ok", **labels)
+                _record_usage(response, labels)
+                return response
+            chunks = iter(response)
+            first_chunk = next(chunks, StreamingResponse._END)
+            metrics.observe("refuse_ai_llm_first_chunk_seconds", time.perf_counter() - started, **labels)
+            return StreamingResponse(response, chunks, first_chunk, limiter, on_failure, started, labels)
+        except retryable as e:
+            limiter.release()
+            last_error = e
+            metrics.inc("refuse_ai_llm_retries_total", **labels)
+            _mark_degraded()
+            if on_failure:
+                on_failure()
+            if retry_count == MAX_RETRIES:
+                logger.warning("LLM呼び出しに失敗しました (%d回目): %s", retry_count + 1, e)
+                break
+            wait = _backoff_seconds(retry_count)
+            logger.warning("LLM呼び出しに失敗しました (%d回目): %s / %.1f秒後に再試行します", retry_count + 1, e, wait)
+            if time.monotonic() + wait >= end_time:
+                break
+            time.sleep(wait)
+        except Exception:
+            limiter.release()
+            metrics.observe("refuse_ai_llm_call_seconds", time.perf_counter() - started, outcome="error", **labels)
+            if on_failure:
+                on_failure()
+            raise
+
+    metrics.observe("refuse_ai_llm_call_seconds", time.perf_counter() - started, outcome="unavailable", **labels)
+    _mark_degraded()
+    raise LLMUnavailableError("AIサーバーが混み合っているため、応答を取得できませんでした。") from last_error
+
+
+def send_message(chat, content, stream=False, timeout=None, deadline=None, labels=None, **kwargs):
+    """ChatSession.send_message を、上限・タイムアウト・リトライ付きで呼び出す"""
+    saved_history = list(chat.history)
+
+    def attempt(request_timeout):
+        return chat.send_message(content, stream=stream, request_options={"timeout": request_timeout}, **kwargs)
+
+    def restore_history():
+        # 失敗した送信が会話履歴に残らないよう、送信前の状態に戻す
+        chat.history = saved_history
+
+    return _call(attempt, stream=stream, timeout=timeout, deadline=deadline, on_failure=restore_history, labels=labels)
+
+
+def generate_content(model, contents, stream=False, timeout=None, deadline=None, labels=None, **kwargs):
+    """GenerativeModel.generate_content を、上限・タイムアウト・リトライ付きで呼び出す"""
+    def attempt(request_timeout):
+        return model.generate_content(contents, stream=stream, request_options={"timeout": request_timeout}, **kwargs)
+
+    return _call(attempt, stream=stream, timeout=timeout, deadline=deadline, labels=labels)
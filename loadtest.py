@@ -0,0 +1,228 @@
+"""同時に練習する学生を模擬する負荷試験ハーネス
+
+疑似バックエンド (fake_genai.py) を使い、実際の refuseAI.py を Streamlit の AppTest で動かす。
+学生1人ごとに「ログイン → 要素を選択 → 練習を開始 → 回答 → 履歴を保存」の流れを実行し、
+再実行 (rerun) ごとの所要時間、データ保存の書き込み時間と取りこぼし、1セッションあたりのメモリを集計する。
+
+AppTest はプロセス内のグローバルな状態を使うためスレッドからは並行実行できない。
+そのため同時に操作する学生はワーカープロセスに分けて走らせ、同じデータ保存先を共有させる。
+(複数のアプリプロセスが1つの user_data/ を共有する本番構成に近い)
+
+    python loadtest.py --students 50 --concurrency 10 --turns 3
+    python loadtest.py --students 50 --backend sqlite --latency 1.0
+
+途中で失敗した学生が1人でもいる場合や、保存した履歴の取りこぼしがある場合は終了コード1で終わる
+(失敗した学生の計測値は集計に含まれないため、集計だけを見て見落とさないようにする)。
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import multiprocessing
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "refuseAI.py")
+
+SAMPLE_ANSWERS = [
+    "すみません、その日は先約があって行けないんです。誘ってくれてありがとうございます！",
+    "ごめん、その日はバイトが入ってて無理なんだ。また今度誘ってね。",
+    "申し訳ないのですが、今回は遠慮させてください。来週なら空いています。",
+]
+
+
+class WriteRecorder:
+    """ストレージの書き込みメソッドを包み、回数と所要時間を記録する"""
+
+    WRITE_METHODS = (
+        "save_progress", "add_study_time", "add_token_usage", "save_live_session", "delete_live_session",
+        "append_chat_session", "delete_chat_session",
+    )
+
+    def __init__(self):
+        self.durations = []
+        self._lock = threading.Lock()
+
+    def install(self):
+        import storage
+        for cls in (storage.JsonStorage, storage.SqliteStorage):
+            for name in self.WRITE_METHODS:
+                setattr(cls, name, self._wrap(getattr(cls, name)))
+
+    def _wrap(self, method):
+        recorder = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                with recorder._lock:
+                    recorder.durations.append(time.perf_counter() - start)
+        return timed
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1]
+
+
+def run_student(student_no, turns, timeout):
+    """学生1人分の流れを実行し、各再実行の所要時間を (手順名, 秒) のリストで返す"""
+    from streamlit.testing.v1 import AppTest
+
+    timings = []
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+
+    def timed_run(step, action):
+        start = time.perf_counter()
+        action().run()
+        timings.append((step, time.perf_counter() - start))
+        if at.exception:
+            raise RuntimeError(f"{step}: {at.exception[0].message}")
+
+    timed_run("login_page", lambda: at)
+    timed_run("login", lambda: at.text_input(key="user_id_key").input(f"load{student_no:05d}"))
+    timed_run("select_element", lambda: next(b for b in at.button if b.label == "この要素を選択する").click())
+    timed_run("start", lambda: at.button(key="start_button_main").click())
+    for turn in range(turns):
+        timed_run("answer", lambda: at.chat_input[0].set_value(SAMPLE_ANSWERS[turn % len(SAMPLE_ANSWERS)]))
+    timed_run("save", lambda: at.button(key="save_button_view2").click())
+    return timings
+
+
+def run_worker(student_nos, turns, timeout):
+    """ワーカープロセスで、割り当てられた学生を順に実行して計測結果を返す"""
+    recorder = WriteRecorder()
+    recorder.install()
+    timings = []
+    failures = []
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    for student_no in student_nos:
+        try:
+            timings.extend(run_student(student_no, turns, timeout))
+        except Exception as e:
+            failures.append(f"学生 {student_no}: {e}")
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "timings": timings,
+        "failures": failures,
+        "write_durations": recorder.durations,
+        "memory_growth": memory_after - memory_before,
+        "memory_peak": memory_peak,
+    }
+
+
+def count_saved_sessions(backend, data_path, students):
+    import storage
+    store = storage.create_storage(backend, data_path)
+    return sum(store.list_chat_headers(f"load{i:05d}", 0, 1)[1] for i in range(students))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="誘いを断る練習AI の同時利用負荷試験")
+    parser.add_argument("--students", type=int, default=20, help="模擬する学生の人数")
+    parser.add_argument("--concurrency", type=int, default=10, help="同時に操作する学生の人数")
+    parser.add_argument("--turns", type=int, default=2, help="1人あたりの回答回数")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json", help="データ保存方式")
+    parser.add_argument("--latency", type=float, default=0.5, help="疑似LLMの最初のチャンクまでの秒数")
+    parser.add_argument("--timeout", type=float, default=120, help="1回の再実行のタイムアウト秒数")
+    parser.add_argument("--json", dest="json_path", help="結果をJSONでも書き出すファイル")
+    args = parser.parse_args(argv)
+
+    data_dir = tempfile.mkdtemp(prefix="refuse_ai_loadtest_")
+    data_path = data_dir if args.backend == "json" else os.path.join(data_dir, "refuse_ai.db")
+    os.environ.update({
+        "LLM_BACKEND": "fake",
+        "STORAGE_BACKEND": args.backend,
+        "STORAGE_PATH": data_path,
+        "FAKE_LLM_LATENCY": str(args.latency),
+    })
+
+    # 学生をワーカープロセスに振り分ける (各ワーカーは担当の学生を順に実行する)
+    workers = max(1, min(args.concurrency, args.students))
+    assignments = [list(range(i, args.students, workers)) for i in range(workers)]
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        results = list(executor.map(run_worker, assignments, [args.turns] * workers, [args.timeout] * workers))
+    elapsed = time.perf_counter() - started
+
+    timings = [timing for result in results for timing in result["timings"]]
+    failures = [failure for result in results for failure in result["failures"]]
+    write_durations = [duration for result in results for duration in result["write_durations"]]
+    memory_growth = sum(result["memory_growth"] for result in results)
+    memory_peak = max(result["memory_peak"] for result in results)
+
+    completed = args.students - len(failures)
+    saved = count_saved_sessions(args.backend, data_path, args.students)
+    rerun_latencies = [duration for _, duration in timings]
+    result = {
+        "students": args.students,
+        "concurrency": args.concurrency,
+        "backend": args.backend,
+        "elapsed_seconds": elapsed,
+        "completed": completed,
+        "failures": failures[:10],
+        "rerun_latency": {
+            "count": len(rerun_latencies),
+            "p50": percentile(rerun_latencies, 50),
+            "p95": percentile(rerun_latencies, 95),
+            "p99": percentile(rerun_latencies, 99),
+        },
+        "rerun_latency_by_step": {
+            step: {
+                "p50": percentile([d for s, d in timings if s == step], 50),
+                "p95": percentile([d for s, d in timings if s == step], 95),
+            }
+            for step in dict.fromkeys(step for step, _ in timings)
+        },
+        "storage_writes": {
+            "count": len(write_durations),
+            "p50": percentile(write_durations, 50),
+            "p95": percentile(write_durations, 95),
+            "p99": percentile(write_durations, 99),
+            "lost_chat_sessions": completed - saved,
+        },
+        "memory_per_session_bytes": memory_growth / max(1, completed),
+        "memory_peak_bytes": memory_peak,
+        "data_path": data_path,
+    }
+
+    print(f"学生 {args.students} 人 (同時 {args.concurrency} 人, {args.backend}) / 完了 {completed} 人 / {elapsed:.1f} 秒")
+    latency = result["rerun_latency"]
+    print(f"再実行の所要時間: p50 {latency['p50'] * 1000:.0f}ms / p95 {latency['p95'] * 1000:.0f}ms / p99 {latency['p99'] * 1000:.0f}ms")
+    for step, stats in result["rerun_latency_by_step"].items():
+        print(f"  {step:<15} p50 {stats['p50'] * 1000:.0f}ms / p95 {stats['p95'] * 1000:.0f}ms")
+    writes = result["storage_writes"]
+    print(
+        f"書き込み: {writes['count']} 回 / p50 {writes['p50'] * 1000:.1f}ms / p95 {writes['p95'] * 1000:.1f}ms / "
+        f"p99 {writes['p99'] * 1000:.1f}ms / 取りこぼし {writes['lost_chat_sessions']} セッション"
+    )
+    print(
+        f"メモリ: 1セッションあたり {result['memory_per_session_bytes'] / 1024:.0f}KiB / "
+        f"ワーカーあたりのピーク {memory_peak / 1024 / 1024:.1f}MiB"
+    )
+    for failure in failures[:10]:
+        print(f"失敗: {failure}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+
+    if failures or writes["lost_chat_sessions"]:
+        print(f"負荷試験に失敗しました (失敗 {len(failures)} 人 / 取りこぼし {writes['lost_chat_sessions']} セッション)。")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
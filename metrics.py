@@ -0,0 +1,192 @@
+"""軽量な計測基盤 (ヒストグラム・カウンターと Prometheus 形式での出力)
+
+LLM呼び出し・データ保存・スクリプトの再実行などの所要時間をプロセス内で集計し、
+Prometheus のテキスト形式で公開する。外部ライブラリには依存しない。
+
+    with metrics.timer("refuse_ai_storage_seconds", op="save_progress"):
+        ...
+    metrics.inc("refuse_ai_llm_input_tokens_total", 1234, mode="総合実践")
+
+出力方法は2つ (どちらも任意):
+- start_http_server(port): 127.0.0.1:port/metrics で公開する (Prometheus から収集)
+- start_file_export(path):  一定間隔でファイルを丸ごと書き換える (node_exporter の textfile collector 向け)
+"""
+import http.server
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# 秒単位のヒストグラムの境界値
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# トークン数のヒストグラムの境界値
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class Registry:
+    """ヒストグラムとカウンターをラベルの組ごとに保持する"""
+
+    def __init__(self):
+        self._histograms = {}  # 名前 -> (境界値, {ラベル: [各境界のカウント, 合計, 件数]})
+        self._counters = {}    # 名前 -> {ラベル: 値}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        """ヒストグラムに1件の観測値を追加する"""
+        key = _label_key(labels)
+        with self._lock:
+            bounds, series = self._histograms.setdefault(name, (tuple(buckets), {}))
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [[0] * len(bounds), 0.0, 0]
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def inc(self, name, value=1, **labels):
+        """カウンターを加算する"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def render(self):
+        """Prometheus のテキスト形式で、すべての値を出力する"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, (bounds, series) in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, (counts, total, count) in series.items():
+                    for bound, bucket_count in zip(bounds, counts):
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', repr(float(bound)))])} {bucket_count}")
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                    lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    REGISTRY.observe(name, value, buckets=buckets, **labels)
+
+
+def inc(name, value=1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+def render():
+    return REGISTRY.render()
+
+
+@contextmanager
+def timer(name, **labels):
+    """with ブロックの所要時間 (秒) をヒストグラムに記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+class InstrumentedProxy:
+    """対象オブジェクトの公開メソッドの呼び出しごとに、所要時間を op ラベル付きで記録する"""
+
+    def __init__(self, target, metric_name, **labels):
+        self._target = target
+        self._metric_name = metric_name
+        self._labels = labels
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            with timer(self._metric_name, op=name, **self._labels):
+                return attribute(*args, **kwargs)
+        return timed
+
+
+# --- 出力 ---
+_export_lock = threading.Lock()
+_http_server = None
+_file_exporter = None
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # アクセスログは出力しない
+        pass
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """/metrics を公開するHTTPサーバーをバックグラウンドで起動する (プロセス内で1回だけ)"""
+    global _http_server
+    with _export_lock:
+        if _http_server is None:
+            _http_server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_http_server.serve_forever, name="metrics-http", daemon=True).start()
+    return _http_server
+
+
+def write_textfile(path):
+    """現在の値をファイルに書き出す (一時ファイルに書いてから置き換える)
+
+    複数プロセスで動かす場合は、パスに {pid} を含めるとプロセスごとに別ファイルになる。
+    """
+    path = path.replace("{pid}", str(os.getpid()))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+def start_file_export(path, interval_seconds=15):
+    """一定間隔で write_textfile を行うスレッドを起動する (プロセス内で1回だけ)"""
+    global _file_exporter
+    with _export_lock:
+        if _file_exporter is None:
+            def loop():
+                while True:
+                    time.sleep(interval_seconds)
+                    try:
+                        write_textfile(path)
+                    except OSError:
+                        pass
+            _file_exporter = threading.Thread(target=loop, name="metrics-file", daemon=True)
+            _file_exporter.start()
+    return _file_exporter
@@ -0,0 +1,90 @@
+"""教員向けのクラス分析ページ
+
+要素ごとの合格率・総合実践の点数分布・学習時間を表示する。
+ユーザーごとのファイルは開かず、analytics.py のロールアップ索引だけを読む。
+閲覧には ANALYTICS_PASSWORD (環境変数または Streamlit Secrets) の入力が必要。
+"""
+import pandas as pd
+import streamlit as st
+
+import admin_pages
+
+ANALYTICS_CACHE_TTL_SECONDS = 60
+
+st.title("📊 クラス分析")
+
+
+@st.cache_data(ttl=ANALYTICS_CACHE_TTL_SECONDS)
+def load_rollups():
+    """索引から集計結果をまとめて読み込む (閲覧者が多くても1分に1回だけ集計する)"""
+    index = admin_pages.get_analytics_index()
+    return {
+        "summary": index.summary(),
+        "pass_rates": index.element_pass_rates(),
+        "attempts": index.element_attempts(),
+        "scores": index.score_distribution(),
+        "study_by_date": index.study_time_by_date(),
+        "study_by_user": index.study_time_by_user(),
+    }
+
+
+# --- 閲覧の制限 ---
+admin_pages.require_password()
+
+rollups = load_rollups()
+summary = rollups["summary"]
+
+col1, col2, col3, col4 = st.columns(4)
+col1.metric("ユーザー数", summary["users"])
+col2.metric("保存済みセッション", summary["sessions"])
+col3.metric("評価された回答", summary["evaluations"])
+col4.metric("学習時間の合計", f"{summary['study_seconds'] // 3600}時間{summary['study_seconds'] % 3600 // 60}分")
+st.caption(f"集計は最大{ANALYTICS_CACHE_TTL_SECONDS}秒ごとに更新されます。")
+
+# --- 要素ごとの合格率 ---
+st.subheader("要素ごとの合格率")
+if rollups["pass_rates"]:
+    pass_rates = pd.DataFrame(rollups["pass_rates"])
+    pass_rates["合格率 (%)"] = (pass_rates["passed_users"] / max(1, summary["users"]) * 100).round(1)
+    st.bar_chart(pass_rates.set_index("element")["合格率 (%)"])
+    st.dataframe(
+        pass_rates.rename(columns={"element": "要素", "passed_users": "合格済みユーザー", "users": "進捗のあるユーザー"}),
+        hide_index=True
+    )
+else:
+    st.info("まだ進捗が記録されていません。")
+
+if rollups["attempts"]:
+    attempts = pd.DataFrame(rollups["attempts"])
+    attempts["回答あたりの合格率 (%)"] = (attempts["passed"] / attempts["attempts"] * 100).round(1)
+    st.caption("保存済みの練習での回答数 (自動チェックで不合格になった回答を含む)")
+    st.dataframe(
+        attempts.rename(columns={"element": "要素", "attempts": "回答数", "passed": "合格", "local": "自動チェック"}),
+        hide_index=True
+    )
+
+# --- 総合実践の点数分布 ---
+st.subheader("総合実践の点数分布")
+scores = rollups["scores"]
+if scores["totals"]:
+    distribution = pd.Series({total: scores["totals"].get(total, 0) for total in range(11)}, name="件数")
+    distribution.index.name = "合計点"
+    st.bar_chart(distribution)
+    st.caption(
+        f"平均: 表現面 {scores['average_expression']:.1f}/5点 ・ 内容面 {scores['average_content']:.1f}/5点 ・ "
+        f"合計 {scores['average_total']:.1f}/10点"
+    )
+else:
+    st.info("まだ総合実践の評価が保存されていません。")
+
+# --- 学習時間 ---
+st.subheader("学習時間")
+if rollups["study_by_date"]:
+    by_date = pd.DataFrame(rollups["study_by_date"])
+    by_date["学習時間 (分)"] = by_date["seconds"] // 60
+    st.line_chart(by_date.set_index("date")["学習時間 (分)"])
+    by_user = pd.DataFrame(rollups["study_by_user"])
+    by_user["学習時間 (分)"] = by_user["seconds"] // 60
+    st.dataframe(by_user[["user_id", "学習時間 (分)"]].rename(columns={"user_id": "ユーザーID"}), hide_index=True)
+else:
+    st.info("まだ学習時間が記録されていません。")
@@ -0,0 +1,86 @@
+"""管理者向けのLLM利用状況ページ
+
+ユーザーごと・日ごとのLLMの呼び出し回数とトークン数 (入力・キャッシュ・出力) と、
+上限 (quota.py) に達しているユーザーを表示する。分析ページと同じく analytics.py の索引だけを読む。
+閲覧には ANALYTICS_PASSWORD (環境変数または Streamlit Secrets) の入力が必要。
+"""
+import datetime
+
+import pandas as pd
+import streamlit as st
+
+import admin_pages
+import quota
+
+USAGE_CACHE_TTL_SECONDS = 60
+TOP_CONSUMERS = 50
+
+st.title("🔢 LLM利用状況")
+
+
+@st.cache_data(ttl=USAGE_CACHE_TTL_SECONDS)
+def load_usage(since_date):
+    index = admin_pages.get_analytics_index()
+    return {
+        "by_user": index.token_usage_by_user(since_date, TOP_CONSUMERS),
+        "by_date": index.token_usage_by_date(),
+    }
+
+
+# --- 閲覧の制限 ---
+admin_pages.require_password()
+
+policy = quota.load_policy()
+today = datetime.date.today()
+period_days = st.radio("集計期間", [1, 7, 30], format_func=lambda days: "今日" if days == 1 else f"直近{days}日", horizontal=True)
+since_date = (today - datetime.timedelta(days=period_days - 1)).isoformat()
+usage = load_usage(since_date)
+
+# --- 上限の設定 ---
+if policy.enabled:
+    def limit_text(value, unit):
+        return f"{value:,}{unit}" if value else "なし"
+
+    st.caption(
+        f"1日あたりの上限: ソフト {limit_text(policy.soft_tokens, 'トークン')} / {limit_text(policy.soft_requests, '回')} ・ "
+        f"ハード {limit_text(policy.hard_tokens, 'トークン')} / {limit_text(policy.hard_requests, '回')}"
+    )
+else:
+    st.caption("利用量の上限は設定されていません (DAILY_TOKEN_SOFT_LIMIT などで設定できます)。")
+st.caption(f"集計は最大{USAGE_CACHE_TTL_SECONDS}秒ごとに更新されます。")
+
+# --- 利用量の多いユーザー ---
+st.subheader("利用量の多いユーザー")
+if usage["by_user"]:
+    by_user = pd.DataFrame(usage["by_user"])
+    by_user["トークン (入力+出力)"] = by_user["input_tokens"] + by_user["output_tokens"]
+    if period_days == 1 and policy.enabled:
+        # 上限は1日ごとなので、今日の集計のときだけ各ユーザーの段階を表示する
+        levels = {"ok": "", "soft": "ソフト上限", "hard": "ハード上限"}
+        by_user["制限"] = [levels[policy.level(row)] for row in usage["by_user"]]
+    st.dataframe(
+        by_user.rename(columns={
+            "user_id": "ユーザーID", "requests": "呼び出し回数", "input_tokens": "入力",
+            "cached_tokens": "うちキャッシュ", "output_tokens": "出力",
+        }),
+        hide_index=True
+    )
+else:
+    st.info("この期間の利用量はまだ記録されていません。")
+
+# --- 日ごとの利用量 ---
+st.subheader("日ごとの利用量")
+if usage["by_date"]:
+    by_date = pd.DataFrame(usage["by_date"])
+    st.bar_chart(by_date.set_index("date")[["input_tokens", "output_tokens"]].rename(
+        columns={"input_tokens": "入力トークン", "output_tokens": "出力トークン"}
+    ))
+    st.dataframe(
+        by_date.rename(columns={
+            "date": "日付", "requests": "呼び出し回数", "input_tokens": "入力", "cached_tokens": "うちキャッシュ",
+            "output_tokens": "出力", "users": "利用したユーザー",
+        }),
+        hide_index=True
+    )
+else:
+    st.info("まだ利用量が記録されていません。")
@@ -0,0 +1,156 @@
+"""要素別トレーニングの回答をローカルで事前チェックする簡易アナライザー
+
+謝罪・感謝・理由・代替案・断りの意思の表現を、語句の辞書と正規表現で検出する。
+LLMの評価を待つ間の速報表示と、対象の要素がまったく含まれていない明らかな不合格の判定に使う。
+検出した語句の位置 (span) は、highlight_text が強調表示する _**...**_ のマークアップに使える。
+明らかな不合格の場合は、LLMの構造化出力と同じ形の評価結果 (evaluation.py) を返す。
+
+    result = prescreen.screen_answer("謝罪の言葉の有無と適切さ", "その日は無理です。")
+    result["clear_fail"]  # -> True (謝罪の言葉が見つからない)
+
+ここでの判定は語句の有無だけを見る目安であり、表現の適切さはLLMが評価する。
+"""
+import re
+
+import evaluation
+
+# --- 表現ごとの検出パターン ---
+APOLOGY_PATTERNS = [
+    r"ごめん", r"御免", r"すみません", r"すいません", r"済みません", r"すまん", r"すまない", r"申し訳",
+    r"恐縮", r"恐れ入", r"(?<!が)(悪|わる)い(ね|な|けど|んだけど|んですが)", r"心苦しい",
+]
+THANKS_PATTERNS = [
+    r"ありがと", r"ありがた", r"有り?難", r"感謝", r"嬉しい", r"うれしい", r"嬉しかった",
+    r"誘って(くれ|くださ|いただ)", r"声(を)?かけて(くれ|くださ|いただ)", r"お誘い",
+    r"楽しそう", r"行きたかった", r"参加したかった", r"気にかけて",
+]
+REASON_PATTERNS = [
+    r"予定", r"先約", r"用事", r"約束", r"バイト", r"仕事", r"シフト", r"授業", r"講義", r"ゼミ",
+    r"試験", r"テスト", r"課題", r"レポート", r"締め切り", r"締切", r"体調", r"風邪", r"家族", r"実家",
+    r"帰省", r"通院", r"病院", r"金欠", r"お金", r"忙しく", r"忙しい", r"都合",
+    r"(だ|です|ある|あります|いる|います|ない|ません|た|なので)から", r"ので", r"ため",
+]
+ALTERNATIVE_PATTERNS = [
+    r"また今度", r"今度", r"次回", r"次の機会", r"次は", r"またの機会", r"別の日", r"ほかの日", r"他の日",
+    r"来週", r"再来週", r"来月", r"週末", r"[0-9０-９]+日", r"[月火水木金土日]曜",
+    r"(なら|だったら)(行け|大丈夫|空いて|参加)", r"空いて(る|います|いる)", r"代わりに",
+    r"また誘って", r"また声", r"ぜひ(また|次)", r"改めて",
+]
+REFUSAL_PATTERNS = [
+    r"行けない", r"行けません", r"いけない", r"いけません", r"参加できない", r"参加できません",
+    r"無理", r"難しい", r"難しく", r"厳しい", r"遠慮", r"控え", r"見送", r"欠席", r"パス",
+    r"都合がつかな", r"都合が(つき|合い)ません", r"都合が合わな", r"行かない", r"行きません",
+    r"やめて?お(く|き|こう)", r"やめと(く|こう)",
+]
+AMBIGUOUS_PATTERNS = [
+    r"行けたら行く", r"考えて(おく|おきます|みる|みます)", r"たぶん", r"多分", r"かもしれない", r"かもしれません",
+    r"わからない", r"分からない", r"わかりません", r"分かりません", r"微妙", r"検討します", r"また連絡",
+]
+
+# --- 要素ごとのルール ---
+# キー: アプリが表示・保存に使う要素名 (training_elements のキーの最初の " (" より前の部分。short_name を参照)
+# label: 速報の文言に使う表現の名前
+# patterns: この要素の表現として検出する語句
+# fail_if_missing: 見つからない場合に、LLMに送らず不合格としてよいか
+#   (関係性に応じた適切さは語句の有無で判断できないため、常にLLMに評価させる)
+# fail_if_ambiguous: 曖昧な表現だけで断っている場合も不合格とするか
+ELEMENT_RULES = {
+    "相手との関係性に応じた適切さ": {"label": "断りの表現", "patterns": REFUSAL_PATTERNS, "fail_if_missing": False},
+    "謝罪の言葉の有無と適切さ": {"label": "謝罪の言葉", "patterns": APOLOGY_PATTERNS, "fail_if_missing": True},
+    "断りの意思の明確さ": {
+        "label": "断りの表現", "patterns": REFUSAL_PATTERNS, "fail_if_missing": True, "fail_if_ambiguous": True
+    },
+    "理由の提示の有無と適切さ": {"label": "理由", "patterns": REASON_PATTERNS, "fail_if_missing": True},
+    "代替案の提示の有無と適切さ": {"label": "代替案", "patterns": ALTERNATIVE_PATTERNS, "fail_if_missing": True},
+    "相手への配慮": {"label": "感謝や配慮の言葉", "patterns": THANKS_PATTERNS, "fail_if_missing": True},
+}
+
+IMPROVEMENT_HINTS = {
+    "謝罪の言葉": "「ごめんね」「申し訳ないのですが」など、断る前に一言謝罪を添えてみましょう。",
+    "断りの表現": "「今回は行けないんだ」「参加できません」のように、断る意思をはっきり言葉にしてみましょう。",
+    "理由": "「その日はバイトがあって」のように、参加できない理由を一言添えてみましょう。",
+    "代替案": "「来週なら空いてるよ」「また今度誘ってね」など、別の機会を提案してみましょう。",
+    "感謝や配慮の言葉": "「誘ってくれてありがとう」「楽しそうだね」など、誘い自体への感謝を伝えてみましょう。",
+}
+
+_compiled_patterns = {}
+
+
+def _compile(patterns):
+    key = tuple(patterns)
+    if key not in _compiled_patterns:
+        _compiled_patterns[key] = re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+    return _compiled_patterns[key]
+
+
+def find_phrases(text, patterns):
+    """patterns に一致した語句を、(開始位置, 終了位置, 語句) のリストで返す"""
+    return [(match.start(), match.end(), match.group(0)) for match in _compile(patterns).finditer(text)]
+
+
+def short_name(element_name):
+    """training_elements のキー (「相手への配慮 (感謝の言葉など) (1点)」など) を、アプリの表示名にそろえる"""
+    return element_name.split(" (")[0]
+
+
+def get_rule(element_name):
+    """要素名 (表示名・training_elements のキーのどちらでもよい) に対応するルールを返す。該当しない場合は None。"""
+    return ELEMENT_RULES.get(short_name(element_name))
+
+
+def screen_answer(element_name, answer):
+    """回答を事前チェックした結果を返す。要素別トレーニング以外 (総合実践など) では None を返す。
+
+    戻り値の辞書:
+        label       検出対象の表現の名前
+        matches     検出した語句 ((開始位置, 終了位置, 語句) のリスト)
+        span        強調表示する範囲 (最初に検出した語句)。見つからない場合は None
+        clear_fail  対象の表現がまったく含まれず、明らかに不合格の場合は True
+        ambiguous   曖昧な表現 (「行けたら行く」など) を含むか
+    """
+    rule = get_rule(element_name)
+    if rule is None:
+        return None
+    matches = find_phrases(answer, rule["patterns"])
+    ambiguous = find_phrases(answer, AMBIGUOUS_PATTERNS)
+    span = matches[0][:2] if matches else None
+    if not matches and ambiguous and rule.get("fail_if_ambiguous"):
+        # 曖昧な表現だけで断っている場合は、その表現を強調する
+        span = ambiguous[0][:2]
+    return {
+        "label": rule["label"],
+        "matches": matches,
+        "span": span,
+        "clear_fail": rule["fail_if_missing"] and not matches,
+        "ambiguous": bool(ambiguous),
+    }
+
+
+def format_provisional_note(result):
+    """LLMの評価を待つ間に表示する速報の1行"""
+    if result["matches"]:
+        phrases = "」「".join(dict.fromkeys(phrase for _, _, phrase in result["matches"]))
+        return f"⚡ 速報: {result['label']}（「{phrases}」）が見つかりました。AIが適切さを評価しています…"
+    return f"⚡ 速報: {result['label']}が見つかりませんでした。AIの評価を待っています…"
+
+
+def build_local_evaluation(result, element_name, answer):
+    """明らかな不合格の場合に、LLMの代わりに返す評価結果 (evaluation.py の形式)"""
+    label = result["label"]
+    highlight = answer[result["span"][0]:result["span"][1]] if result["span"] else ""
+    if highlight:
+        comment = f"「{highlight}」という表現は曖昧で、断りの意思が相手に伝わりにくいです。"
+    else:
+        comment = f"回答に{label}が含まれていないため、この要素の基準を満たしていません。"
+    return {
+        "kind": "element",
+        "element": short_name(element_name),
+        "verdict": "不合格",
+        "scores": None,
+        "highlight": highlight,
+        "reply": "",
+        "feedback": [comment],
+        "improvements": [IMPROVEMENT_HINTS[label]],
+        "source": "local",
+    }
+
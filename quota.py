@@ -0,0 +1,73 @@
+"""ユーザーごとのLLM利用量の計測と上限 (クォータ)
+
+1つのAPIキーをクラス全体で共有するため、ユーザーごと・日ごとにLLMの呼び出し回数とトークン数を数え、
+設定した上限に応じて利用を段階的に制限する。トークン数は応答の usage_metadata (llm_client.get_token_usage) から取る。
+
+利用量の辞書:
+    requests        LLMの呼び出し回数
+    input_tokens    入力トークン数 (キャッシュから読んだ分を含む)
+    cached_tokens   入力トークンのうちコンテキストキャッシュから読んだ分
+    output_tokens   出力トークン数
+
+上限の段階:
+    "ok"    制限なし
+    "soft"  ソフト上限を超えた: 評価を簡潔な形式にし、相手役の返答を別リクエストで生成しない
+    "hard"  ハード上限を超えた: その日はLLMを呼ぶ操作 (回答の送信・新しい練習の開始) を受け付けない
+
+上限は0で無効。トークン数の上限は入力と出力の合計 (billable_tokens) に対して判定する。
+判定はターンを始める前に行うため、最後の1ターンの分だけ上限を超えることがある。
+"""
+from settings import get_setting
+from storage import TOKEN_USAGE_COUNTERS as COUNTERS
+
+LEVELS = ("ok", "soft", "hard")
+
+
+def empty_usage():
+    return dict.fromkeys(COUNTERS, 0)
+
+
+def billable_tokens(usage):
+    """上限の判定に使うトークン数 (入力 + 出力)"""
+    return usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+
+
+class QuotaPolicy:
+    """1日あたりのソフト上限・ハード上限 (トークン数と呼び出し回数)"""
+
+    def __init__(self, soft_tokens=0, hard_tokens=0, soft_requests=0, hard_requests=0):
+        self.soft_tokens = soft_tokens
+        self.hard_tokens = hard_tokens
+        self.soft_requests = soft_requests
+        self.hard_requests = hard_requests
+
+    @property
+    def enabled(self):
+        return any((self.soft_tokens, self.hard_tokens, self.soft_requests, self.hard_requests))
+
+    def level(self, usage):
+        """その日の利用量から、制限の段階 ("ok" / "soft" / "hard") を返す"""
+        tokens, requests = billable_tokens(usage), usage.get("requests", 0)
+        if _over(tokens, self.hard_tokens) or _over(requests, self.hard_requests):
+            return "hard"
+        if _over(tokens, self.soft_tokens) or _over(requests, self.soft_requests):
+            return "soft"
+        return "ok"
+
+
+def _over(value, limit):
+    return bool(limit) and value >= limit
+
+
+def load_policy():
+    """設定 (環境変数または Streamlit Secrets) から上限を読み込む
+
+    DAILY_TOKEN_SOFT_LIMIT / DAILY_TOKEN_HARD_LIMIT       1日あたりのトークン数 (入力 + 出力)
+    DAILY_REQUEST_SOFT_LIMIT / DAILY_REQUEST_HARD_LIMIT   1日あたりのLLMの呼び出し回数
+    """
+    return QuotaPolicy(
+        soft_tokens=int(get_setting("DAILY_TOKEN_SOFT_LIMIT", 0)),
+        hard_tokens=int(get_setting("DAILY_TOKEN_HARD_LIMIT", 0)),
+        soft_requests=int(get_setting("DAILY_REQUEST_SOFT_LIMIT", 0)),
+        hard_requests=int(get_setting("DAILY_REQUEST_HARD_LIMIT", 0)),
+    )
@@ -1,156 +1,343 @@
 import streamlit as st
-import google.generativeai as genai
+from streamlit.errors import StreamlitAPIException
 import os
 import time
-import json
 import uuid
-import re
-import base64 
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import analytics
+import llm_client
+import evaluation
+import feedback_cache
+import metrics
+import prescreen
+import prompts
+import quota
+import scenario_pool
+import storage
+import study_time
+from settings import get_setting, get_flag
+
+logger = logging.getLogger(__name__)
+
+# スクリプト1回の実行 (再実行) にかかった時間の計測開始
+SCRIPT_RUN_STARTED = time.perf_counter()
 
 # --- 1. APIキーの設定 ---
-if "GOOGLE_API_KEY" in st.secrets:
-    genai.configure(api_key=st.secrets["GOOGLE_API_KEY"])
-else:
+# LLM_BACKEND=fake の場合は、APIを呼ばないオフラインの疑似バックエンドを使う (負荷試験・開発用)
+USE_FAKE_LLM = os.environ.get("LLM_BACKEND") == "fake"
+if not USE_FAKE_LLM and not get_setting("GOOGLE_API_KEY"):
     st.error("GOOGLE_API_KEY が設定されていません。Streamlit Secretsまたは環境変数を確認してください。")
     st.stop()
 
-# --- ログファイルのディレクトリ設定 ---
-LOGS_DIR = "user_data" 
+@st.cache_resource
+def get_genai():
+    """LLMのSDKを初めて使うときに読み込み、設定済みのモジュールをプロセス全体で共有する
 
-def get_user_files(user_id):
-    """ユーザーIDに基づいてチャットログと進捗ログのパスを生成"""
-    if not os.path.exists(LOGS_DIR):
-        os.makedirs(LOGS_DIR, exist_ok=True)
-    return {
-        "chat": os.path.join(LOGS_DIR, f"chat_logs_{user_id}.json"),
-        "progress": os.path.join(LOGS_DIR, f"element_progress_{user_id}.json"),
-        "study_log": os.path.join(LOGS_DIR, f"study_logs_{user_id}.json")
-    }
+    google.generativeai の読み込みには時間がかかるため、ログイン画面の表示や再実行のたびには行わない。
+    """
+    if USE_FAKE_LLM:
+        import fake_genai as genai
+        return genai
+    import google.generativeai as genai
+    genai.configure(api_key=get_setting("GOOGLE_API_KEY"))
+    return genai
+
+# --- データ保存先の設定 ---
+# STORAGE_BACKEND: "json" (既定, user_data/ 以下のファイル) または "sqlite" (WALモードの単一DB)
+# STORAGE_PATH:    保存先のディレクトリ (json) またはDBファイル (sqlite)。省略時は user_data/ 以下
+@st.cache_resource
+def get_storage():
+    """プロセス全体で共有するストレージを生成する (操作ごとの所要時間を計測する)"""
+    backend = get_setting("STORAGE_BACKEND", "json")
+    return metrics.InstrumentedProxy(
+        storage.create_storage(backend, get_setting("STORAGE_PATH")),
+        "refuse_ai_storage_seconds",
+        backend=backend
+    )
+
+
+# --- クラス分析用の索引 ---
+# 保存のたびに該当ユーザーの集計行だけを更新する (分析ページはこの索引だけを読む)
+# ANALYTICS_INDEX_PATH: 索引ファイル。省略時は保存先と同じディレクトリの analytics.db
+@st.cache_resource
+def get_analytics_index():
+    return metrics.InstrumentedProxy(analytics.AnalyticsIndex(analytics.configured_index_path()), "refuse_ai_analytics_seconds")
+
+def update_analytics(method_name, *args):
+    """索引を更新する。失敗しても保存自体は完了しているため、記録だけして続行する (rebuild で復旧できる)"""
+    try:
+        getattr(get_analytics_index(), method_name)(*args)
+    except Exception:
+        logger.exception("分析用索引の更新に失敗しました (%s)", method_name)
 
-# --- 進捗のロード/セーブ関数 (既存) ---
-def load_element_progress(training_elements, user_id):
-    """進捗ファイルを読み込む。ない場合や破損時は初期状態を返す。"""
-    file_path = get_user_files(user_id)["progress"]
-    initial_status = {key: False for key in training_elements.keys()}
-    if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
-            try:
-                loaded_status = json.load(f)
-                initial_status.update(loaded_status)
-            except json.JSONDecodeError:
-                pass
-    return initial_status
 
-def save_element_progress(status, user_id):
-    """進捗をファイルに保存する。"""
-    file_path = get_user_files(user_id)["progress"]
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(status, f, ensure_ascii=False, indent=4)
+# --- 計測値の出力設定 ---
+# METRICS_PORT: 指定すると 127.0.0.1:METRICS_PORT/metrics で Prometheus 形式の計測値を公開する
+# METRICS_FILE: 指定すると一定間隔でこのファイルに計測値を書き出す ({pid} でプロセスごとに分けられる)
+@st.cache_resource
+def start_metrics_export():
+    port = get_setting("METRICS_PORT")
+    if port:
+        metrics.start_http_server(int(port))
+    file_path = get_setting("METRICS_FILE")
+    if file_path:
+        metrics.start_file_export(file_path, int(get_setting("METRICS_FILE_INTERVAL", 15)))
 
+start_metrics_export()
 
-# --- 学習時間記録関数 (既存) ---
-def save_study_session(user_id, start_time, end_time):
-    """セッションの開始と終了時刻から学習時間を計算し、ログに追記する"""
-    if not start_time or not end_time:
-        return
+def get_metric_labels(mode_key):
+    """計測値に付けるラベル (練習モードと要素名)"""
+    if not mode_key or mode_key == "総合実践":
+        return {"mode": "総合実践", "element": ""}
+    return {"mode": "要素別", "element": mode_key}
 
-    duration = int(end_time - start_time)
-    date_key = time.strftime("%Y-%m-%d", time.localtime(start_time))
-    
-    file_path = get_user_files(user_id)["study_log"]
-    logs = {}
-    
-    # 既存のログを読み込む
-    if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
-            try:
-                logs = json.load(f)
-            except json.JSONDecodeError:
-                logs = {}
-
-    if date_key not in logs:
-        logs[date_key] = 0
-    
-    # 当日の合計学習時間に加算
-    logs[date_key] += duration
 
-    # ログを書き戻す
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(logs, f, ensure_ascii=False, indent=4)
+# --- 進捗のロード/セーブ関数 (既存) ---
+def load_element_progress(training_elements, user_id):
+    """保存済みの進捗を読み込む。ない場合や破損時は初期状態を返す。"""
+    initial_status = {key: False for key in training_elements.keys()}
+    initial_status.update(get_storage().load_progress(user_id))
+    return initial_status
 
-# --- 学習時間表示関数 (既存) ---
+def save_element_progress(status, user_id):
+    """進捗を保存する。"""
+    get_storage().save_progress(user_id, status)
+    update_analytics("record_progress", user_id, status)
+
+
+# --- 学習時間記録関数 ---
+# 再実行 (操作) のたびにハートビートを記録し、操作の間隔 (STUDY_IDLE_CAP_SECONDS で打ち切り) を学習時間に加算する。
+# 加算した秒数はメモリにためておき、一定間隔またはしきい値に達したときにまとめて保存する。
+@st.cache_resource
+def get_study_time_tracker():
+    """プロセス全体で共有する学習時間の集計器 (書き出しはバックグラウンドのスレッドで行う)"""
+    store = get_storage()
+    index = get_analytics_index()
+
+    def save_study_time(user_id, date_key, seconds):
+        store.add_study_time(user_id, date_key, seconds)
+        try:
+            index.add_study_time(user_id, date_key, seconds)
+        except Exception:
+            logger.exception("分析用索引の更新に失敗しました (add_study_time)")
+
+    return study_time.StudyTimeTracker(
+        save_study_time,
+        idle_cap_seconds=int(get_setting("STUDY_IDLE_CAP_SECONDS", study_time.DEFAULT_IDLE_CAP_SECONDS)),
+        flush_interval_seconds=int(get_setting("STUDY_FLUSH_INTERVAL_SECONDS", study_time.DEFAULT_FLUSH_INTERVAL_SECONDS))
+    )
+
+# --- 学習時間表示関数 ---
 def load_today_study_time(user_id):
     """当日の合計学習時間（秒）をロードし、分単位で返す"""
-    file_path = get_user_files(user_id)["study_log"]
-    today_key = time.strftime("%Y-%m-%d")
-    
-    if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
-            try:
-                logs = json.load(f)
-                total_seconds = logs.get(today_key, 0)
-                # 現在のセッションの経過時間を追加
-                if st.session_state.get('session_start_time'):
-                    current_duration = time.time() - st.session_state.session_start_time
-                    total_seconds += current_duration
-                    
-                return int(total_seconds // 60) # 分単位で返す
-            except json.JSONDecodeError:
-                return 0
-    return 0
+    date_key = time.strftime("%Y-%m-%d")
+    total_seconds = get_storage().load_study_time(user_id, date_key)
+    # まだ保存していない分を追加
+    total_seconds += get_study_time_tracker().pending_seconds(user_id, date_key)
+    return int(total_seconds // 60) # 分単位で返す
 
 
 # --- 履歴管理関数 (既存) ---
 def save_chat_history(history, user_id):
-    file_path = get_user_files(user_id)["chat"]
-    if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
-            try:
-                logs = json.load(f)
-            except json.JSONDecodeError:
-                logs = []
-    else:
-        logs = []
-    session_data = {
+    session = {
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
         "session_id": str(uuid.uuid4()),
         "history": history
     }
-    logs.append(session_data)
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(logs, f, ensure_ascii=False, indent=4)
-    st.success("現在の会話履歴を保存しました！")
-
-def load_all_chat_histories(user_id):
-    file_path = get_user_files(user_id)["chat"]
-    if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
-            try:
-                logs = json.load(f)
-                return logs
-            except json.JSONDecodeError:
-                return []
-    return []
+    get_storage().append_chat_session(user_id, session)
+    update_analytics("record_chat_session", user_id, session)
+    st.toast("現在の会話履歴を保存しました！", icon="✅")
+
+def load_chat_history_page(user_id, page, page_size):
+    """指定ページ分のセッションヘッダー（本文なし）と総数を返す"""
+    return get_storage().list_chat_headers(user_id, page * page_size, page_size)
+
+def load_chat_history(session_id, user_id):
+    """1セッション分の会話本文を読み込む"""
+    return get_storage().load_chat_session(user_id, session_id)
 
 def delete_chat_history(session_id_to_delete, user_id):
-    file_path = get_user_files(user_id)["chat"]
-    logs = load_all_chat_histories(user_id)
-    updated_logs = [log for log in logs if log["session_id"] != session_id_to_delete]
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(updated_logs, f, ensure_ascii=False, indent=4)
-    st.success("履歴を削除しました！")
+    get_storage().delete_chat_session(user_id, session_id_to_delete)
+    update_analytics("remove_chat_session", session_id_to_delete)
+    st.toast("履歴を削除しました！", icon="🗑️")
+
+
+# --- 練習中の会話の保存 (ライブセッション) ---
+# 練習の状態はJSONに変換できる値だけでセッションステートに持ち、やり取りのたびに保存先へ書き出す。
+# サーバーの再起動や別のワーカーへの振り分けがあっても、ログイン時にここから練習を再開できる。
+# ChatSession は保存せず、会話の文脈 (chat_context) から必要なときに組み立て直す。
+LIVE_SESSION_KEYS = (
+    "chat_history", "chat_context", "folded_turns", "initial_prompt_sent", "current_scenario",
+    "selected_element_display", "selected_element_for_practice", "practice_mode_select"
+)
 
+def save_live_session(user_id):
+    get_storage().save_live_session(user_id, {key: st.session_state.get(key) for key in LIVE_SESSION_KEYS})
 
-# --- テキストの強調表示処理関数 (既存) ---
-def highlight_text(text):
-    """AIが出力する太字斜体下線マークアップ（_**...**_）を赤色に変換する"""
-    highlighted = text.replace("_**", '<span style="color:red; font-weight:bold; text-decoration: underline;">')
-    highlighted = highlighted.replace("**_**", '</span>')
-    return highlighted
+def restore_live_session(user_id):
+    """保存中の練習があればセッションステートに戻す"""
+    state = get_storage().load_live_session(user_id) or {}
+    for key in LIVE_SESSION_KEYS:
+        if state.get(key) is not None:
+            st.session_state[key] = state[key]
 
+def clear_live_session(user_id):
+    get_storage().delete_live_session(user_id)
 
-# --- 2. モデルの選択 (既存) ---
-model = genai.GenerativeModel('models/gemini-pro-latest')
+
+# --- テキストの強調表示処理関数 (既存) ---
+# 変換結果をプロセス内でキャッシュするため、evaluation モジュール側に置いている
+highlight_text = evaluation.highlight_text
+
+
+# --- 2. モデルの選択 ---
+MODEL_NAME = get_setting("MODEL_NAME", 'models/gemini-pro-latest')
+
+# 段階ごとのモデル (未設定の段階は MODEL_NAME を使う)。
+# 誘いと相手役の返答には速いモデルを、評価には強いモデルを割り当てられる。
+#   scenario:   最初の誘い (シナリオ) の生成           SCENARIO_MODEL_NAME
+#   reply:      評価と並行して生成する相手役の返答     REPLY_MODEL_NAME
+#   evaluation: 回答の評価                             EVALUATION_MODEL_NAME
+MODEL_STAGES = ("scenario", "reply", "evaluation")
+MODEL_ROUTING = {stage: get_setting(f"{stage.upper()}_MODEL_NAME", MODEL_NAME) for stage in MODEL_STAGES}
+
+# システムプロンプトをコンテキストキャッシュに載せるか (APIやモデルが未対応の場合は通常のモデルで動作する)
+USE_CONTEXT_CACHE = get_flag("USE_CONTEXT_CACHE", True)
+CONTEXT_CACHE_TTL_SECONDS = 60 * 60
+
+# LLM呼び出しの上限 (プロセス全体)。APIキーのクォータに合わせて設定する
+LLM_MAX_CONCURRENT = int(get_setting("LLM_MAX_CONCURRENT", llm_client.DEFAULT_MAX_CONCURRENT))
+LLM_REQUESTS_PER_MINUTE = int(get_setting("LLM_REQUESTS_PER_MINUTE", llm_client.DEFAULT_REQUESTS_PER_MINUTE))
+llm_client.configure(LLM_MAX_CONCURRENT, LLM_REQUESTS_PER_MINUTE)
+
+# 混雑・障害で応答が得られなかったときに表示するメッセージ
+LLM_UNAVAILABLE_MESSAGE = "⚠️ 現在AIが混み合っているため、応答を取得できませんでした。少し時間をおいてから、もう一度お試しください。"
+
+# 応答をストリーミングで逐次表示するか (False の場合は従来どおりスピナー表示で全文を待つ)
+STREAM_RESPONSES = True
+
+# 評価を含む応答を構造化出力 (JSONスキーマ) で受け取るか。
+# 受け取った合否・点数は型付きのフィールドとして保存し、表示用のマークダウンはそこから組み立てる。
+STRUCTURED_EVALUATION = get_flag("STRUCTURED_EVALUATION", True)
+
+# 構造化された評価を使う場合、相手役の返答 (reply) を評価とは別のリクエストで並行して生成する。
+# 返答は速いモデルですぐに表示し、評価 (フィードバック) はその下に届きしだい表示する。
+PARALLEL_REPLY = get_flag("PARALLEL_REPLY", True)
+
+
+# --- ストリーミング応答のヘルパー関数 ---
+def send_message_streaming(chat, content, labels=None, **kwargs):
+    """応答をチャンクごとにチャット欄へ書き出し、最終的な全文と応答オブジェクトを返す (st.chat_message の中で呼ぶ)"""
+    response = llm_client.send_message(chat, content, stream=True, labels=labels, **kwargs)
+    placeholder = st.empty()
+    text = ""
+    for chunk in response:
+        try:
+            text += chunk.text
+        except ValueError:
+            # テキストを含まないチャンク（安全フィルタ等）は読み飛ばす
+            continue
+        placeholder.markdown(text + "▌")
+    placeholder.markdown(highlight_text(text), unsafe_allow_html=True)
+    return text, response
+
+
+# --- 回答の事前チェック (要素別トレーニング) ---
+# 対象の要素の表現がまったく含まれない明らかな不合格は、PRESCREEN_SKIP_LLM を有効にした場合だけ、
+# LLMに送らずローカルのフィードバックを返す (語句の辞書は言い回しを網羅できないため、既定ではLLMに評価させる)
+PRESCREEN_SKIP_LLM = get_flag("PRESCREEN_SKIP_LLM", False)
+
+def record_local_turn(chat, user_text, model_text):
+    """LLMを呼ばずに返したやり取りを会話履歴に追加し、以降のターンの文脈を揃える"""
+    chat.history = history_to_dicts(chat.history) + [
+        {"role": "user", "parts": [user_text]},
+        {"role": "model", "parts": [model_text]}
+    ]
+
+
+# --- よく似た回答への評価の再利用 (要素別トレーニング) ---
+# 既定では無効。FEEDBACK_CACHE=1 で有効にすると、同じ要素・シナリオでほぼ同じ回答には
+# 過去のLLMの評価を返し、APIを呼ばない (構造化された評価を使う場合のみ)
+USE_FEEDBACK_CACHE = get_flag("FEEDBACK_CACHE", False)
+
+@st.cache_resource
+def get_feedback_cache():
+    """プロセス全体で共有する評価のキャッシュ"""
+    return feedback_cache.FeedbackCache(
+        max_entries=int(get_setting("FEEDBACK_CACHE_SIZE", feedback_cache.DEFAULT_MAX_ENTRIES)),
+        ttl_seconds=int(get_setting("FEEDBACK_CACHE_TTL_SECONDS", feedback_cache.DEFAULT_TTL_SECONDS)),
+        threshold=float(get_setting("FEEDBACK_CACHE_THRESHOLD", feedback_cache.DEFAULT_THRESHOLD))
+    )
+
+def feedback_cache_scenario():
+    """評価のキャッシュを分ける場面: 入力されたシナリオ、未入力ならAIが生成した最初の誘いの本文
+
+    シナリオ未入力の練習はすべて current_scenario が空文字列になるため、それをキーにすると
+    別々の誘いへの回答が同じ評価を共有してしまう。誘いの本文がない場合は None (キャッシュを使わない)。
+    """
+    if st.session_state.current_scenario:
+        return st.session_state.current_scenario
+    context = st.session_state.chat_context
+    return "".join(context[1]["parts"]) if len(context) > 1 else None
+
+def feedback_cache_enabled(mode_key):
+    return (
+        USE_FEEDBACK_CACHE and STRUCTURED_EVALUATION and mode_key != "総合実践"
+        and feedback_cache_scenario() is not None
+    )
+
+def lookup_cached_feedback(mode_key, answer, labels):
+    """よく似た回答の評価があれば、この回答向けに調整したコピーを返す"""
+    cached, score = get_feedback_cache().lookup(mode_key, feedback_cache_scenario(), answer)
+    metrics.inc("refuse_ai_feedback_cache_total", result="hit" if cached else "miss", **labels)
+    if cached is None:
+        return None
+    logger.info("類似の回答の評価を再利用しました (%s, 類似度 %.2f)", mode_key, score)
+    cached["source"] = "cache"
+    # 誘った相手としての返答はシナリオの細部に依存するため再利用しない
+    cached["reply"] = ""
+    return cached
+
+
+# --- トークン使用量の記録 (取得は llm_client.get_token_usage) ---
+def log_token_usage(mode_key, usage):
+    logger.info(
+        "token usage mode=%s input=%d cached=%d output=%d",
+        mode_key, usage["input_tokens"], usage["cached_tokens"], usage["output_tokens"]
+    )
+
+
+# --- LLMの利用量の記録と上限 (ユーザーごと・1日ごと) ---
+# 利用量は常に記録する。上限は DAILY_TOKEN_SOFT_LIMIT などで設定する (quota.load_policy を参照。未設定なら制限しない)
+QUOTA_POLICY = quota.load_policy()
+QUOTA_MESSAGES = {
+    "soft": "ℹ️ 本日のAIの利用量が多くなっているため、フィードバックを簡潔な形式でお返しします。",
+    "hard": "⚠️ 本日のAIの利用上限に達しました。練習の続きは明日またお試しください。",
+}
+# ソフト上限を超えたユーザーの評価の出力トークン数の上限 (構造化出力を使わない場合)。
+# 構造化出力では途中で切れるとJSONとして解析できなくなるため、スキーマを絞って短くする (evaluation.generation_config)
+BRIEF_MAX_OUTPUT_TOKENS = int(get_setting("BRIEF_MAX_OUTPUT_TOKENS", 600))
+
+def load_today_token_usage(user_id):
+    return get_storage().load_token_usage(user_id, time.strftime("%Y-%m-%d"))
+
+def get_quota_level(user_id):
+    """当日の利用量に応じた制限の段階 ("ok" / "soft" / "hard")"""
+    if not QUOTA_POLICY.enabled:
+        return "ok"
+    return QUOTA_POLICY.level(load_today_token_usage(user_id))
+
+def record_token_usage(user_id, usage, requests):
+    """LLMの呼び出し回数とトークン数を、このユーザーの当日の利用量に加算する"""
+    if not requests:
+        return
+    date_key = time.strftime("%Y-%m-%d")
+    counters = {"requests": requests, **usage}
+    get_storage().add_token_usage(user_id, date_key, counters)
+    update_analytics("add_token_usage", user_id, date_key, counters)
 
 
 # --- スクロール機能のヘルパー関数 (既存) ---
@@ -183,13 +370,9 @@ def scroll_to_element(element_id):
 # --- ログアウト関数 (既存) ---
 def logout_user():
     """セッション情報をクリアし、強制的にアプリを初期状態に戻す"""
-    # 学習時間記録: ログアウト（終了）時間を記録
+    # 学習時間記録: ためている学習時間をすぐに保存する
     if st.session_state.get('user_id'):
-        save_study_session(
-            st.session_state.user_id,
-            st.session_state.get('session_start_time'),
-            time.time()
-        )
+        get_study_time_tracker().end_session(st.session_state.user_id)
     
     # ユーザーIDをクリア
     if "user_id" in st.session_state:
@@ -198,12 +381,12 @@ def logout_user():
         del st.session_state["user_id_key"] # 入力フィールドの内容もクリア
     
     # その他のセッションデータもクリア
-    keys_to_delete = ["user_id", "user_id_key", "chat_history", "genai_chat", "initial_prompt_sent", 
+    keys_to_delete = ["user_id", "user_id_key", "chat_history", "chat_context", "initial_prompt_sent", 
                       "current_scenario", "selected_element_display", 
                       "new_session_flag", "element_status", 
                       "scroll_to_top_flag", "practice_mode_select",
-                      "training_element_select_display", "session_start_time",
-                      "selected_element_for_practice"] 
+                      "training_element_select_display",
+                      "selected_element_for_practice", "folded_turns"] 
     for key in keys_to_delete:
         if key in st.session_state:
             del st.session_state[key]
@@ -269,127 +452,149 @@ user_id = user_id_input
 
 
 # --- 練習要素の定義 (要素別トレーニング用: 6要素) ---
-training_elements = {
-    "相手との関係性に応じた適切さ (1点)": "表現面：相手との関係性に応じた適切な言葉遣い、敬語、直接的な断り表現を避けているか。",
-    "謝罪の言葉の有無と適切さ (1点)": "表現面：謝罪の言葉が適切に使われているか。",
-    "断りの意思の明確さ (1点)": "内容面：曖昧さがなく、断りの意思がはっきりと伝わるか。",
-    "理由の提示の有無と適切さ (1点)": "内容面：納得できる理由か、具体性があるか。",
-    "代替案の提示の有無と適切さ (1点)": "内容面：別の機会や方法を提案しているか。",
-    "相手への配慮 (感謝の言葉など) (1点)": "内容面：相手の誘い自体を否定せず、感謝の言葉があるか。",
-}
-
-# --- 6. システムプロンプトの設定 (テンプレート) ---
-
-# --- 総合実践モード用の詳細なプロンプトテンプレート ---
-SYSTEM_PROMPT_FULL_TEMPLATE = f"""
-あなたはユーザーが誘いを断る練習をするためのロールプレイング相手です。
-
-**【AIの役割と設定】**
-あなたの役割は、**大学1年生から新卒1年目（社会人経験が浅い層）**のユーザーに対して、**大学生活、サークル、アルバイト、または初めての職場**で起こり得る具体的な誘いのシナリオを提供することです。
-
---- シナリオ開始 ---
-**最初の応答では、以下の指示にのみ従ってください。ユーザーに何か誘いをかけてください。この応答に、ユーザーの断り方に対するフィードバックは絶対に含めないでください。**
-**ユーザーがシナリオを入力していない場合、**あなたはターゲット層に合ったランダムな誘い（サークル、バイト、新卒職場など）を自動で設定してください。**
-**必ず、最初に提示するシナリオのシチュエーションを詳細に記載し、**相手との関係性（サークルの先輩、バイトの同僚、大学の友人、新卒の教育担当など）**を明確にしてから、誘い文を続けてください。**
-
---- ユーザーの応答後 ---
-ユーザーがあなたの誘いを断った後の応答では、その断り方に応じて、納得して引き下がるか、あるいは少しだけ食い下がってください。
-
-ユーザーの断り方に対して、以下の「表現面」と「内容面」の観点から、その断り方が適切かどうかフィードバックしてください。改善点があれば、その点も具体的に指摘してください。
-
-**【評価に関する重要な追加指示】**
-**ユーザーからの断り方を評価する際、シチュエーションで設定された「相手との関係性の親密さ」を最重要視してください。**
-**特に親しい先輩や同僚に対しては、**過剰に固い敬語や遠回しな言い方はむしろ不自然とみなし、**丁寧さを保ちつつも親近感のある自然なフランクな表現（例：「ごめん、その日はちょっと無理なんだ」＋理由＋代替案）も高得点の対象としてください。**
-
-**【出力形式の厳守】**
-* **結論ファースト**: まず、以下の形式で「全体評価」と「点数内訳」を**# 見出し**として表示してください。その後に、詳細な評価に入ってください。
-* **簡潔な箇条書き**: 評価理由や改善提案は、**冗長な文章を避け、必ず箇条書き（ハイフン`-`を使用）**で簡潔に記述してください。説明は各項目につき1〜2行に収めてください。
-
-フィードバックをする際に必ず取り入れてほしい要素は以下の通りです。
-
-# 全体評価
-- 回答に対して点数をつける（10点満点）
-- 表現面、内容面をそれぞれ**5点満点**で評価し、その合計を全体の点数としてください。
-- 点数が**10点満点の場合にのみ合格**、9点以下の場合は不合格と表示してください。
-- **点数内訳**: 以下の形式で簡潔にまとめてください。
-  - **表現面**: X/5点 (理由の要約)
-  - **内容面**: Y/5点 (理由の要約)
-
-表現面（言葉遣い、態度、丁寧さなど）：以下の内容が含まれているかで判断（5点満点）
-- 相手との関係性に応じた適切さ: 1点
-- 謝罪の言葉の有無と適切さ：1点
-- 全体的な丁寧さ、配慮が感じられるか：1点
-- 文法的な正確さ、自然な言い回しか：2点
-
-内容面（断りの理由、代替案など）：以下の内容が含まれているかで判断（5点満点）
-- 断りの意思の明確さ: 1点
-- 理由の提示の有無と適切さ: 1点
-- 代替案の提示の有無と適切さ: 1点
-- 相手への配慮: 相手の誘い自体を否定せず、感謝の言葉があるか：1点
-- 内容の一貫性: 1点 
+# 要素の定義とシステムプロンプトは prompts.py にあり、プロセス内で一度だけ組み立てられる
+training_elements = prompts.TRAINING_ELEMENTS
 
-# 表現面（詳細）
-- **評価**: 表現面で加点・減点された点を、具体的な言葉遣いに言及しながら説明してください。
 
-# 内容面（詳細）
-- **評価**: 内容面で加点・減点された点を、理由や代替案の具体性に言及しながら説明してください。
+# --- モードごとのシステムプロンプトとモデル ---
+def get_system_prompt(mode_key):
+    """練習モード（"総合実践" または要素名）のシステムプロンプトを返す。該当しない場合は None。"""
+    return prompts.get_system_prompt(mode_key, STRUCTURED_EVALUATION)
 
-# 重み付けの考慮
-- 提示されたシチュエーションを考慮し、**どちらの面（表現面/内容面）が重要であったか**を結論づけてください。
+@st.cache_resource(ttl=CONTEXT_CACHE_TTL_SECONDS - 5 * 60)
+def get_mode_model(mode_key, stage="evaluation"):
+    """システムプロンプトを system_instruction に設定したモデルを、モード・段階ごとにプロセス全体で共有する
 
-# 改善提案
-- フィードバックの結果から、不足している要素を補うためにどんな練習をしたらよいかを具体的に提示してください。
-"""
-
-# --- 要素別トレーニング用プロンプト生成関数 ---
-def create_focused_prompt(element_key, element_description):
-    """選択された要素に特化したフィードバックプロンプトを生成する関数 (合否判定あり)"""
-    
-    score_info = element_description.split('(')[-1].replace(')', '')
-    
-    focused_prompt = f"""
-あなたはユーザーが特定の要素を練習するためのコーチです。
-あなたの役割は、ユーザーが断りの練習をする際、冷静にフィードバックを提供することです。
-
-**【AIの役割と設定】**
-あなたの役割は、**大学1年生から新卒1年目（社会人経験が浅い層）**のユーザーに対して、**大学生活、サークル、アルバイト、または初めての職場**で起こり得る具体的な誘いのシナリオを提供することです。
-
---- 練習目標 ---
-このモードの目的は、**特定のスキル習得に集中**することです。
-ユーザーの断り方を評価する際、**{element_key} (配点: {score_info})** の項目**のみ**を評価対象としてください。**他の項目、および総合点数や合否は一切無視し、絶対に点数を付けないでください。**
-
-**【評価に関する重要な追加指示】**
-**ユーザーからの断り方を評価する際、シチュエーションで設定された「相手との関係性の親密さ」を最重要視してください。**
-**特に親しい先輩や同僚に対しては、**過剰に固い敬語や遠回しな言い方はむしろ不自然とみなし、**丁寧さを保ちつつも親近感のある自然なフランクな表現（例：「ごめん、その日はちょっと無理なんだ」＋理由＋代替案）も高評価の対象としてください。**
-
---- シナリオ開始 ---
-最初の応答では、以下の指示にのみ従ってください。ユーザーに何か誘いをかけてください。この応答に、ユーザーの断り方に対するフィードバックは絶対に含めないでください。
-**ユーザーがシナリオを入力していない場合、**あなたはターゲット層に合ったランダムな誘い（サークル、バイト、新卒職場など）を自動で設定してください。**
-必ず、最初に提示するシナリオのシチュエーションを詳細に記載し、**相手との関係性（サークルの先輩、バイトの同僚、大学の友人、新卒の教育担当など）**を明確にしてから、誘い文を続けてください。
-
---- ユーザーの応答後 ---
-ユーザーがあなたの誘いを断った後の応答では、その断り方に応じて、納得して引き下がるか、あるいは少しだけ食い下がってください。
-
-ユーザーの断り方に対して、以下の【評価観点】に**厳密に**従ってフィードバックしてください。
-
-**【出力形式の厳守】**
-* **結論ファースト**: まず「評価」を太字の見出しで表示してください。
-* **簡潔な箇条書き**: 評価理由や改善提案は、**冗長な文章を避け、必ず箇条書き（ハイフン`-`を使用）**で簡潔に記述してください。説明は各項目につき1〜2行に収めてください。
-
-【評価観点】
-1. **評価**: **{element_key}** の観点から、具体的にどの言葉が良かったか/悪かったかを、ユーザーの感情に配慮しつつ**コーチング形式**で説明してください。
-2. **改善提案**: この**特定の要素**を補うために、どんな練習をしたらよいかを具体的に提示してください。
+    プロンプトは会話履歴に含まれなくなるため、以降のターンで毎回送り直されることがない。
+    可能であればコンテキストキャッシュも作成し、プロンプト分の入力トークンをキャッシュから読ませる。
+    モデルは段階 (MODEL_ROUTING) ごとに選び、相手役の返答には返答専用の短いプロンプトを使う。
+    """
+    model_name = MODEL_ROUTING[stage]
+    system_prompt = prompts.REPLY_SYSTEM_PROMPT if stage == "reply" else get_system_prompt(mode_key)
+    # 相手役のプロンプトは短く、コンテキストキャッシュの最小トークン数に満たないため使わない
+    if USE_CONTEXT_CACHE and stage != "reply":
+        try:
+            cached_content = get_genai().caching.CachedContent.create(
+                model=model_name,
+                display_name=f"refuse-ai-{mode_key}-{stage}",
+                system_instruction=system_prompt,
+                ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS)
+            )
+            return get_genai().GenerativeModel.from_cached_content(cached_content=cached_content)
+        except Exception as e:
+            # プロンプトがキャッシュの最小トークン数に満たない場合や、モデルが未対応の場合
+            logger.info("コンテキストキャッシュを使用しません (%s): %s", mode_key, e)
+    return get_genai().GenerativeModel(model_name, system_instruction=system_prompt)
+
+
+# --- 会話コンテキストの上限 ---
+# AIに送る会話履歴は「シナリオ指定と最初の誘い」と「直近 CONTEXT_KEEP_TURNS 回分の回答とフィードバック」に限り、
+# それより古いやり取りは回答と合否だけの短い要約1組にまとめる。画面に表示する chat_history はすべて残す。
+# 0 を指定すると要約せず、従来どおり全履歴を送る。
+CONTEXT_KEEP_TURNS = int(get_setting("CONTEXT_KEEP_TURNS", 3))
+CONTEXT_SUMMARY_ACK = "承知しました。これまでの練習内容を踏まえて、引き続きロールプレイングとフィードバックを行います。"
+
+def history_to_dicts(history):
+    """ChatSession.history (Content のリスト) を、start_chat に渡せる辞書のリストに変換する"""
+    return [{"role": content.role, "parts": [part.text for part in content.parts]} for content in history]
+
+def summarize_folded_turns(folded_turns):
+    """要約に折りたたんだやり取りを、AIに渡す短いメッセージにまとめる"""
+    lines = ["（これまでの練習の要約: 古いやり取りは省略しています）"]
+    for i, turn in enumerate(folded_turns, start=1):
+        verdict = f" → {turn['verdict']}" if turn["verdict"] else ""
+        lines.append(f"{i}. ユーザーの回答: 「{turn['answer']}」{verdict}")
+    return "\n".join(lines)
+
+def get_chat_session(mode_key):
+    """会話の文脈 (chat_context) から、このターンで使う ChatSession を組み立てる"""
+    return get_mode_model(mode_key).start_chat(history=st.session_state.chat_context)
+
+@st.cache_resource
+def get_evaluation_executor():
+    """評価のリクエストを相手役の返答と並行して送るためのスレッドプール (プロセス全体で共有)"""
+    return ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENT, thread_name_prefix="evaluation")
+
+def generate_reply(mode_key, answer, labels):
+    """相手役の返答を生成してチャット欄に表示し、(本文, 応答) を返す。得られなかった場合は (None, None)。
+
+    返答はユーザーが断った誘いへの反応なので、文脈にはシナリオの指定と最初の誘いだけを渡す。
+    """
+    reply_chat = get_mode_model(mode_key, "reply").start_chat(history=st.session_state.chat_context[:2])
+    labels = {**labels, "stage": "reply"}
+    try:
+        if STREAM_RESPONSES:
+            return send_message_streaming(reply_chat, answer, labels=labels)
+        response = llm_client.send_message(reply_chat, answer, labels=labels)
+    except llm_client.LLMUnavailableError:
+        # 返答がなくても評価は表示できるので、ここでは打ち切らない
+        logger.warning("相手役の返答を取得できませんでした (%s)", mode_key)
+        return None, None
+    st.markdown(response.text)
+    return response.text, response
+
+def compact_chat_context(chat, mode_key, folded_turns):
+    """直近のやり取りだけを残し、古いやり取りを要約に置き換えた ChatSession を返す
+
+    folded_turns は要約済みのやり取り（回答と合否）のリストで、この関数が追記する。
+    """
+    if CONTEXT_KEEP_TURNS <= 0:
+        return chat
+    history = history_to_dicts(chat.history)
+    head, body = history[:2], history[2:]
+    if folded_turns:
+        # 前回作成した要約の組は作り直すので取り除く
+        body = body[2:]
+    pairs = [body[i:i + 2] for i in range(0, len(body), 2)]
+    if len(pairs) <= CONTEXT_KEEP_TURNS:
+        return chat
+
+    for user_content, model_content in pairs[:-CONTEXT_KEEP_TURNS]:
+        verdict = evaluation.extract_verdict("".join(model_content["parts"]))
+        folded_turns.append({"answer": "".join(user_content["parts"]), "verdict": verdict})
+    summary = [
+        {"role": "user", "parts": [summarize_folded_turns(folded_turns)]},
+        {"role": "model", "parts": [CONTEXT_SUMMARY_ACK]}
+    ]
+    kept = [content for pair in pairs[-CONTEXT_KEEP_TURNS:] for content in pair]
+    return get_mode_model(mode_key).start_chat(history=head + summary + kept)
+
+
+# --- 最初の誘いの事前生成プール ---
+# シナリオ未入力で開始されたときに即座に渡せるよう、モードごとに誘いを生成して溜めておく
+SCENARIO_POOL_SIZE = 2               # モードごとの在庫数の上限
+SCENARIO_POOL_TTL_SECONDS = 30 * 60  # これより古い誘いは破棄する
+# 有効にすると、プロセスで最初のログイン時に全モードの誘いを生成しておく (モード数 × 在庫数 のLLM呼び出し)。
+# 無効 (既定) の場合は、モードごとにシナリオ未入力で最初に開始されたときから補充を始める。
+SCENARIO_POOL_WARM_UP = get_flag("SCENARIO_POOL_WARM_UP", False)
+
+def generate_pooled_scenario(mode_key, model):
+    """シナリオ未入力の場合の最初の誘いを1件生成し、ChatSession用の履歴とともに返す
+
+    プールのバックグラウンドのスレッドで呼ばれるため、モデル (get_mode_model) はスクリプトのスレッドで取得して渡す。
+    """
+    message = prompts.build_initial_message("")
+    response = llm_client.send_message(
+        model.start_chat(history=[]), message,
+        labels={"stage": "scenario_pool", **get_metric_labels(mode_key)}
+    )
+    return {
+        "text": response.text,
+        "usage": llm_client.get_token_usage(response),
+        "history": [
+            {"role": "user", "parts": [message]},
+            {"role": "model", "parts": [response.text]}
+        ]
+    }
 
-**【AIへの追加指示】**
-ユーザーの断り方（例：「大変恐縮なのですが、その日は先約がありまして」）を、あなたの応答の**最初に**、以下の手順で**マークアップして引用**してください。
-1. **練習目標である要素に最も関連する部分（単語または句）**を見つけます。
-2. その部分を、**太字と斜体、下線**でマークアップ（_**...**_）してください。
-3. その後に、通常の評価と改善提案を続けてください。
-4. フィードバックの**末尾に**、以下の厳密な形式で合否判定を必ず追加してください。
-    - 基準: ユーザーの断り方が、この要素の基準を完全に満たした場合のみ「合格」としてください。少しでも改善の余地がある場合は「不合格」です。
-    - 形式: 【合否判定】: 合格 または 【合否判定】: 不合格
-"""
-    return focused_prompt
+@st.cache_resource
+def get_scenario_pool():
+    """プロセス全体で共有する事前生成プールを作成する (SCENARIO_POOL_WARM_UP の場合は全モードの補充も開始する)"""
+    pool = scenario_pool.ScenarioPool(generate_pooled_scenario, SCENARIO_POOL_SIZE, SCENARIO_POOL_TTL_SECONDS)
+    if SCENARIO_POOL_WARM_UP:
+        mode_keys = ["総合実践"] + [key.split(' (')[0] for key in training_elements]
+        pool.warm_up({mode_key: get_mode_model(mode_key, "scenario") for mode_key in mode_keys})
+    return pool
 
 
 # --- 4. UIの配置とモード選択 ---
@@ -398,25 +603,77 @@ def create_focused_prompt(element_key, element_description):
 if "chat_history" not in st.session_state or "user_id" not in st.session_state or st.session_state.user_id != user_id:
     
     st.session_state.chat_history = []
-    st.session_state.genai_chat = model.start_chat(history=[])
+    st.session_state.chat_context = []
     st.session_state.initial_prompt_sent = False
     st.session_state.current_scenario = None
     st.session_state.user_id = user_id
     st.session_state.selected_element_display = "総合実践"
     st.session_state.new_session_flag = False
     
-    # ログイン（開始）時刻を記録 (学習時間機能削除のため、この行は削除されるべきだが、以前の修正で残っていたため、ここでは削除)
-    
     # 要素別トレーニングの合格状況をファイルからロードする
     st.session_state.element_status = load_element_progress(training_elements, user_id) 
+
+    # 再起動や別のワーカーで途切れた練習があれば、その続きから再開する
+    restore_live_session(user_id)
+    
+    # 最初の誘いの事前生成プールを用意する (SCENARIO_POOL_WARM_UP の場合は、練習開始までの間に全モードの生成を進めておく)
+    get_scenario_pool()
     
     # スクロール制御の初期化
     st.session_state.scroll_to_top_flag = False
-    # ★学習時間関連のセッション変数をクリア★
-    keys_to_clear_on_start = ["session_start_time"]
-    for key in keys_to_clear_on_start:
-        if key in st.session_state:
-            del st.session_state[key]
+
+# 学習時間: この再実行 (操作) をハートビートとして記録する (保存はまとめて行われる)
+def record_heartbeat():
+    """フラグメントだけの再実行 (チャットの送信など) も操作として数える"""
+    get_study_time_tracker().heartbeat(user_id)
+
+record_heartbeat()
+
+
+# --- 部分的な再実行 (st.fragment) ---
+# 練習設定・実践エリア・履歴はそれぞれフラグメントとして描画し、操作のたびに画面全体を再実行しない。
+# 合格状況の変化など、複数の領域にまたがる変更のときだけスクリプト全体を再実行する。
+ELEMENT_PANEL_KEY = "element_panel"
+PRACTICE_AREA_KEY = "practice_area"
+HISTORY_PANEL_KEY = "history_panel"
+
+# 選択された要素を一時的に保持するためのキーを定義
+ELEMENT_SELECT_KEY = 'selected_element_for_practice'
+
+def rerun_fragment():
+    """フラグメントの再実行中はそのフラグメントだけを、スクリプト全体の実行中は全体を再実行する"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+# 要素の選択と練習の開始は実践エリア (別のフラグメント) の表示も変えるため、アプリ全体を再実行する。
+# ログイン欄などフラグメント外のウィジェットも描き直され、以降のターンでもログイン状態が保たれる。
+def select_element(key, element_name_simple):
+    """「この要素を選択する」ボタン: 選択を記録し、アプリ全体を再実行する"""
+    st.session_state[ELEMENT_SELECT_KEY] = key
+    st.session_state.selected_element_display = element_name_simple
+    save_live_session(st.session_state.user_id)
+    st.rerun()
+
+def start_practice(selected_element_display):
+    """「練習を開始する」ボタン: 会話をリセットし、アプリ全体を再実行する"""
+    st.session_state.chat_history = []
+    st.session_state.chat_context = []
+
+    st.session_state.initial_prompt_sent = False
+    st.session_state.current_scenario = st.session_state.get("scenario_input", "").strip() # 入力がない場合は空文字列を渡す
+    st.session_state.new_session_flag = True
+
+    st.session_state.selected_element_display = selected_element_display
+    st.rerun()
+
+def save_current_history():
+    """「現在の会話履歴を保存」ボタン (フラグメント外のため、押した後はアプリ全体が再実行される)"""
+    if st.session_state.chat_history:
+        save_chat_history(st.session_state.chat_history, st.session_state.user_id)
+    else:
+        st.toast("保存する会話履歴がありません。", icon="⚠️")
 
 
 # --- UI制御 ---
@@ -428,253 +685,421 @@ if st.session_state.scroll_to_top_flag:
     st.session_state.scroll_to_top_flag = False
 # ---------------------------------
 
-# 練習モードの選択 (ロック機能の実装)
-all_elements_passed = all(st.session_state.element_status.values())
+@st.fragment(key=ELEMENT_PANEL_KEY)
+def render_element_panel():
+    """練習モードの選択・要素別の進捗と目標・シナリオ入力・開始ボタン"""
+    record_heartbeat()
 
-# ロック状態に応じた選択肢リストの定義
-mode_options_base = ('要素別トレーニング (一点集中)',)
+    # 練習モードの選択 (ロック機能の実装)
+    all_elements_passed = all(st.session_state.element_status.values())
 
-if all_elements_passed:
-    st.success("🎉 すべての要素を合格しました！総合実践モードが解放されました。")
-    # ロック解除時: 総合実践をリストの先頭に追加
-    mode_options = ('総合実践 (全要素を評価)',) + mode_options_base
-else:
-    st.warning("総合実践は、すべての要素別トレーニング（6要素）を合格後に解放されます。")
-    # ロック時: 要素別トレーニングのみ
-    mode_options = mode_options_base
-    
-# 選択肢のインデックスを維持またはリセット
-initial_index = 0
-if 'practice_mode_select' in st.session_state:
-    try:
-        # ロック中に総合実践を選択していた場合を考慮して、インデックスを再計算
-        if not all_elements_passed and st.session_state.practice_mode_select == '総合実践 (全要素を評価)':
-             st.session_state.practice_mode_select = mode_options_base[0] # 要素別トレーニングに強制リセット
-        
-        initial_index = mode_options.index(st.session_state.practice_mode_select)
-    except ValueError:
-        initial_index = 0 # 見つからない場合は最初の要素に設定
-
-
-practice_mode = st.radio(
-    "1. 練習モードを選択してください:",
-    mode_options,
-    index=initial_index,
-    key='practice_mode_select'
-)
+    # ロック状態に応じた選択肢リストの定義
+    mode_options_base = ('要素別トレーニング (一点集中)',)
 
-# ロックされている場合は、選択されたモードを '要素別トレーニング' に強制
-if not all_elements_passed and practice_mode == '総合実践 (全要素を評価)':
-    practice_mode = mode_options_base[0]
-    st.session_state.selected_element_display = "総合実践" # 総合実践の表示名は維持
+    if all_elements_passed:
+        st.success("🎉 すべての要素を合格しました！総合実践モードが解放されました。")
+        # ロック解除時: 総合実践をリストの先頭に追加
+        mode_options = ('総合実践 (全要素を評価)',) + mode_options_base
+    else:
+        st.warning("総合実践は、すべての要素別トレーニング（6要素）を合格後に解放されます。")
+        # ロック時: 要素別トレーニングのみ
+        mode_options = mode_options_base
 
+    # 選択肢のインデックスを維持またはリセット
+    initial_index = 0
+    if 'practice_mode_select' in st.session_state:
+        try:
+            # ロック中に総合実践を選択していた場合を考慮して、インデックスを再計算
+            if not all_elements_passed and st.session_state.practice_mode_select == '総合実践 (全要素を評価)':
+                 st.session_state.practice_mode_select = mode_options_base[0] # 要素別トレーニングに強制リセット
 
-# 要素ポイントの表示 (Expanderで常に開閉可能にする)
-# ★★★ 目標確認と選択ボタンの統合UI ★★★
+            initial_index = mode_options.index(st.session_state.practice_mode_select)
+        except ValueError:
+            initial_index = 0 # 見つからない場合は最初の要素に設定
 
-st.markdown("---")
-st.markdown("### 🏆 要素別トレーニングの進捗と目標")
 
-# 修正: element_keys をここで定義する
-element_keys = list(training_elements.keys())
+    practice_mode = st.radio(
+        "1. 練習モードを選択してください:",
+        mode_options,
+        index=initial_index,
+        key='practice_mode_select'
+    )
 
-# 選択された要素を一時的に保持するためのキーを定義
-ELEMENT_SELECT_KEY = 'selected_element_for_practice'
+    # ロックされている場合は、選択されたモードを '要素別トレーニング' に強制
+    if not all_elements_passed and practice_mode == '総合実践 (全要素を評価)':
+        practice_mode = mode_options_base[0]
+        st.session_state.selected_element_display = "総合実践" # 総合実践の表示名は維持
 
-for i, key in enumerate(element_keys):
-    passed = st.session_state.element_status[key]
-    icon = "✅" if passed else "❌"
-    
-    # 要素名（点数除く）
-    element_name_simple = key.split(' (')[0]
-    
-    # 現在この要素が選択中かどうかをチェック
-    is_current_selection = (st.session_state.get('selected_element_display') == element_name_simple)
-    
-    # 選択中の要素はExpanderを強制的に開く
-    expander_label = f"{icon} **{element_name_simple}**"
-    if is_current_selection:
-        expander_label += " (✨ 現在の目標)"
-    
-    with st.expander(expander_label, expanded=is_current_selection):
-        st.markdown(f"**目標**:\n- {training_elements[key]}")
-        
-        # 集中モードが選択されている場合のみボタンを表示
-        if practice_mode == '要素別トレーニング (一点集中)':
-            
-            # ボタンのキーが個々にユニークであることを保証
-            button_key = f"select_{i}_{key.replace(' ', '_')}"
-            
-            if st.button("この要素を選択する", key=button_key, disabled=is_current_selection):
-                # クロージャを使わず直接セッションステートを更新し再実行
-                st.session_state[ELEMENT_SELECT_KEY] = key
-                st.session_state.selected_element_display = element_name_simple
-                st.rerun() 
 
+    # 要素ポイントの表示 (Expanderで常に開閉可能にする)
+    # ★★★ 目標確認と選択ボタンの統合UI ★★★
 
-st.markdown("---")
+    st.markdown("---")
+    st.markdown("### 🏆 要素別トレーニングの進捗と目標")
+
+    # 修正: element_keys をここで定義する
+    element_keys = list(training_elements.keys())
+
+    for i, key in enumerate(element_keys):
+        passed = st.session_state.element_status[key]
+        icon = "✅" if passed else "❌"
+
+        # 要素名（点数除く）
+        element_name_simple = key.split(' (')[0]
+
+        # 現在この要素が選択中かどうかをチェック
+        is_current_selection = (st.session_state.get('selected_element_display') == element_name_simple)
+
+        # 選択中の要素はExpanderを強制的に開く
+        expander_label = f"{icon} **{element_name_simple}**"
+        if is_current_selection:
+            expander_label += " (✨ 現在の目標)"
+
+        with st.expander(expander_label, expanded=is_current_selection):
+            st.markdown(f"**目標**:\n- {training_elements[key]}")
+
+            # 集中モードが選択されている場合のみボタンを表示
+            if practice_mode == '要素別トレーニング (一点集中)':
+
+                # ボタンのキーが個々にユニークであることを保証
+                button_key = f"select_{i}_{key.replace(' ', '_')}"
 
-# --- 選択された要素をセッションステートに反映し、メインロジックで使用可能にする ---
-current_selected_element_display = "総合実践"
-selected_element = None
+                if st.button("この要素を選択する", key=button_key, disabled=is_current_selection):
+                    select_element(key, element_name_simple)
 
-if practice_mode == '総合実践 (全要素を評価)' or practice_mode == '総合実践 (ロック中)':
-    st.session_state[ELEMENT_SELECT_KEY] = None
+
+    st.markdown("---")
+
+    # --- 選択された要素をセッションステートに反映し、メインロジックで使用可能にする ---
     current_selected_element_display = "総合実践"
-    
-elif st.session_state.get(ELEMENT_SELECT_KEY) is not None:
-    # ボタンで選択された値がセッションステートにある場合
-    selected_element = st.session_state[ELEMENT_SELECT_KEY]
-    current_selected_element_display = st.session_state.selected_element_display
-    
-    st.success(f"✅ 選択中の集中要素: **{current_selected_element_display}**")
-    
-# 要素別モードが選択されているのに要素が未選択の場合
-elif practice_mode == '要素別トレーニング (一点集中)' and st.session_state.get(ELEMENT_SELECT_KEY) is None:
-    st.warning("☝️ 上のリストから、集中して練習する要素を一つ選択してください。")
-    
-    # 選択されていない場合は、要素別トレーニングの開始を不可にするため、selected_elementはNoneのままにする
     selected_element = None
-    
-# ★★★ 統合UI終了 ★★★
 
+    if practice_mode == '総合実践 (全要素を評価)' or practice_mode == '総合実践 (ロック中)':
+        st.session_state[ELEMENT_SELECT_KEY] = None
+        current_selected_element_display = "総合実践"
 
-# ユーザーがシナリオを入力するUI
-st.markdown("### 2. シナリオの入力 (オプション)")
+    elif st.session_state.get(ELEMENT_SELECT_KEY) is not None:
+        # ボタンで選択された値がセッションステートにある場合
+        selected_element = st.session_state[ELEMENT_SELECT_KEY]
+        current_selected_element_display = st.session_state.selected_element_display
 
-# 課題解消: シナリオ入力の説明強化 ＆ 必須解除
-st.info("💡 **希望するシナリオがない場合は空欄のまま**で構いません。空欄の場合、AIが自動でシナリオを生成します。")
-scenario_input = st.text_area(
-    "【任意】誘い手（誰から）、誘いの内容、断りにくさのレベル（低・中・高）を具体的に入力してください。",
-    height=100,
-    key="scenario_input"
-)
+        st.success(f"✅ 選択中の集中要素: **{current_selected_element_display}**")
 
-# シナリオ入力が空欄でもボタンを有効にする
-start_button_disabled = (practice_mode == '要素別トレーニング (一点集中)' and selected_element is None)
+    # 要素別モードが選択されているのに要素が未選択の場合
+    elif practice_mode == '要素別トレーニング (一点集中)' and st.session_state.get(ELEMENT_SELECT_KEY) is None:
+        st.warning("☝️ 上のリストから、集中して練習する要素を一つ選択してください。")
 
-# 「練習を開始する」ボタン
-if st.button("▶️ 練習を開始する", disabled=start_button_disabled, key="start_button_main"):
-    
-    st.session_state.chat_history = []
-    st.session_state.genai_chat = model.start_chat(history=[])
-    
-    st.session_state.initial_prompt_sent = False
-    st.session_state.current_scenario = scenario_input.strip() # 入力がない場合は空文字列を渡す
-    st.session_state.new_session_flag = True
-    
-    st.session_state.selected_element_display = current_selected_element_display
-    
-    # スクロールロジックは会話エリアの直後に誘導
-    st.rerun()
+        # 選択されていない場合は、要素別トレーニングの開始を不可にするため、selected_elementはNoneのままにする
+        selected_element = None
 
+    # ★★★ 統合UI終了 ★★★
 
-st.markdown("---")
-st.subheader("🗣️ ロールプレイング実践エリア")
-# --------------------------------------------------------------------------
 
-# --- 課題解消: 選択中の要素をロールプレイング画面で確認できるようにする ---
-if st.session_state.get("current_scenario") is not None and st.session_state.initial_prompt_sent:
-    
-    mode_name = "総合実践 (全要素評価)"
-    element_name = ""
-    display_text = st.session_state.get("selected_element_display")
-    
-    if display_text and display_text != "総合実践":
-        mode_name = f"要素別トレーニング"
-        element_name = f" | 目標: **{display_text}**"
-        
-    st.markdown(f"**練習モード:** {mode_name}{element_name}")
-    
-    # シナリオ入力が空の場合の表示を調整
-    scenario_display = st.session_state.current_scenario if st.session_state.current_scenario else "AIがランダムに設定"
-    st.info(f"シチュエーション: **{scenario_display}**")
-    
-else:
-    st.warning("「練習設定」エリアで設定を入力し、「練習を開始」ボタンを押してください。")
+    # ユーザーがシナリオを入力するUI
+    st.markdown("### 2. シナリオの入力 (オプション)")
 
+    # 課題解消: シナリオ入力の説明強化 ＆ 必須解除
+    st.info("💡 **希望するシナリオがない場合は空欄のまま**で構いません。空欄の場合、AIが自動でシナリオを生成します。")
+    st.text_area(
+        "【任意】誘い手（誰から）、誘いの内容、断りにくさのレベル（低・中・高）を具体的に入力してください。",
+        height=100,
+        key="scenario_input"
+    )
 
-# --- 7. AIからの最初の誘いを生成し表示 (ロジック分岐) ---
-if st.session_state.get("new_session_flag", False):
-    
-    st.session_state.new_session_flag = False 
-    
-    # シナリオ入力が空欄の場合の処理
-    scenario_input_value = st.session_state.current_scenario
-    
-    if not scenario_input_value:
-        # 入力がない場合、AIにランダム生成を指示するテキストをセット
-        scenario_text = "**ユーザーはシナリオを指定しませんでした。ターゲット層（大学1年〜新卒1年）に合った、断りにくい誘いを一つ自動で設定してください。**"
-    else:
-        scenario_text = f"**ユーザーが設定したシナリオ:** {scenario_input_value}"
-    
-    
-    element_key_for_prompt = next((key for key in training_elements if st.session_state.selected_element_display in key), None)
-    
-    if st.session_state.selected_element_display != "総合実践" and element_key_for_prompt:
-        combined_prompt = create_focused_prompt(element_key_for_prompt, training_elements[element_key_for_prompt])
-        combined_prompt += f"\n\n{scenario_text}"
-    elif st.session_state.selected_element_display == "総合実践":
-            combined_prompt = f"{SYSTEM_PROMPT_FULL_TEMPLATE}\n\n{scenario_text}"
-    else:
-            combined_prompt = "" 
-    
-    if combined_prompt:
-        with st.spinner("AIが誘いを考えています..."):
-            initial_response = st.session_state.genai_chat.send_message(combined_prompt)
-            st.session_state.chat_history.append({"role": "assistant", "content": initial_response.text})
-            st.session_state.initial_prompt_sent = True
-            
-            # View維持
-            st.rerun()
-    else:
-        st.error("プロンプトの生成に失敗しました。設定を見直してください。")
-        st.stop()
+    # シナリオ入力が空欄でもボタンを有効にする
+    start_button_disabled = (practice_mode == '要素別トレーニング (一点集中)' and selected_element is None)
+
+    # 「練習を開始する」ボタン (スクロールロジックは会話エリアの直後に誘導)
+    if st.button("▶️ 練習を開始する", disabled=start_button_disabled, key="start_button_main"):
+        start_practice(current_selected_element_display)
 
+render_element_panel()
 
-# --- 8. 会話履歴の表示 ---
-for message in st.session_state.chat_history:
+
+st.markdown("---")
+st.subheader("🗣️ ロールプレイング実践エリア")
+# --------------------------------------------------------------------------
+
+def render_chat_message(message):
+    """会話履歴の1メッセージを表示する"""
     with st.chat_message(message["role"]):
         if message["role"] == "assistant":
-            st.markdown(highlight_text(message["content"]), unsafe_allow_html=True)
+            st.markdown(evaluation.message_html(message), unsafe_allow_html=True)
+            # 開発者向け: ターンごとのトークン数 (システムプロンプト削減の効果確認用)
+            if get_flag("SHOW_DEBUG_STATS") and message.get("usage"):
+                usage = message["usage"]
+                st.caption(
+                    f"入力トークン {usage['input_tokens']} (うちキャッシュ {usage['cached_tokens']}) / "
+                    f"出力トークン {usage['output_tokens']}"
+                )
         else:
             st.markdown(message["content"])
 
-# --- 9. ユーザー入力の処理 ---
-user_input = st.chat_input("あなたの断り言葉を入力してください", disabled=not st.session_state.initial_prompt_sent)
+@st.fragment(key=PRACTICE_AREA_KEY)
+def render_practice_area():
+    """練習中の会話。回答の送信ではこのフラグメントだけが再実行される"""
+    record_heartbeat()
+
+    # 見出しは最初の誘いを生成した後に書き込むため、先に場所だけ確保する
+    header_area = st.container()
+    chat_area = st.container()
+
+    # --- 8. 会話履歴の表示 ---
+    with chat_area:
+        for message in st.session_state.chat_history:
+            render_chat_message(message)
+
+    # --- 7. AIからの最初の誘いを生成し表示 (ロジック分岐) ---
+    if st.session_state.get("new_session_flag", False):
+
+        st.session_state.new_session_flag = False
+
+        mode_key = st.session_state.selected_element_display
+
+        if not get_system_prompt(mode_key):
+            st.error("プロンプトの生成に失敗しました。設定を見直してください。")
+            st.stop()
+
+        if get_quota_level(user_id) == "hard":
+            metrics.inc("refuse_ai_quota_limited_total", level="hard", **get_metric_labels(mode_key))
+            st.error(QUOTA_MESSAGES["hard"])
+            st.stop()
+
+        mode_model = get_mode_model(mode_key, "scenario")
+        initial_message = prompts.build_initial_message(st.session_state.current_scenario)
+
+        # シナリオ未入力の場合は、事前生成済みの誘いがあればそれを使う（待ち時間なし）
+        pooled = None
+        if not st.session_state.current_scenario:
+            pooled = get_scenario_pool().take(mode_key, mode_model)
+
+        metrics.inc("refuse_ai_scenario_pool_total", result="hit" if pooled else "miss", **get_metric_labels(mode_key))
+        with chat_area, st.chat_message("assistant"):
+            if pooled:
+                # 事前生成時の会話履歴を引き継ぎ、以降のやり取りの文脈を保つ
+                st.session_state.chat_context = pooled["history"]
+                initial_text = pooled["text"]
+                usage = pooled["usage"]
+                st.markdown(highlight_text(initial_text), unsafe_allow_html=True)
+            else:
+                chat = mode_model.start_chat(history=[])
+                try:
+                    if STREAM_RESPONSES:
+                        initial_text, initial_response = send_message_streaming(
+                            chat, initial_message,
+                            labels={"stage": "scenario", **get_metric_labels(mode_key)}
+                        )
+                    else:
+                        with st.spinner("AIが誘いを考えています..."):
+                            initial_response = llm_client.send_message(
+                                chat, initial_message,
+                                labels={"stage": "scenario", **get_metric_labels(mode_key)}
+                            )
+                            initial_text = initial_response.text
+                        st.markdown(highlight_text(initial_text), unsafe_allow_html=True)
+                except llm_client.LLMUnavailableError:
+                    # 「練習を開始する」ボタンを押し直せば再試行できる
+                    st.error(LLM_UNAVAILABLE_MESSAGE)
+                    st.stop()
+                usage = llm_client.get_token_usage(initial_response)
+                st.session_state.chat_context = history_to_dicts(chat.history)
+        log_token_usage(mode_key, usage)
+        # 事前生成の誘いも、受け取ったユーザーの利用量として数える
+        record_token_usage(user_id, usage, 1)
+        st.session_state.chat_history.append({
+            "role": "assistant", "content": initial_text, "html": highlight_text(initial_text), "usage": usage
+        })
+        st.session_state.folded_turns = []
+        st.session_state.initial_prompt_sent = True
+        save_live_session(user_id)
+
+    # --- 課題解消: 選択中の要素をロールプレイング画面で確認できるようにする ---
+    with header_area:
+        if st.session_state.get("current_scenario") is not None and st.session_state.initial_prompt_sent:
+
+            mode_name = "総合実践 (全要素評価)"
+            element_name = ""
+            display_text = st.session_state.get("selected_element_display")
+
+            if display_text and display_text != "総合実践":
+                mode_name = f"要素別トレーニング"
+                element_name = f" | 目標: **{display_text}**"
+
+            st.markdown(f"**練習モード:** {mode_name}{element_name}")
+
+            # シナリオ入力が空の場合の表示を調整
+            scenario_display = st.session_state.current_scenario if st.session_state.current_scenario else "AIがランダムに設定"
+            st.info(f"シチュエーション: **{scenario_display}**")
 
-if user_input:
-    st.session_state.chat_history.append({"role": "user", "content": user_input})
-    with st.chat_message("user"):
-        st.markdown(user_input)
+        else:
+            st.warning("「練習設定」エリアで設定を入力し、「練習を開始」ボタンを押してください。")
 
-    with st.spinner("AIが返答を考えています..."):
-        ai_response = st.session_state.genai_chat.send_message(user_input)
-        response_text = ai_response.text
+    # --- 9. ユーザー入力の処理 ---
+    if llm_client.is_degraded():
+        st.warning("現在AIが混み合っており、応答に時間がかかる場合があります。")
 
-        # 合否判定チェック
-        if st.session_state.selected_element_display != "総合実践":
-            match = re.search(r"【合否判定】:\s*(合格|不合格)", response_text)
-            
-            if match:
-                current_element_key = next((key for key in training_elements if st.session_state.selected_element_display in key), None)
-                
-                if current_element_key and match.group(1) == "合格":
-                    if not st.session_state.element_status[current_element_key]:
-                        st.session_state.element_status[current_element_key] = True
-                        save_element_progress(st.session_state.element_status, user_id)
-                        response_text += "\n\n🎉 **おめでとうございます！この要素を合格しました。** 次の要素に進むか、すべての要素合格後に総合実践に挑戦しましょう！"
-                
-                response_text = response_text.replace("【合否判定】: 合格", "**【合否判定】: <span style='color:green;'>合格</span>**")
-                response_text = response_text.replace("【合否判定】: 不合格", "**【合否判定】: <span style='color:red;'>不合格</span>**")
+    quota_level = get_quota_level(user_id)
+    if quota_level == "hard":
+        st.error(QUOTA_MESSAGES["hard"])
+    elif quota_level == "soft":
+        st.info(QUOTA_MESSAGES["soft"])
 
+    user_input = st.chat_input(
+        "あなたの断り言葉を入力してください",
+        disabled=not st.session_state.initial_prompt_sent or quota_level == "hard"
+    )
 
-        st.session_state.chat_history.append({"role": "assistant", "content": response_text})
-        with st.chat_message("assistant"):
-            st.markdown(highlight_text(response_text), unsafe_allow_html=True)
+    if not user_input:
+        return
 
-    time.sleep(1)
-    st.rerun()
+    turn_started = time.perf_counter()
+    turn_labels = get_metric_labels(st.session_state.selected_element_display)
+    st.session_state.chat_history.append({"role": "user", "content": user_input})
+    with chat_area, st.chat_message("user"):
+        st.markdown(user_input)
+
+    mode_key = st.session_state.selected_element_display
+    chat = get_chat_session(mode_key)
+    evaluation_result = None
+    ai_response = None
+    reply_text, reply_response = None, None
+    progress_changed = False
+    assistant_area = chat_area.chat_message("assistant")
+    # 最終的な応答は同じ場所に書き直す (速報やストリーミング中の表示を置き換える)
+    response_area = assistant_area.empty()
+    screening = prescreen.screen_answer(mode_key, user_input)
+    local_fail = screening and screening["clear_fail"] and PRESCREEN_SKIP_LLM
+    cached_evaluation = None
+    if not local_fail and feedback_cache_enabled(mode_key):
+        cached_evaluation = lookup_cached_feedback(mode_key, user_input, turn_labels)
+    if local_fail:
+        # 明らかな不合格: LLMを呼ばずに即座にフィードバックを返す
+        metrics.inc("refuse_ai_prescreen_total", result="local", **turn_labels)
+        evaluation_result = prescreen.build_local_evaluation(screening, mode_key, user_input)
+        response_text = evaluation.render_markdown(evaluation_result, user_input)
+        record_local_turn(chat, user_input, response_text)
+    elif cached_evaluation:
+        # よく似た回答の評価を再利用する (LLMは呼ばない)
+        evaluation_result = cached_evaluation
+        response_text = evaluation.render_markdown(evaluation_result, user_input)
+        record_local_turn(chat, user_input, response_text)
+    else:
+        if screening:
+            metrics.inc("refuse_ai_prescreen_total", result="llm", **turn_labels)
+        labels = {"stage": "evaluation", **turn_labels}
+        # ソフト上限を超えたユーザーは、簡潔な評価を1回のリクエストで返す
+        brief = quota_level == "soft"
+        if brief:
+            metrics.inc("refuse_ai_quota_limited_total", level="soft", **turn_labels)
+        try:
+            with response_area.container():
+                if screening:
+                    # LLMの評価を待つ間の速報 (最終的な表示には残さない)
+                    st.caption(prescreen.format_provisional_note(screening))
+                if STRUCTURED_EVALUATION and PARALLEL_REPLY and not brief:
+                    # 評価をバックグラウンドで送り、その間に相手役の返答を別のモデルで生成して先に表示する
+                    evaluation_future = get_evaluation_executor().submit(
+                        llm_client.send_message, chat, user_input, labels=labels,
+                        generation_config=evaluation.generation_config(mode_key, with_reply=False)
+                    )
+                    reply_text, reply_response = generate_reply(mode_key, user_input, turn_labels)
+                    with st.spinner("AIがフィードバックを考えています..."):
+                        ai_response = evaluation_future.result()
+                elif STRUCTURED_EVALUATION:
+                    # 評価は構造化出力 (JSON) で受け取るため、ストリーミングせずに待つ
+                    with st.spinner("AIが返答を考えています..."):
+                        ai_response = llm_client.send_message(
+                            chat, user_input, labels=labels,
+                            generation_config=evaluation.generation_config(mode_key, brief=brief)
+                        )
+                if STRUCTURED_EVALUATION:
+                    response_text = ai_response.text
+                    evaluation_result = evaluation.parse_evaluation(response_text, mode_key)
+                    if evaluation_result and reply_text:
+                        evaluation_result["reply"] = reply_text.strip()
+                    elif reply_text:
+                        response_text = f"{reply_text}\n\n{response_text}"
+                    if evaluation_result:
+                        response_text = evaluation.render_markdown(evaluation_result, user_input)
+                        if feedback_cache_enabled(mode_key):
+                            get_feedback_cache().store(mode_key, feedback_cache_scenario(), user_input, evaluation_result)
+                    else:
+                        # 形式が崩れた場合は本文をそのまま表示し、合否は従来どおり本文から読み取る
+                        metrics.inc("refuse_ai_evaluation_parse_failures_total", **turn_labels)
+                        logger.warning("構造化された評価を解析できませんでした (%s)", mode_key)
+                else:
+                    # 従来のマークダウン形式: ソフト上限を超えたユーザーには簡潔な評価を指示し、出力トークン数も制限する
+                    message, brief_options = user_input, {}
+                    if brief:
+                        message = prompts.build_brief_message(user_input)
+                        brief_options = {"generation_config": {"max_output_tokens": BRIEF_MAX_OUTPUT_TOKENS}}
+                    if STREAM_RESPONSES:
+                        response_text, ai_response = send_message_streaming(
+                            chat, message, labels=labels, **brief_options
+                        )
+                    else:
+                        with st.spinner("AIが返答を考えています..."):
+                            ai_response = llm_client.send_message(chat, message, labels=labels, **brief_options)
+                        response_text = ai_response.text
+                    if brief:
+                        # 簡潔にする指示は以降のターンの文脈に残さず、回答だけを履歴に戻す
+                        history = history_to_dicts(chat.history)
+                        history[-2] = {"role": "user", "parts": [user_input]}
+                        chat.history = history
+        except llm_client.LLMUnavailableError:
+            if reply_response is not None:
+                # 評価が失敗しても、並行して生成済みの相手役の返答の分は利用量に含める
+                record_token_usage(user_id, llm_client.get_token_usage(reply_response), 1)
+            # 評価されなかった回答は履歴から取り除き、もう一度入力できるようにする
+            st.session_state.chat_history.pop()
+            st.error(LLM_UNAVAILABLE_MESSAGE)
+            st.stop()
+    usage = llm_client.get_token_usage(ai_response)
+    if reply_response is not None:
+        # 並行して生成した相手役の返答の分も、このターンのトークン数に含める
+        reply_usage = llm_client.get_token_usage(reply_response)
+        usage = {key: usage[key] + reply_usage[key] for key in usage}
+    if ai_response is not None:
+        log_token_usage(mode_key, usage)
+    record_token_usage(user_id, usage, (ai_response is not None) + (reply_response is not None))
+
+    # 合否判定チェック (構造化された評価があればそのフィールドを使い、なければ本文から読み取る)
+    if mode_key != "総合実践":
+        verdict = evaluation_result["verdict"] if evaluation_result else evaluation.extract_verdict(response_text)
+
+        if verdict:
+            current_element_key = next((key for key in training_elements if mode_key in key), None)
+
+            if current_element_key and verdict == "合格":
+                if not st.session_state.element_status[current_element_key]:
+                    st.session_state.element_status[current_element_key] = True
+                    save_element_progress(st.session_state.element_status, user_id)
+                    progress_changed = True
+                    response_text += "\n\n🎉 **おめでとうございます！この要素を合格しました。** 次の要素に進むか、すべての要素合格後に総合実践に挑戦しましょう！"
+
+            response_text = evaluation.color_verdict(response_text)
+
+
+    # 構造化された評価 (合否・点数など) と表示用のHTMLは、履歴の保存時にメッセージと一緒に保存される
+    response_html = highlight_text(response_text)
+    st.session_state.chat_history.append({
+        "role": "assistant", "content": response_text, "html": response_html, "usage": usage, "evaluation": evaluation_result
+    })
+    response_area.markdown(response_html, unsafe_allow_html=True)
+
+    # 次のターンに送る履歴が長くなりすぎないよう、古いやり取りを要約に置き換える
+    chat = compact_chat_context(chat, mode_key, st.session_state.setdefault("folded_turns", []))
+    st.session_state.chat_context = history_to_dicts(chat.history)
+    save_live_session(user_id)
+
+    # 回答の受付から表示の完了まで (LLM呼び出し・保存を含む) の所要時間
+    metrics.observe("refuse_ai_turn_seconds", time.perf_counter() - turn_started, **turn_labels)
+
+    # 会話は表示済みなので再実行は不要。合格で進捗が変わったときだけ、進捗パネルを含めて全体を描き直す
+    if progress_changed:
+        st.rerun()
+
+render_practice_area()
 
 st.markdown("---")
 st.subheader("✅ データ管理")
@@ -682,21 +1107,33 @@ st.subheader("✅ データ管理")
 # 「新しい練習を始める」ボタン
 if st.button("🔄 新しい練習を始める（設定エリアへ戻る）", key="reset_and_go_to_settings"):
     st.session_state.chat_history = []
-    st.session_state.genai_chat = model.start_chat(history=[])
+    st.session_state.chat_context = []
     st.session_state.initial_prompt_sent = False
     st.session_state.current_scenario = None
     st.session_state.selected_element_display = "総合実践"
     st.session_state['selected_element_for_practice'] = None
+    clear_live_session(user_id)
     
     # 練習設定のサブヘッダーにスクロール
     st.session_state.scroll_to_top_flag = True
     st.rerun()
     
-if st.button("✅ 現在の会話履歴を保存", key="save_button_view2"):
-    if st.session_state.chat_history:
-        save_chat_history(st.session_state.chat_history, user_id)
-    else:
-        st.warning("保存する会話履歴がありません。")
+st.button("✅ 現在の会話履歴を保存", key="save_button_view2", on_click=save_current_history)
+
+# 開発者向けの統計表示 (SHOW_DEBUG_STATS を設定した場合のみ)
+if get_flag("SHOW_DEBUG_STATS"):
+    cache_stats = get_storage().cache_stats()
+    if cache_stats:
+        st.caption(
+            f"読み込みキャッシュ: ヒット {cache_stats['hits']} / ミス {cache_stats['misses']} "
+            f"(ヒット率 {cache_stats['hit_rate']:.0%}, {cache_stats['entries']} ファイル)"
+        )
+    if USE_FEEDBACK_CACHE:
+        feedback_stats = get_feedback_cache().stats()
+        st.caption(
+            f"評価の再利用: ヒット {feedback_stats['hits']} / ミス {feedback_stats['misses']} "
+            f"(ヒット率 {feedback_stats['hit_rate']:.0%}, {feedback_stats['entries']} 件)"
+        )
 
 # デバッグ用全要素合格ボタン
 if st.button("✅ 全要素を合格にする (デバッグ用)", key="debug_complete_all_elements"):
@@ -720,41 +1157,86 @@ if st.button("🚪 ログアウト", key="logout_button"):
 st.markdown("---")
 st.subheader("📚 これまでの練習履歴")
 
-all_histories = load_all_chat_histories(user_id)
-
-if not all_histories:
-    st.info("まだ保存された練習履歴はありません。")
-else:
-    for i, log in enumerate(reversed(all_histories)):
-        with st.expander(f"セッション: {log['timestamp']} (ID: {log['session_id'][-4:]})"):
-            for message in log["history"]:
-                if message["role"] == "assistant" and "あなたはユーザーが誘いを断る練習をするためのロールプレイング相手です。" in message["content"]:
-                    continue 
-                with st.chat_message(message["role"]):
-                    if message["role"] == "assistant":
-                        st.markdown(highlight_text(message["content"]), unsafe_allow_html=True)
-                    else:
-                        st.markdown(message["content"])
+# 1ページに表示するセッション数
+HISTORY_PAGE_SIZE = 10
+
+@st.fragment(key=HISTORY_PANEL_KEY)
+def render_history_panel():
+    """保存済みの練習履歴。開閉・削除・ページ送りではこのフラグメントだけが再実行される"""
+    record_heartbeat()
+
+    # 一覧にはヘッダー（日時・ID・件数）だけを読み込み、本文は開いたセッションの分だけ読み込む
+    history_render_started = time.perf_counter()
+    history_page = st.session_state.get("history_page", 0)
+    history_headers, total_sessions = load_chat_history_page(user_id, history_page, HISTORY_PAGE_SIZE)
 
-            if st.button(f"このセッションを削除 ({log['session_id'][-4:]})", key=f"delete_btn_{log['session_id']}"):
-                delete_chat_history(log['session_id'], user_id)
-                st.rerun()
+    if total_sessions == 0:
+        st.info("まだ保存された練習履歴はありません。")
+    else:
+        page_count = (total_sessions + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        if history_page >= page_count:
+            # 削除などでページ数が減った場合は最終ページに戻す
+            st.session_state.history_page = page_count - 1
+            rerun_fragment()
+
+        for header in history_headers:
+            session_label = f"セッション: {header['timestamp']} (ID: {header['session_id'][-4:]}) - {header['message_count']}件"
+            # st.expander は開閉状態を取得できないため、トグルで開閉を管理する
+            if not st.toggle(session_label, key=f"history_open_{header['session_id']}"):
+                continue
+            log = load_chat_history(header['session_id'], user_id)
+            if log is None:
+                continue
+            with st.container(border=True):
+                for message in log["history"]:
+                    if message["role"] == "assistant" and "あなたはユーザーが誘いを断る練習をするためのロールプレイング相手です。" in message["content"]:
+                        continue 
+                    with st.chat_message(message["role"]):
+                        if message["role"] == "assistant":
+                            st.markdown(evaluation.message_html(message), unsafe_allow_html=True)
+                        else:
+                            st.markdown(message["content"])
+
+                if st.button(f"このセッションを削除 ({log['session_id'][-4:]})", key=f"delete_btn_{log['session_id']}"):
+                    delete_chat_history(log['session_id'], user_id)
+                    rerun_fragment()
+
+        # ページ送り
+        if page_count > 1:
+            col_prev, col_page, col_next = st.columns([1, 2, 1])
+            if col_prev.button("◀ 新しい履歴", key="history_prev_page", disabled=history_page == 0):
+                st.session_state.history_page = history_page - 1
+                rerun_fragment()
+            col_page.caption(f"{history_page + 1} / {page_count} ページ (全 {total_sessions} 件)")
+            if col_next.button("古い履歴 ▶", key="history_next_page", disabled=history_page >= page_count - 1):
+                st.session_state.history_page = history_page + 1
+                rerun_fragment()
+
+    metrics.observe("refuse_ai_render_seconds", time.perf_counter() - history_render_started, section="history")
+
+render_history_panel()
                 
 st.markdown("---")
 if st.button("すべての要素の進捗をリセット (研究用)", key="full_reset_button_view3"):
     st.session_state.element_status = {key: False for key in training_elements.keys()}
-    progress_file_path = get_user_files(user_id)["progress"]
-    if os.path.exists(progress_file_path):
-        os.remove(progress_file_path)
+    get_storage().reset_progress(user_id)
+    update_analytics("record_progress", user_id, {})
 
     st.session_state.chat_history = []
-    st.session_state.genai_chat = model.start_chat(history=[])
+    st.session_state.chat_context = []
     st.session_state.initial_prompt_sent = False
     st.session_state.selected_element_display = "総合実践"
     st.session_state['selected_element_for_practice'] = None
+    clear_live_session(user_id)
     
     st.info(f"ID: {user_id} の進捗がリセットされました。")
     scroll_to_top()
     st.rerun()
 
 
+# --- 再実行1回分の所要時間を記録 ---
+metrics.observe(
+    "refuse_ai_script_run_seconds",
+    time.perf_counter() - SCRIPT_RUN_STARTED,
+    **get_metric_labels(st.session_state.get("selected_element_display"))
+)
@@ -0,0 +1,91 @@
+"""最初の誘い（シナリオ）の事前生成プール
+
+シナリオ未入力で練習を開始した場合に、あらかじめ生成しておいた誘いを即座に渡す。
+プールはモード（総合実践 / 各要素）ごとに上限数まで溜め、取り出されるたびに
+バックグラウンドのスレッドで非同期に補充する。古くなった誘いはTTLで破棄する。
+
+生成に使うモデルは呼び出し元 (スクリプトのスレッド) で取得して渡す。
+バックグラウンドのスレッドからは、Streamlit のキャッシュ (st.cache_resource) の関数を呼ばない。
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ScenarioPool:
+    """モードごとに、事前生成した最初の誘いを溜めておくプール
+
+    generate(mode_key, model) は、model で生成した {"text": 誘いの本文, "history": ChatSession に渡す履歴} を返す関数。
+    """
+
+    def __init__(self, generate, pool_size=2, ttl_seconds=30 * 60, max_workers=2):
+        self._generate = generate
+        self.pool_size = pool_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}  # モード -> deque[(生成時刻, 誘い)]
+        self._pending = {}  # モード -> 生成中の件数
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scenario-pool")
+        self.hits = 0
+        self.misses = 0
+
+    def warm_up(self, models):
+        """指定したすべてのモード ({モード: モデル}) の補充を開始する"""
+        for mode_key, model in models.items():
+            self.refill(mode_key, model)
+
+    def take(self, mode_key, model):
+        """事前生成済みの誘いを1件取り出し、model で補充を開始する。なければ None を返す。"""
+        with self._lock:
+            entries = self._entries.setdefault(mode_key, deque())
+            self._evict_expired(entries)
+            entry = entries.popleft()[1] if entries else None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self.refill(mode_key, model)
+        return entry
+
+    def refill(self, mode_key, model):
+        """上限に満たない分の生成をバックグラウンドで開始する"""
+        with self._lock:
+            entries = self._entries.setdefault(mode_key, deque())
+            self._evict_expired(entries)
+            missing = self.pool_size - len(entries) - self._pending.get(mode_key, 0)
+            if missing <= 0:
+                return
+            self._pending[mode_key] = self._pending.get(mode_key, 0) + missing
+        for _ in range(missing):
+            self._executor.submit(self._fill_one, mode_key, model)
+
+    def _fill_one(self, mode_key, model):
+        entry = None
+        try:
+            entry = self._generate(mode_key, model)
+        except Exception:
+            # 生成に失敗しても、練習開始時に通常どおり生成されるだけなので記録のみ行う
+            logger.exception("シナリオの事前生成に失敗しました (%s)", mode_key)
+        finally:
+            with self._lock:
+                self._pending[mode_key] -= 1
+                if entry is not None:
+                    self._entries.setdefault(mode_key, deque()).append((time.time(), entry))
+
+    def _evict_expired(self, entries):
+        deadline = time.time() - self.ttl_seconds
+        while entries and entries[0][0] < deadline:
+            entries.popleft()
+
+    def stats(self):
+        """モードごとの在庫数と、ヒット数・ミス数を返す"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "available": {mode_key: len(entries) for mode_key, entries in self._entries.items()}
+            }
@@ -0,0 +1,22 @@
+"""設定値の取得 (アプリ本体と pages/ 以下のページで共通)"""
+import os
+
+import streamlit as st
+
+
+def get_setting(name, default=None):
+    """環境変数 → Streamlit Secrets の順に設定値を探し、なければ default を返す"""
+    if name in os.environ:
+        return os.environ[name]
+    try:
+        return st.secrets.get(name, default)
+    except FileNotFoundError:
+        return default
+
+
+def get_flag(name, default=False):
+    """真偽値の設定 ("1", "true", "yes" などを True とみなす)"""
+    value = get_setting(name)
+    if value is None:
+        return default
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
@@ -0,0 +1,896 @@
+"""誘いを断る練習AI のデータ保存層
+
+進捗（合格状況）・学習時間・チャットログ・練習中の会話 (ライブセッション)・LLMの利用量の読み書きを、
+共通のインターフェースにまとめる。
+
+- JsonStorage:   user_data/ 以下にユーザーごとのJSON/JSONLファイルを置く従来方式
+- SqliteStorage: 1つのSQLiteデータベース (WALモード) にトランザクションで保存する方式
+
+JsonStorage は、ユーザーIDのハッシュで分けたサブディレクトリ (user_data/ab/cd/) にファイルを置き、
+書き込みは一時ファイルに書いてから置き換える (アトミックな書き込み)。
+ユーザーごとのアドバイザリロックで、複数のサーバープロセスが同じディレクトリを共有しても安全に書き込める。
+
+コマンドラインから実行すると、既存の user_data/ ディレクトリをSQLiteへ取り込んだり、
+旧来のフラットな配置からハッシュ分割の配置へ一括で移行したりできる:
+
+    python storage.py import user_data --db user_data/refuse_ai.db
+    python storage.py shard user_data
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows ではファイルロックを使わず、プロセス内のロックだけで排他する
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOGS_DIR = "user_data"
+DEFAULT_DB_PATH = os.path.join(DEFAULT_LOGS_DIR, "refuse_ai.db")
+
+# チャットログの削除レコード（墓標）がこの数に達したらコンパクションを行う
+CHAT_LOG_COMPACT_THRESHOLD = 20
+
+# LLMの利用量として日ごとに数える項目 (quota.py を参照)
+TOKEN_USAGE_COUNTERS = ("requests", "input_tokens", "cached_tokens", "output_tokens")
+
+# 読み込みキャッシュの上限 (ファイル数と、キャッシュ中のファイルサイズの合計)
+READ_CACHE_MAX_ENTRIES = 512
+READ_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+# ハッシュ分割の階層数 (sha1 の先頭2文字ずつ。2階層で 65536 ディレクトリ)
+SHARD_DEPTH = 2
+
+
+def create_storage(backend="json", path=None):
+    """設定名からストレージを生成する ("json" または "sqlite")"""
+    if backend == "json":
+        return JsonStorage(path or DEFAULT_LOGS_DIR)
+    if backend == "sqlite":
+        return SqliteStorage(path or DEFAULT_DB_PATH)
+    raise ValueError(f"未対応のストレージバックエンドです: {backend}")
+
+
+# ==============================================================================
+# 読み込みキャッシュ
+# ==============================================================================
+class FileReadCache:
+    """(パス, 更新時刻, サイズ, inode) をキーにした、ファイル読み込み結果のLRUキャッシュ
+
+    ディスク上のファイルが変わっていなければ、前回パースした結果をそのまま返す。
+    返す値は複数のセッションで共有されるため、呼び出し側で変更してはならない。
+    """
+
+    def __init__(self, max_entries=READ_CACHE_MAX_ENTRIES, max_bytes=READ_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # パス -> ((mtime_ns, size, inode), 値)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, file_path, loader):
+        """キャッシュが有効ならその値を、そうでなければ loader(file_path) の結果を返す"""
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            self.invalidate(file_path)
+            return loader(file_path)
+        # 別プロセスがファイルを置き換えた場合も検出できるよう、inode も比較する
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(file_path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = loader(file_path)
+        with self._lock:
+            self._pop(file_path)
+            self._entries[file_path] = (stamp, value)
+            self._total_bytes += stamp[1]
+            while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+        return value
+
+    def _pop(self, file_path):
+        entry = self._entries.pop(file_path, None)
+        if entry is not None:
+            self._total_bytes -= entry[0][1]
+
+    def invalidate(self, file_path):
+        """書き込み後などに、指定ファイルのキャッシュを破棄する"""
+        with self._lock:
+            self._pop(file_path)
+
+    def stats(self):
+        """ヒット数・ミス数などの統計を返す"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes
+            }
+
+
+# ==============================================================================
+# ファイルの書き込み
+# ==============================================================================
+def atomic_write(file_path, data):
+    """同じディレクトリの一時ファイルに書いてから置き換える (途中で止まっても元のファイルは壊れない)"""
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class UserLocks:
+    """ユーザーごとのアドバイザリロック (fcntl.flock)
+
+    同じスレッド内では再入でき、ロックファイルは開いている間だけ保持する。
+    flock はオープンしたファイルごとのロックのため、同じプロセスの別スレッドとも排他される。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._fallback_locks = {}
+        self._fallback_guard = threading.Lock()
+
+    @contextmanager
+    def hold(self, lock_path):
+        held = self._local.__dict__.setdefault("held", {})
+        if lock_path in held:
+            held[lock_path][1] += 1
+            try:
+                yield
+            finally:
+                held[lock_path][1] -= 1
+            return
+        handle = self._acquire(lock_path)
+        held[lock_path] = [handle, 1]
+        try:
+            yield
+        finally:
+            del held[lock_path]
+            self._release(lock_path, handle)
+
+    def _acquire(self, lock_path):
+        if fcntl is None:
+            with self._fallback_guard:
+                lock = self._fallback_locks.setdefault(lock_path, threading.Lock())
+            lock.acquire()
+            return lock
+        handle = open(lock_path, "a")
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def _release(self, lock_path, handle):
+        if fcntl is None:
+            handle.release()
+            return
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+
+
+# ==============================================================================
+# JSONファイル方式
+# ==============================================================================
+class JsonStorage:
+    """ユーザーごとのJSONファイルにデータを保存する
+
+    ファイルは sha1(ユーザーID) の先頭2文字ずつで分けたディレクトリ (user_data/ab/cd/) に置く。
+    旧来のフラットな配置 (user_data/ 直下) のファイルは、そのユーザーに最初にアクセスしたときに移動する。
+    書き込みはすべてユーザーごとのロックを取ってから行い、JSONファイルはアトミックに置き換える。
+
+    チャットログは1行1レコードのJSONLとして追記のみで書き込む。
+      {"op": "put", "timestamp": ..., "session_id": ..., "history": [...]}  セッションの保存
+      {"op": "delete", "timestamp": ..., "session_id": ...}                 セッションの削除（墓標）
+
+    履歴一覧の表示用に、本文を含まないヘッダーだけの索引 (chat_index_*.jsonl) も並行して追記する。
+      {"op": "put", "timestamp": ..., "session_id": ..., "message_count": N, "offset": チャットログ内のバイト位置}
+      {"op": "delete", "session_id": ...}
+    """
+
+    USER_FILE_PATTERN = re.compile(r"^(?:chat_logs|element_progress|study_logs|live_session|token_usage)_(.+)\.jsonl?$")
+    USER_FILE_NAMES = {
+        "chat": "chat_logs_{}.jsonl",
+        "legacy_chat": "chat_logs_{}.json",
+        "chat_index": "chat_index_{}.jsonl",
+        "progress": "element_progress_{}.json",
+        "study_log": "study_logs_{}.json",
+        "live_session": "live_session_{}.json",
+        "token_usage": "token_usage_{}.json",
+    }
+
+    def __init__(self, logs_dir=DEFAULT_LOGS_DIR):
+        self.logs_dir = logs_dir
+        self.read_cache = FileReadCache()
+        self.locks = UserLocks()
+        self._migrated_users = set()
+
+    def cache_stats(self):
+        return self.read_cache.stats()
+
+    def get_shard_dir(self, user_id):
+        digest = hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.logs_dir, *(digest[i * 2:i * 2 + 2] for i in range(SHARD_DEPTH)))
+
+    def _flat_user_files(self, user_id):
+        return {key: os.path.join(self.logs_dir, name.format(user_id)) for key, name in self.USER_FILE_NAMES.items()}
+
+    def _sharded_user_files(self, user_id):
+        shard_dir = self.get_shard_dir(user_id)
+        files = {key: os.path.join(shard_dir, name.format(user_id)) for key, name in self.USER_FILE_NAMES.items()}
+        files["lock"] = os.path.join(shard_dir, f".lock_{user_id}")
+        return files
+
+    def get_user_files(self, user_id):
+        """読み込み用の、ユーザーIDに基づいたチャットログと進捗ログのパス
+
+        読み込みではファイルを移動しない (エクスポートなどの読み込み専用のツールがデータを書き換えないように)。
+        まだ移動していない旧配置のファイルは、分割後のファイルがなければ旧配置のパスを返す。
+        """
+        files = self._sharded_user_files(user_id)
+        if user_id in self._migrated_users:
+            return files
+        flat_files = {key: path for key, path in self._flat_user_files(user_id).items() if os.path.exists(path)}
+        if not flat_files:
+            self._migrated_users.add(user_id)
+        for key, flat_path in flat_files.items():
+            if not os.path.exists(files[key]):
+                files[key] = flat_path
+        return files
+
+    def _writable_user_files(self, user_id):
+        """書き込み用のパス。旧配置のファイルがあれば、書き込む前にハッシュ分割のディレクトリへ移動する"""
+        os.makedirs(self.get_shard_dir(user_id), exist_ok=True)
+        if user_id not in self._migrated_users:
+            self.migrate_flat_layout(user_id)
+        return self._sharded_user_files(user_id)
+
+    def migrate_flat_layout(self, user_id):
+        """旧来のフラットな配置にあるこのユーザーのファイルを、ハッシュ分割のディレクトリへ移動する"""
+        shard_dir = self.get_shard_dir(user_id)
+        with self.locks.hold(os.path.join(shard_dir, f".lock_{user_id}")):
+            for key, flat_path in self._flat_user_files(user_id).items():
+                if os.path.exists(flat_path):
+                    sharded_path = os.path.join(shard_dir, self.USER_FILE_NAMES[key].format(user_id))
+                    if os.path.exists(sharded_path):
+                        # 両方にある場合は分割後のファイルを正とし、旧ファイルは退避する
+                        self._replace(flat_path, flat_path + ".migrated")
+                    else:
+                        self._replace(flat_path, sharded_path)
+        self._migrated_users.add(user_id)
+
+    def migrate_all_flat_files(self):
+        """フラットな配置に残っている全ユーザーのファイルを移動し、移動したユーザー数を返す"""
+        user_ids = self._list_flat_user_ids()
+        for user_id in user_ids:
+            self._writable_user_files(user_id)
+        return len(user_ids)
+
+    def _list_flat_user_ids(self):
+        if not os.path.isdir(self.logs_dir):
+            return set()
+        return {
+            match.group(1) for match in map(self.USER_FILE_PATTERN.match, os.listdir(self.logs_dir)) if match
+        }
+
+    def list_user_ids(self):
+        """ディレクトリ内のファイル名から、データを持つユーザーIDの一覧を返す"""
+        user_ids = self._list_flat_user_ids()
+        if os.path.isdir(self.logs_dir):
+            for dir_path, dir_names, file_names in os.walk(self.logs_dir):
+                depth = 0 if dir_path == self.logs_dir else os.path.relpath(dir_path, self.logs_dir).count(os.sep) + 1
+                if depth < SHARD_DEPTH:
+                    # 分割用のディレクトリ (16進数2文字) だけをたどる
+                    dir_names[:] = [name for name in dir_names if re.fullmatch(r"[0-9a-f]{2}", name)]
+                    continue
+                dir_names[:] = []
+                for name in file_names:
+                    match = self.USER_FILE_PATTERN.match(name)
+                    if match:
+                        user_ids.add(match.group(1))
+        return sorted(user_ids)
+
+    def _user_lock(self, user_id):
+        """ユーザーのデータを書き換える間保持するロック (取る前に旧配置のファイルを移動する)"""
+        return self.locks.hold(self._writable_user_files(user_id)["lock"])
+
+    def _read_json(self, file_path, default):
+        """JSONファイルを読み込む。ない場合や破損時は default を返す。"""
+        loaded = self.read_cache.get(file_path, self._load_json_file)
+        return default if loaded is None else loaded
+
+    def _load_json_file(self, file_path):
+        if os.path.exists(file_path):
+            with open(file_path, "r", encoding="utf-8") as f:
+                try:
+                    return json.load(f)
+                except json.JSONDecodeError:
+                    # 上書きされて失われないよう、壊れたファイルを退避してから空として扱う
+                    logger.warning("壊れたJSONファイルを退避しました: %s", file_path)
+                    shutil.copy2(file_path, f"{file_path}.corrupt-{time.strftime('%Y%m%d%H%M%S')}")
+        return None
+
+    def _write_json(self, file_path, data):
+        atomic_write(file_path, json.dumps(data, ensure_ascii=False, indent=4).encode("utf-8"))
+        self.read_cache.invalidate(file_path)
+
+    def _write_lines(self, file_path, records):
+        """レコードのリストをJSONLとしてアトミックに書き出す"""
+        atomic_write(file_path, "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8"))
+        self.read_cache.invalidate(file_path)
+
+    def _replace(self, src_path, dst_path):
+        os.replace(src_path, dst_path)
+        self.read_cache.invalidate(src_path)
+        self.read_cache.invalidate(dst_path)
+
+    # --- 進捗 ---
+    def load_progress(self, user_id):
+        return self._read_json(self.get_user_files(user_id)["progress"], {})
+
+    def save_progress(self, user_id, status):
+        with self._user_lock(user_id):
+            self._write_json(self._writable_user_files(user_id)["progress"], status)
+
+    def reset_progress(self, user_id):
+        with self._user_lock(user_id):
+            file_path = self._writable_user_files(user_id)["progress"]
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            self.read_cache.invalidate(file_path)
+
+    # --- 学習時間 ---
+    def load_study_logs(self, user_id):
+        """日付ごとの学習時間（秒）の辞書を返す"""
+        return self._read_json(self.get_user_files(user_id)["study_log"], {})
+
+    def load_study_time(self, user_id, date_key):
+        return self.load_study_logs(user_id).get(date_key, 0)
+
+    def add_study_time(self, user_id, date_key, seconds):
+        with self._user_lock(user_id):
+            # 読み込みから書き込みまでをロック内で行う (他プロセスの書き込みを確実に読むため、キャッシュは使わない)
+            file_path = self._writable_user_files(user_id)["study_log"]
+            logs = self._load_json_file(file_path) or {}
+            logs[date_key] = logs.get(date_key, 0) + seconds
+            self._write_json(file_path, logs)
+
+    # --- LLMの利用量 ---
+    def load_token_usage_logs(self, user_id):
+        """日付ごとの利用量 (TOKEN_USAGE_COUNTERS の辞書) の辞書を返す"""
+        return self._read_json(self.get_user_files(user_id)["token_usage"], {})
+
+    def load_token_usage(self, user_id, date_key):
+        usage = dict.fromkeys(TOKEN_USAGE_COUNTERS, 0)
+        usage.update(self.load_token_usage_logs(user_id).get(date_key, {}))
+        return usage
+
+    def add_token_usage(self, user_id, date_key, usage):
+        with self._user_lock(user_id):
+            # 学習時間と同じく、読み込みから書き込みまでをロック内で行う
+            file_path = self._writable_user_files(user_id)["token_usage"]
+            logs = self._load_json_file(file_path) or {}
+            day = logs.setdefault(date_key, dict.fromkeys(TOKEN_USAGE_COUNTERS, 0))
+            for counter in TOKEN_USAGE_COUNTERS:
+                day[counter] = day.get(counter, 0) + usage.get(counter, 0)
+            self._write_json(file_path, logs)
+
+    # --- 練習中の会話 ---
+    def load_live_session(self, user_id):
+        """保存中の練習の状態を返す (ない場合は None)
+
+        返した状態はそのままセッションステートに入れて変更されるため、共有の読み込みキャッシュは使わず、
+        呼び出しごとにファイルから読み込んだ新しいオブジェクトを返す (読み込みはログイン時だけ)。
+        """
+        return self._load_json_file(self.get_user_files(user_id)["live_session"])
+
+    def save_live_session(self, user_id, state):
+        with self._user_lock(user_id):
+            self._write_json(self._writable_user_files(user_id)["live_session"], state)
+
+    def delete_live_session(self, user_id):
+        with self._user_lock(user_id):
+            file_path = self._writable_user_files(user_id)["live_session"]
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            self.read_cache.invalidate(file_path)
+
+    # --- チャットログ ---
+    def migrate_legacy_chat_log(self, user_id):
+        """旧形式（JSON配列）のチャットログがあれば、JSONL形式へ一度だけ変換する (書き込みの前に呼ぶ)"""
+        files = self._writable_user_files(user_id)
+        legacy_path = files["legacy_chat"]
+        if not os.path.exists(legacy_path) or os.path.exists(files["chat"]):
+            return
+        with self._user_lock(user_id):
+            if not os.path.exists(legacy_path) or os.path.exists(files["chat"]):
+                return
+            logs = self._read_json(legacy_path, [])
+            self._write_lines(files["chat"], [{"op": "put", **log} for log in logs])
+            # 変換済みの旧ファイルは削除せず、念のため退避しておく
+            self._replace(legacy_path, legacy_path + ".migrated")
+
+    def _read_chat_records(self, files):
+        """チャットログのレコード。未変換の旧形式 (JSON配列) しかない場合は、変換せずにそれを読む"""
+        if not os.path.exists(files["chat"]) and os.path.exists(files["legacy_chat"]):
+            return [{"op": "put", **log} for log in self._read_json(files["legacy_chat"], [])]
+        return self._read_records(files["chat"])
+
+    def _read_records(self, file_path):
+        """JSONLファイルのレコードのリストを返す (読み込み結果はキャッシュされる)"""
+        return self.read_cache.get(file_path, self._load_records_file)
+
+    def _load_records_file(self, file_path):
+        """JSONLファイルを1行ずつ読み込み、レコードのリストを返す"""
+        records = []
+        if not os.path.exists(file_path):
+            return records
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 書き込み途中で中断された行などは読み飛ばす
+                    continue
+        return records
+
+    def _replay_records(self, records, fields):
+        """レコードを先頭から適用し、削除されていないセッションを保存順に返す"""
+        sessions = {}
+        for record in records:
+            if record.get("op") == "delete":
+                sessions.pop(record["session_id"], None)
+            else:
+                sessions[record["session_id"]] = {field: record[field] for field in fields}
+        return list(sessions.values())
+
+    def _append_line(self, file_path, record):
+        """JSONLファイルの末尾に1レコードを追記し、その行の先頭バイト位置を返す"""
+        with open(file_path, "ab") as f:
+            offset = f.tell()
+            f.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.read_cache.invalidate(file_path)
+        return offset
+
+    def _index_record(self, session, offset):
+        return {
+            "op": "put",
+            "timestamp": session["timestamp"],
+            "session_id": session["session_id"],
+            "message_count": len(session["history"]),
+            "offset": offset
+        }
+
+    def _write_chat_log(self, user_id, sessions):
+        """セッションの一覧からチャットログと索引を作り直す (ロックを取った状態で呼ぶ)"""
+        files = self._writable_user_files(user_id)
+        index_records = []
+        chunks = []
+        offset = 0
+        for session in sessions:
+            index_records.append(self._index_record(session, offset))
+            line = (json.dumps({"op": "put", **session}, ensure_ascii=False) + "\n").encode("utf-8")
+            chunks.append(line)
+            offset += len(line)
+        atomic_write(files["chat"], b"".join(chunks))
+        self.read_cache.invalidate(files["chat"])
+        self._write_lines(files["chat_index"], index_records)
+
+    def rebuild_chat_index(self, user_id):
+        """チャットログを走査して、ヘッダー索引を作り直す"""
+        with self._user_lock(user_id):
+            self._rebuild_chat_index(user_id)
+
+    def _rebuild_chat_index(self, user_id):
+        files = self._writable_user_files(user_id)
+        self._write_lines(files["chat_index"], self._scan_chat_index_records(files["chat"]))
+
+    def _scan_chat_index_records(self, chat_path):
+        """チャットログを走査して、ヘッダー索引のレコードを作る"""
+        index_records = []
+        if os.path.exists(chat_path):
+            with open(chat_path, "rb") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        record = None
+                    if record is not None:
+                        if record.get("op") == "delete":
+                            index_records.append({"op": "delete", "session_id": record["session_id"]})
+                        else:
+                            index_records.append(self._index_record(record, offset))
+                    offset += len(line)
+        return index_records
+
+    def compact_chat_log(self, user_id):
+        """削除済みセッションを取り除き、チャットログと索引を書き直す"""
+        with self._user_lock(user_id):
+            self._write_chat_log(user_id, self.load_chat_sessions(user_id))
+
+    def append_chat_session(self, user_id, session):
+        self.migrate_legacy_chat_log(user_id)
+        files = self._writable_user_files(user_id)
+        with self._user_lock(user_id):
+            offset = self._append_line(files["chat"], {"op": "put", **session})
+            if os.path.exists(files["chat_index"]):
+                self._append_line(files["chat_index"], self._index_record(session, offset))
+            else:
+                self._rebuild_chat_index(user_id)
+
+    def load_chat_sessions(self, user_id):
+        records = self._read_chat_records(self.get_user_files(user_id))
+        return self._replay_records(records, ("timestamp", "session_id", "history"))
+
+    def list_chat_headers(self, user_id, offset=0, limit=None):
+        """本文を読まずに、新しい順のセッションヘッダーの一部と総数を返す
+
+        索引がない場合 (旧形式のみ・索引の作成前) は、ファイルを書かずにその場でヘッダーを作る。
+        索引は次にセッションを保存したときに作られる。
+        """
+        files = self.get_user_files(user_id)
+        fields = ("timestamp", "session_id", "message_count", "offset")
+        if os.path.exists(files["chat_index"]):
+            headers = self._replay_records(self._read_records(files["chat_index"]), fields)
+        elif os.path.exists(files["chat"]):
+            headers = self._replay_records(self._scan_chat_index_records(files["chat"]), fields)
+        else:
+            headers = [
+                {"timestamp": session["timestamp"], "session_id": session["session_id"],
+                 "message_count": len(session["history"]), "offset": None}
+                for session in self._replay_records(self._read_chat_records(files), ("timestamp", "session_id", "history"))
+            ]
+        headers.reverse()
+        end = None if limit is None else offset + limit
+        return headers[offset:end], len(headers)
+
+    def load_chat_session(self, user_id, session_id):
+        """索引のバイト位置から、1セッション分の本文だけを読み込む"""
+        headers, _ = self.list_chat_headers(user_id)
+        header = next((h for h in headers if h["session_id"] == session_id), None)
+        if header is None:
+            return None
+        record = None
+        if header["offset"] is not None:
+            with open(self.get_user_files(user_id)["chat"], "rb") as f:
+                f.seek(header["offset"])
+                try:
+                    record = json.loads(f.readline())
+                except json.JSONDecodeError:
+                    record = None
+        if record is None or record.get("session_id") != session_id:
+            # 旧形式のログしかない場合や、索引がずれている場合は全体から探す (索引はコンパクションで作り直される)
+            return next((s for s in self.load_chat_sessions(user_id) if s["session_id"] == session_id), None)
+        return {"timestamp": record["timestamp"], "session_id": session_id, "history": record["history"]}
+
+    def delete_chat_session(self, user_id, session_id):
+        self.migrate_legacy_chat_log(user_id)
+        files = self._writable_user_files(user_id)
+        with self._user_lock(user_id):
+            self._append_line(files["chat"], {
+                "op": "delete",
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "session_id": session_id
+            })
+            if os.path.exists(files["chat_index"]):
+                self._append_line(files["chat_index"], {"op": "delete", "session_id": session_id})
+            # 削除レコードが溜まったらコンパクションを行う
+            index_records = self._read_records(files["chat_index"])
+            tombstones = sum(1 for record in index_records if record.get("op") == "delete")
+            if tombstones >= CHAT_LOG_COMPACT_THRESHOLD:
+                self.compact_chat_log(user_id)
+
+
+# ==============================================================================
+# SQLite方式
+# ==============================================================================
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS element_progress (
+    user_id TEXT NOT NULL,
+    element TEXT NOT NULL,
+    passed  INTEGER NOT NULL,
+    PRIMARY KEY (user_id, element)
+);
+CREATE TABLE IF NOT EXISTS study_time (
+    user_id TEXT NOT NULL,
+    date    TEXT NOT NULL,
+    seconds INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, date)
+);
+CREATE INDEX IF NOT EXISTS idx_study_time_date ON study_time (date);
+CREATE TABLE IF NOT EXISTS chat_sessions (
+    session_id    TEXT PRIMARY KEY,
+    user_id       TEXT NOT NULL,
+    timestamp     TEXT NOT NULL,
+    message_count INTEGER NOT NULL,
+    history       TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chat_sessions_user ON chat_sessions (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_chat_sessions_date ON chat_sessions (timestamp);
+CREATE TABLE IF NOT EXISTS token_usage (
+    user_id       TEXT NOT NULL,
+    date          TEXT NOT NULL,
+    requests      INTEGER NOT NULL DEFAULT 0,
+    input_tokens  INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, date)
+);
+CREATE TABLE IF NOT EXISTS live_sessions (
+    user_id    TEXT PRIMARY KEY,
+    updated_at TEXT NOT NULL,
+    state      TEXT NOT NULL
+);
+"""
+
+
+class SqliteStorage:
+    """SQLite (WALモード) にすべてのユーザーのデータを保存する
+
+    Streamlit はセッションごとに別スレッドでスクリプトを実行するため、
+    接続はスレッドごとに作成する。書き込みはすべてトランザクション内で行う。
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def cache_stats(self):
+        # SQLiteはページキャッシュを持つため、アプリ側の読み込みキャッシュは使わない
+        return None
+
+    def list_user_ids(self):
+        rows = self._connect().execute(
+            "SELECT user_id FROM element_progress UNION SELECT user_id FROM study_time "
+            "UNION SELECT user_id FROM chat_sessions UNION SELECT user_id FROM token_usage ORDER BY user_id"
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    # --- 進捗 ---
+    def load_progress(self, user_id):
+        rows = self._connect().execute(
+            "SELECT element, passed FROM element_progress WHERE user_id = ?", (user_id,)
+        ).fetchall()
+        return {element: bool(passed) for element, passed in rows}
+
+    def save_progress(self, user_id, status):
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO element_progress (user_id, element, passed) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, element) DO UPDATE SET passed = excluded.passed",
+                [(user_id, element, int(passed)) for element, passed in status.items()]
+            )
+
+    def reset_progress(self, user_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM element_progress WHERE user_id = ?", (user_id,))
+
+    # --- 学習時間 ---
+    def load_study_logs(self, user_id):
+        rows = self._connect().execute(
+            "SELECT date, seconds FROM study_time WHERE user_id = ? ORDER BY date", (user_id,)
+        ).fetchall()
+        return dict(rows)
+
+    def load_study_time(self, user_id, date_key):
+        row = self._connect().execute(
+            "SELECT seconds FROM study_time WHERE user_id = ? AND date = ?", (user_id, date_key)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def add_study_time(self, user_id, date_key, seconds):
+        # 読み込み→加算→書き戻しではなく、1文で加算するため同時更新でも失われない
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO study_time (user_id, date, seconds) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, date) DO UPDATE SET seconds = seconds + excluded.seconds",
+                (user_id, date_key, seconds)
+            )
+
+    # --- LLMの利用量 ---
+    def load_token_usage_logs(self, user_id):
+        rows = self._connect().execute(
+            f"SELECT date, {', '.join(TOKEN_USAGE_COUNTERS)} FROM token_usage WHERE user_id = ? ORDER BY date",
+            (user_id,)
+        ).fetchall()
+        return {row[0]: dict(zip(TOKEN_USAGE_COUNTERS, row[1:])) for row in rows}
+
+    def load_token_usage(self, user_id, date_key):
+        row = self._connect().execute(
+            f"SELECT {', '.join(TOKEN_USAGE_COUNTERS)} FROM token_usage WHERE user_id = ? AND date = ?",
+            (user_id, date_key)
+        ).fetchone()
+        return dict(zip(TOKEN_USAGE_COUNTERS, row or (0,) * len(TOKEN_USAGE_COUNTERS)))
+
+    def add_token_usage(self, user_id, date_key, usage):
+        # 学習時間と同じく、1文で加算する
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT INTO token_usage (user_id, date, {', '.join(TOKEN_USAGE_COUNTERS)}) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, date) DO UPDATE SET "
+                + ", ".join(f"{counter} = {counter} + excluded.{counter}" for counter in TOKEN_USAGE_COUNTERS),
+                (user_id, date_key, *(usage.get(counter, 0) for counter in TOKEN_USAGE_COUNTERS))
+            )
+
+    # --- 練習中の会話 ---
+    def load_live_session(self, user_id):
+        row = self._connect().execute(
+            "SELECT state FROM live_sessions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_live_session(self, user_id, state):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO live_sessions (user_id, updated_at, state) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET updated_at = excluded.updated_at, state = excluded.state",
+                (user_id, time.strftime("%Y-%m-%d %H:%M:%S"), json.dumps(state, ensure_ascii=False))
+            )
+
+    def delete_live_session(self, user_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM live_sessions WHERE user_id = ?", (user_id,))
+
+    # --- チャットログ ---
+    def append_chat_session(self, user_id, session):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_sessions (session_id, user_id, timestamp, message_count, history) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (session["session_id"], user_id, session["timestamp"], len(session["history"]),
+                 json.dumps(session["history"], ensure_ascii=False))
+            )
+
+    def list_chat_headers(self, user_id, offset=0, limit=None):
+        """本文を読まずに、新しい順のセッションヘッダーの一部と総数を返す"""
+        conn = self._connect()
+        total = conn.execute("SELECT COUNT(*) FROM chat_sessions WHERE user_id = ?", (user_id,)).fetchone()[0]
+        rows = conn.execute(
+            "SELECT timestamp, session_id, message_count FROM chat_sessions WHERE user_id = ? "
+            "ORDER BY timestamp DESC, rowid DESC LIMIT ? OFFSET ?",
+            (user_id, -1 if limit is None else limit, offset)
+        ).fetchall()
+        headers = [
+            {"timestamp": timestamp, "session_id": session_id, "message_count": message_count}
+            for timestamp, session_id, message_count in rows
+        ]
+        return headers, total
+
+    def load_chat_session(self, user_id, session_id):
+        row = self._connect().execute(
+            "SELECT timestamp, history FROM chat_sessions WHERE user_id = ? AND session_id = ?",
+            (user_id, session_id)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"timestamp": row[0], "session_id": session_id, "history": json.loads(row[1])}
+
+    def load_chat_sessions(self, user_id):
+        rows = self._connect().execute(
+            "SELECT timestamp, session_id, history FROM chat_sessions "
+            "WHERE user_id = ? ORDER BY timestamp, rowid", (user_id,)
+        ).fetchall()
+        return [
+            {"timestamp": timestamp, "session_id": session_id, "history": json.loads(history)}
+            for timestamp, session_id, history in rows
+        ]
+
+    def delete_chat_session(self, user_id, session_id):
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM chat_sessions WHERE user_id = ? AND session_id = ?", (user_id, session_id)
+            )
+
+    # --- 取り込み ---
+    def import_user(self, user_id, progress, study_logs, sessions, token_usage_logs=None):
+        """1ユーザー分のデータを1トランザクションで取り込む (再実行しても重複しない)"""
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO element_progress (user_id, element, passed) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, element) DO UPDATE SET passed = excluded.passed",
+                [(user_id, element, int(passed)) for element, passed in progress.items()]
+            )
+            conn.executemany(
+                "INSERT INTO study_time (user_id, date, seconds) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, date) DO UPDATE SET seconds = excluded.seconds",
+                [(user_id, date_key, seconds) for date_key, seconds in study_logs.items()]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO chat_sessions (session_id, user_id, timestamp, message_count, history) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(session["session_id"], user_id, session["timestamp"], len(session["history"]),
+                  json.dumps(session["history"], ensure_ascii=False)) for session in sessions]
+            )
+            conn.executemany(
+                f"INSERT OR REPLACE INTO token_usage (user_id, date, {', '.join(TOKEN_USAGE_COUNTERS)}) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(user_id, date_key, *(usage.get(counter, 0) for counter in TOKEN_USAGE_COUNTERS))
+                 for date_key, usage in (token_usage_logs or {}).items()]
+            )
+
+
+def import_json_directory(logs_dir, db_path):
+    """既存の user_data/ ディレクトリの内容をSQLiteへ取り込み、取り込んだユーザー数を返す"""
+    source = JsonStorage(logs_dir)
+    target = SqliteStorage(db_path)
+    user_ids = source.list_user_ids()
+    for user_id in user_ids:
+        target.import_user(
+            user_id,
+            source.load_progress(user_id),
+            source.load_study_logs(user_id),
+            source.load_chat_sessions(user_id),
+            source.load_token_usage_logs(user_id)
+        )
+    return len(user_ids)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="誘いを断る練習AI のデータ保存層の管理ツール")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="user_data/ のJSONファイルをSQLiteへ取り込む")
+    import_parser.add_argument("logs_dir", nargs="?", default=DEFAULT_LOGS_DIR, help="取り込み元のディレクトリ")
+    import_parser.add_argument("--db", default=DEFAULT_DB_PATH, help="取り込み先のSQLiteファイル")
+
+    shard_parser = subparsers.add_parser("shard", help="フラットな配置のファイルを、ハッシュ分割のディレクトリへ移動する")
+    shard_parser.add_argument("logs_dir", nargs="?", default=DEFAULT_LOGS_DIR, help="対象のディレクトリ")
+
+    args = parser.parse_args(argv)
+    if args.command == "import":
+        count = import_json_directory(args.logs_dir, args.db)
+        print(f"{count} 人分のデータを {args.db} に取り込みました。")
+    elif args.command == "shard":
+        count = JsonStorage(args.logs_dir).migrate_all_flat_files()
+        print(f"{count} 人分のファイルを移動しました。")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""ハートビート方式の学習時間の集計
+
+ログアウト時に「開始〜終了」をまとめて記録する方式では、タブを閉じた学生の時間が失われる。
+そこでスクリプトの再実行 (操作) のたびにハートビートを記録し、直前の操作からの経過時間を
+学習時間として加算する。長く操作がなかった間隔は idle_cap_seconds で打ち切る。
+
+加算した秒数はメモリ上にためておき、一定間隔 (flush_interval_seconds) または
+ためた秒数が flush_threshold_seconds に達したときに、まとめて保存先へ書き出す。
+操作のたびにディスクへ書き込むことはない。
+"""
+import atexit
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IDLE_CAP_SECONDS = 120
+DEFAULT_FLUSH_INTERVAL_SECONDS = 60
+DEFAULT_FLUSH_THRESHOLD_SECONDS = 300
+
+
+class StudyTimeTracker:
+    """ユーザーごとのハートビートから学習時間を集計し、まとめて書き出す
+
+    flush(user_id, date_key, seconds) は保存先の学習時間に秒数を加算する関数。
+    """
+
+    def __init__(self, flush, idle_cap_seconds=DEFAULT_IDLE_CAP_SECONDS,
+                 flush_interval_seconds=DEFAULT_FLUSH_INTERVAL_SECONDS,
+                 flush_threshold_seconds=DEFAULT_FLUSH_THRESHOLD_SECONDS):
+        self._flush = flush
+        self.idle_cap_seconds = idle_cap_seconds
+        self.flush_interval_seconds = flush_interval_seconds
+        self.flush_threshold_seconds = flush_threshold_seconds
+        self._last_seen = {}  # ユーザーID -> 最後のハートビートの時刻
+        self._pending = {}    # (ユーザーID, 日付) -> 未保存の秒数
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        threading.Thread(target=self._run, name="study-time-flush", daemon=True).start()
+        atexit.register(self.flush_all)
+
+    def heartbeat(self, user_id, now=None):
+        """操作があったことを記録し、直前の操作からの経過時間 (上限あり) を加算する"""
+        now = time.time() if now is None else now
+        with self._lock:
+            last = self._last_seen.get(user_id)
+            self._last_seen[user_id] = now
+            if last is None or now <= last:
+                return
+            key = (user_id, time.strftime("%Y-%m-%d", time.localtime(now)))
+            self._pending[key] = self._pending.get(key, 0.0) + min(now - last, self.idle_cap_seconds)
+            over_threshold = self._pending[key] >= self.flush_threshold_seconds
+        if over_threshold:
+            # 書き出しは呼び出し元 (スクリプトの実行) を待たせず、バックグラウンドで行う
+            self._wake.set()
+
+    def end_session(self, user_id):
+        """ログアウト時: 次の操作との間隔を数えないようにし、そのユーザーの分をすぐに書き出す"""
+        with self._lock:
+            self._last_seen.pop(user_id, None)
+        self.flush_user(user_id)
+
+    def pending_seconds(self, user_id, date_key):
+        """まだ保存していない学習時間 (秒)"""
+        with self._lock:
+            return self._pending.get((user_id, date_key), 0.0)
+
+    def flush_user(self, user_id):
+        self._flush_where(lambda key: key[0] == user_id)
+
+    def flush_all(self):
+        self._flush_where(lambda key: True)
+
+    def _flush_where(self, matches):
+        with self._lock:
+            batch = {key: seconds for key, seconds in self._pending.items() if matches(key)}
+            for key in batch:
+                del self._pending[key]
+        for (user_id, date_key), seconds in batch.items():
+            whole_seconds = int(seconds)
+            try:
+                if whole_seconds:
+                    self._flush(user_id, date_key, whole_seconds)
+                remainder = seconds - whole_seconds
+            except Exception:
+                logger.exception("学習時間の保存に失敗しました (%s)", user_id)
+                remainder = seconds
+            if remainder:
+                # 1秒未満の端数と、保存に失敗した分は次回に持ち越す
+                with self._lock:
+                    self._pending[(user_id, date_key)] = self._pending.get((user_id, date_key), 0.0) + remainder
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.flush_interval_seconds)
+            self._wake.clear()
+            self.flush_all()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+        self.flush_all()
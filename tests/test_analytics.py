@@ -0,0 +1,70 @@
+import sqlite3
+
+import pytest
+
+import analytics
+import storage
+
+TABLES = ("user_progress", "user_study_time", "user_token_usage", "chat_session_stats", "evaluations")
+
+SESSIONS = {
+    "u1": [
+        {"timestamp": "2024-01-01 10:00:00", "session_id": "s1", "history": [
+            {"role": "user", "content": "a"},
+            {"role": "assistant", "content": "b", "evaluation": {
+                "kind": "element", "element": "相手への配慮", "verdict": "合格", "source": "llm"
+            }},
+            {"role": "user", "content": "c"},
+            {"role": "assistant", "content": "d", "evaluation": {
+                "kind": "full", "verdict": "合格", "scores": {"expression": 40, "content": 45, "total": 85}
+            }},
+        ]},
+        {"timestamp": "2024-01-02 10:00:00", "session_id": "s2", "history": []},
+    ],
+    "u2": [
+        {"timestamp": "2024-01-03 10:00:00", "session_id": "s3", "history": [
+            {"role": "assistant", "content": "e", "evaluation": None},
+            {"role": "assistant", "content": "f", "evaluation": {"kind": "full", "verdict": "不合格", "scores": {}}},
+        ]},
+    ],
+}
+
+
+def dump(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return {table: sorted(conn.execute(f"SELECT * FROM {table}").fetchall(), key=repr) for table in TABLES}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = storage.JsonStorage(str(tmp_path / "logs"))
+    store.save_progress("u1", {"相手への配慮": True, "理由": False})
+    store.add_study_time("u1", "2024-01-01", 120)
+    store.add_study_time("u2", "2024-01-02", 30)
+    store.add_token_usage("u1", "2024-01-01", {"requests": 2, "input_tokens": 100, "output_tokens": 20})
+    for user_id, sessions in SESSIONS.items():
+        for session in sessions:
+            store.append_chat_session(user_id, session)
+    return store
+
+
+def test_rebuild_matches_incremental_updates(store, tmp_path):
+    incremental = analytics.AnalyticsIndex(str(tmp_path / "incremental.db"))
+    incremental.record_progress("u1", store.load_progress("u1"))
+    incremental.add_study_time("u1", "2024-01-01", 120)
+    incremental.add_study_time("u2", "2024-01-02", 30)
+    incremental.add_token_usage("u1", "2024-01-01", {"requests": 2, "input_tokens": 100, "output_tokens": 20})
+    for user_id, sessions in SESSIONS.items():
+        for session in sessions:
+            incremental.record_chat_session(user_id, session)
+
+    assert analytics.rebuild_index(store, str(tmp_path / "rebuilt.db")) == 2
+    rebuilt = dump(str(tmp_path / "rebuilt.db"))
+    assert rebuilt == dump(str(tmp_path / "incremental.db"))
+    assert len(rebuilt["evaluations"]) == 3
+
+
+def test_rebuild_empty_store(tmp_path):
+    store = storage.JsonStorage(str(tmp_path / "logs"))
+    assert analytics.rebuild_index(store, str(tmp_path / "analytics.db")) == 0
+    assert dump(str(tmp_path / "analytics.db")) == dict.fromkeys(TABLES, [])
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import evaluation
+
+ELEMENT = "相手への配慮 (Consideration)"
+
+
+def element_response(**fields):
+    data = {"reply": "そっか", "highlight": "ごめん", "feedback": ["良い"], "improvements": [], "verdict": "合格"}
+    data.update(fields)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def full_response(**fields):
+    data = {
+        "reply": "わかった", "highlight": "", "expression_score": 5, "expression_summary": "丁寧",
+        "content_score": 5, "content_summary": "明確", "expression_details": ["a"], "content_details": ["b"],
+        "weighting": "内容面", "improvements": [],
+    }
+    data.update(fields)
+    return json.dumps(data, ensure_ascii=False)
+
+
+@pytest.mark.parametrize("text", [None, "", "not json", "【合否判定】: 合格", "[1, 2]", '"text"'])
+def test_parse_evaluation_rejects_malformed_output(text):
+    assert evaluation.parse_evaluation(text, ELEMENT) is None
+    assert evaluation.parse_evaluation(text, "総合実践") is None
+
+
+@pytest.mark.parametrize("verdict", [None, "", "合格です", "pass"])
+def test_parse_evaluation_requires_a_known_verdict(verdict):
+    assert evaluation.parse_evaluation(element_response(verdict=verdict), ELEMENT) is None
+
+
+def test_parse_element_evaluation_normalizes_lists():
+    result = evaluation.parse_evaluation(element_response(feedback="一行だけ", improvements=[" ", "直す"]), ELEMENT)
+    assert result["kind"] == "element" and result["element"] == ELEMENT
+    assert result["feedback"] == ["一行だけ"]
+    assert result["improvements"] == ["直す"]
+    assert result["scores"] is None and result["source"] == "llm"
+
+
+@pytest.mark.parametrize("field", ["expression_score", "content_score"])
+@pytest.mark.parametrize("value", [None, "five", [5]])
+def test_parse_full_evaluation_rejects_bad_scores(field, value):
+    assert evaluation.parse_evaluation(full_response(**{field: value}), "総合実践") is None
+
+
+@pytest.mark.parametrize("expression, content, expected", [
+    (5, 5, {"expression": 5, "content": 5, "total": 10}),
+    (9, "4", {"expression": 5, "content": 4, "total": 9}),
+    (-3, 5, {"expression": 0, "content": 5, "total": 5}),
+])
+def test_parse_full_evaluation_clamps_scores(expression, content, expected):
+    result = evaluation.parse_evaluation(full_response(expression_score=expression, content_score=content), "総合実践")
+    assert result["scores"] == expected
+    assert result["verdict"] == ("合格" if expected["total"] == 10 else "不合格")
+
+
+def test_render_markdown_escapes_the_answer():
+    result = evaluation.parse_evaluation(element_response(highlight="<b>ごめん</b>"), ELEMENT)
+    markdown = evaluation.render_markdown(result, "<b>ごめん</b>、<img src=x onerror=alert(1)>行けない")
+    assert "<b>" not in markdown and "<img" not in markdown
+    assert "「_**&lt;b&gt;ごめん&lt;/b&gt;**_、&lt;img src=x onerror=alert(1)&gt;行けない」" in markdown
+
+
+def test_render_markdown_skips_missing_brief_sections():
+    result = evaluation.parse_evaluation(
+        full_response(expression_details=[], content_details=[], weighting=""), "総合実践"
+    )
+    markdown = evaluation.render_markdown(result, "ごめん")
+    assert "# 全体評価" in markdown and "合計**: 10/10点 (合格)" in markdown
+    assert "詳細" not in markdown and "重み付け" not in markdown
+
+
+RED_SPAN = '<span style="color:red; font-weight:bold; text-decoration: underline;">{}</span>'
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("「_**ごめんね**_、行けない」", f"「{RED_SPAN.format('ごめんね')}、行けない」"),
+    ("_**a**_ と _**b**_", f"{RED_SPAN.format('a')} と {RED_SPAN.format('b')}"),
+    ("**太字だけ**", "**太字だけ**"),
+    ("_斜体だけ_", "_斜体だけ_"),
+    ("_****_", "_****_"),
+])
+def test_highlight_text(text, expected):
+    assert evaluation.highlight_text(text) == expected
+
+
+def test_mark_highlight_round_trips_through_highlight_text():
+    marked = evaluation.mark_highlight("今日はごめん、用事がある", "用事がある")
+    assert marked == "今日はごめん、_**用事がある**_"
+    assert evaluation.highlight_text(marked) == f"今日はごめん、{RED_SPAN.format('用事がある')}"
+    assert evaluation.mark_highlight("今日はごめん", "見つからない") == "今日はごめん"
+
+
+@pytest.mark.parametrize("verdict, color", [("合格", "green"), ("不合格", "red")])
+def test_color_verdict(verdict, color):
+    assert evaluation.color_verdict(f"本文\n【合否判定】: {verdict}") == (
+        f"本文\n**【合否判定】: <span style='color:{color};'>{verdict}</span>**"
+    )
@@ -0,0 +1,52 @@
+import feedback_cache
+
+EVALUATION = {"kind": "element", "verdict": "合格", "feedback": ["謝罪があります。"], "reply": "そっか"}
+ANSWER = "すみません、その日は先約があって行けないんです。"
+
+
+def test_normalize_ignores_width_case_and_punctuation():
+    assert feedback_cache.normalize("ＡＢＣ、 abc！") == feedback_cache.normalize("abcabc")
+
+
+def test_near_duplicate_answer_hits_and_returns_a_copy():
+    cache = feedback_cache.FeedbackCache(threshold=0.8)
+    cache.store("謝罪", "誘いA", ANSWER, EVALUATION)
+    cached, score = cache.lookup("謝罪", "誘いA", "すみません！その日は先約があって行けないんです")
+    assert cached == EVALUATION and score >= 0.8
+    cached["feedback"].append("変更")
+    assert cache.lookup("謝罪", "誘いA", ANSWER)[0] == EVALUATION
+
+
+def test_different_scenarios_and_elements_do_not_share_entries():
+    cache = feedback_cache.FeedbackCache()
+    cache.store("謝罪", "先輩からの飲み会の誘い", ANSWER, EVALUATION)
+    assert cache.lookup("謝罪", "友人からの旅行の誘い", ANSWER)[0] is None
+    assert cache.lookup("理由", "先輩からの飲み会の誘い", ANSWER)[0] is None
+
+
+def test_dissimilar_answer_misses():
+    cache = feedback_cache.FeedbackCache()
+    cache.store("謝罪", "誘いA", ANSWER, EVALUATION)
+    cached, score = cache.lookup("謝罪", "誘いA", "ごめん、無理")
+    assert cached is None and score < cache.threshold
+    assert cache.stats()["misses"] == 1
+
+
+def test_expired_entries_are_dropped(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(feedback_cache.time, "time", lambda: now[0])
+    cache = feedback_cache.FeedbackCache(ttl_seconds=60)
+    cache.store("謝罪", "誘いA", ANSWER, EVALUATION)
+    now[0] += 61
+    assert cache.lookup("謝罪", "誘いA", ANSWER)[0] is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = feedback_cache.FeedbackCache(max_entries=2)
+    cache.store("謝罪", "誘いA", "回答その一です", EVALUATION)
+    cache.store("謝罪", "誘いB", "回答その二です", EVALUATION)
+    cache.lookup("謝罪", "誘いA", "回答その一です")
+    cache.store("謝罪", "誘いC", "回答その三です", EVALUATION)
+    assert cache.lookup("謝罪", "誘いB", "回答その二です")[0] is None
+    assert cache.lookup("謝罪", "誘いA", "回答その一です")[0] is not None
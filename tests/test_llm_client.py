@@ -0,0 +1,117 @@
+import types
+
+import pytest
+
+import llm_client
+
+
+class FakeChat:
+    """send_message の結果を順に返す (例外なら送出する) ChatSession の代わり"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.history = ["before"]
+        self.calls = 0
+
+    def send_message(self, content, stream=False, request_options=None, **kwargs):
+        self.calls += 1
+        self.history = self.history + [content]
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def failing_stream(*chunks):
+    yield from chunks
+    raise ConnectionError("reset")
+
+
+@pytest.fixture(autouse=True)
+def limiter(monkeypatch):
+    limiter = llm_client.RequestLimiter(max_concurrent=2, requests_per_minute=6000)
+    monkeypatch.setattr(llm_client, "_limiter", limiter)
+    monkeypatch.setattr(llm_client, "_backoff_seconds", lambda retry_count: 0.0)
+    monkeypatch.setattr(llm_client, "_degraded_until", 0.0)
+    return limiter
+
+
+def assert_all_slots_free(limiter):
+    assert all(limiter._semaphore.acquire(blocking=False) for _ in range(limiter.max_concurrent))
+    for _ in range(limiter.max_concurrent):
+        limiter.release()
+
+
+def test_get_token_usage():
+    response = types.SimpleNamespace(usage_metadata=types.SimpleNamespace(
+        prompt_token_count=120, cached_content_token_count=None, candidates_token_count=30
+    ))
+    assert llm_client.get_token_usage(response) == {"input_tokens": 120, "cached_tokens": 0, "output_tokens": 30}
+    assert llm_client.get_token_usage(object()) == {"input_tokens": 0, "cached_tokens": 0, "output_tokens": 0}
+
+
+def test_retries_transient_errors(limiter):
+    chat = FakeChat(ConnectionError("busy"), TimeoutError("slow"), "ok")
+    assert llm_client.send_message(chat, "hi") == "ok"
+    assert chat.calls == 3
+    assert chat.history == ["before", "hi"]
+    assert llm_client.is_degraded()
+    assert_all_slots_free(limiter)
+
+
+def test_gives_up_after_max_retries(limiter):
+    chat = FakeChat(*[ConnectionError("busy")] * (llm_client.MAX_RETRIES + 1))
+    with pytest.raises(llm_client.LLMUnavailableError):
+        llm_client.send_message(chat, "hi")
+    assert chat.calls == llm_client.MAX_RETRIES + 1
+    assert chat.history == ["before"]
+    assert_all_slots_free(limiter)
+
+
+def test_other_errors_are_not_retried(limiter):
+    chat = FakeChat(ValueError("bad request"), "ok")
+    with pytest.raises(ValueError):
+        llm_client.send_message(chat, "hi")
+    assert chat.calls == 1
+    assert chat.history == ["before"]
+    assert_all_slots_free(limiter)
+
+
+def test_streaming_holds_the_slot_until_read(limiter):
+    chat = FakeChat(ConnectionError("busy"), iter(["a", "b"]))
+    response = llm_client.send_message(chat, "hi", stream=True)
+    assert chat.calls == 2
+    # 読み終わるまでは実行枠を1つ使ったまま
+    assert limiter._semaphore.acquire(blocking=False)
+    assert not limiter._semaphore.acquire(blocking=False)
+    limiter.release()
+    assert list(response) == ["a", "b"]
+    assert_all_slots_free(limiter)
+
+
+def test_streaming_failure_after_first_chunk_restores_history(limiter):
+    chat = FakeChat(failing_stream("a"))
+    response = llm_client.send_message(chat, "hi", stream=True)
+    with pytest.raises(llm_client.LLMUnavailableError):
+        list(response)
+    assert chat.history == ["before"]
+    assert_all_slots_free(limiter)
+
+
+def test_limiter_concurrency_timeout():
+    limiter = llm_client.RequestLimiter(max_concurrent=1, requests_per_minute=6000)
+    assert limiter.acquire(1)
+    assert not limiter.acquire(0.01)
+    limiter.release()
+    assert limiter.acquire(1)
+
+
+def test_limiter_rate_timeout():
+    limiter = llm_client.RequestLimiter(max_concurrent=2, requests_per_minute=1)
+    assert limiter.acquire(1)
+    limiter.release()
+    assert limiter.acquire(1)
+    limiter.release()
+    # バケットが空になり、次のトークンは60秒後まで補充されない
+    assert not limiter.acquire(0.05)
+    assert_all_slots_free(limiter)
@@ -0,0 +1,63 @@
+import pytest
+
+import prescreen
+import prompts
+
+ELEMENT_KEYS = list(prompts.TRAINING_ELEMENTS)
+
+
+@pytest.mark.parametrize("element_key", ELEMENT_KEYS)
+def test_every_element_has_a_rule_under_the_app_display_name(element_key):
+    # アプリは key.split(' (')[0] を selected_element_display として screen_answer に渡す
+    display_name = element_key.split(" (")[0]
+    assert prescreen.get_rule(display_name) is not None
+    assert prescreen.get_rule(element_key) is prescreen.get_rule(display_name)
+    assert prescreen.screen_answer(display_name, "ごめんなさい、その日は無理です。") is not None
+
+
+def test_full_mode_is_not_screened():
+    assert prescreen.screen_answer("総合実践", "ごめん、無理なんだ") is None
+
+
+def test_consideration_element_fails_without_thanks():
+    result = prescreen.screen_answer("相手への配慮", "その日は無理です。")
+    assert result["clear_fail"]
+    evaluation = prescreen.build_local_evaluation(result, "相手への配慮 (感謝の言葉など) (1点)", "その日は無理です。")
+    assert evaluation["element"] == "相手への配慮"
+    assert evaluation["verdict"] == "不合格"
+
+
+def test_detected_phrase_gives_span():
+    answer = "ごめんね、その日はバイトなんだ。"
+    result = prescreen.screen_answer("謝罪の言葉の有無と適切さ", answer)
+    assert not result["clear_fail"]
+    start, end = result["span"]
+    assert answer[start:end] == "ごめん"
+
+
+def test_ambiguous_refusal_is_a_clear_fail_for_clarity():
+    answer = "うーん、行けたら行くね。"
+    result = prescreen.screen_answer("断りの意思の明確さ", answer)
+    assert result["clear_fail"] and result["ambiguous"]
+    assert prescreen.build_local_evaluation(result, "断りの意思の明確さ", answer)["highlight"] == "行けたら行く"
+
+
+def test_relationship_element_is_never_failed_locally():
+    assert not prescreen.screen_answer("相手との関係性に応じた適切さ", "はい")["clear_fail"]
+
+
+@pytest.mark.parametrize("element, answer", [
+    ("謝罪の言葉の有無と適切さ", "すまん、その日は無理なんだ"),
+    ("謝罪の言葉の有無と適切さ", "すまないけど、その日は行けない"),
+    ("謝罪の言葉の有無と適切さ", "悪いね、その日は無理"),
+    ("相手への配慮", "ありがたいんだけど今回はパス"),
+    ("断りの意思の明確さ", "今回はやめておくね"),
+    ("断りの意思の明確さ", "今回はやめとこうかな"),
+])
+def test_common_phrasings_are_not_clear_fails(element, answer):
+    assert not prescreen.screen_answer(element, answer)["clear_fail"]
+
+
+@pytest.mark.parametrize("answer", ["失礼だけど、その日は無理", "残念だけど、その日は無理", "体調が悪いけど、無理"])
+def test_non_apologies_are_not_counted_as_apologies(answer):
+    assert prescreen.screen_answer("謝罪の言葉の有無と適切さ", answer)["clear_fail"]
@@ -0,0 +1,60 @@
+import pytest
+
+import evaluation
+import prompts
+import quota
+
+
+def usage(requests=0, input_tokens=0, output_tokens=0, cached_tokens=0):
+    return {"requests": requests, "input_tokens": input_tokens, "cached_tokens": cached_tokens, "output_tokens": output_tokens}
+
+
+def test_no_limits_means_always_ok():
+    policy = quota.QuotaPolicy()
+    assert not policy.enabled
+    assert policy.level(usage(requests=10 ** 6, input_tokens=10 ** 9)) == "ok"
+
+
+@pytest.mark.parametrize("tokens, expected", [(99, "ok"), (100, "soft"), (199, "soft"), (200, "hard"), (500, "hard")])
+def test_token_limits_are_inclusive(tokens, expected):
+    policy = quota.QuotaPolicy(soft_tokens=100, hard_tokens=200)
+    assert policy.level(usage(input_tokens=tokens - 10, output_tokens=10)) == expected
+
+
+def test_cached_tokens_are_not_counted_twice():
+    # cached_tokens は input_tokens の内数
+    assert quota.billable_tokens(usage(input_tokens=80, cached_tokens=60, output_tokens=20)) == 100
+
+
+@pytest.mark.parametrize("requests, expected", [(4, "ok"), (5, "soft"), (10, "hard")])
+def test_request_limits(requests, expected):
+    policy = quota.QuotaPolicy(soft_requests=5, hard_requests=10)
+    assert policy.level(usage(requests=requests)) == expected
+
+
+def test_hard_limit_alone_has_no_soft_stage():
+    policy = quota.QuotaPolicy(hard_tokens=100)
+    assert policy.enabled
+    assert policy.level(usage(input_tokens=99)) == "ok"
+    assert policy.level(usage(input_tokens=100)) == "hard"
+
+
+def test_load_policy_reads_settings(monkeypatch):
+    monkeypatch.setenv("DAILY_TOKEN_SOFT_LIMIT", "1000")
+    monkeypatch.setenv("DAILY_REQUEST_HARD_LIMIT", "30")
+    policy = quota.load_policy()
+    assert (policy.soft_tokens, policy.hard_tokens, policy.soft_requests, policy.hard_requests) == (1000, 0, 0, 30)
+
+
+@pytest.mark.parametrize("mode_key, omitted", [("謝罪の言葉の有無と適切さ", {"improvements"}),
+                                               ("総合実践", {"expression_details", "content_details", "weighting"})])
+def test_brief_schema_drops_detail_fields(mode_key, omitted):
+    full = evaluation.generation_config(mode_key)["response_schema"]
+    brief = evaluation.generation_config(mode_key, brief=True)["response_schema"]
+    assert set(full["properties"]) - set(brief["properties"]) == omitted
+    assert not omitted & set(brief["required"])
+
+
+def test_brief_markdown_message_keeps_the_answer_first():
+    message = prompts.build_brief_message("ごめん、無理なんだ")
+    assert message.startswith("ごめん、無理なんだ") and prompts.BRIEF_FEEDBACK_INSTRUCTION in message
@@ -0,0 +1,46 @@
+import threading
+import time
+
+import scenario_pool
+
+
+def make_pool(calls, pool_size=2, ttl_seconds=60):
+    def generate(mode_key, model):
+        calls.append((mode_key, model, threading.current_thread().name))
+        return {"text": f"{mode_key}-{len(calls)}", "history": []}
+
+    return scenario_pool.ScenarioPool(generate, pool_size=pool_size, ttl_seconds=ttl_seconds)
+
+
+def drain(pool):
+    deadline = time.time() + 5
+    while any(pool._pending.values()) and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_miss_refills_with_the_callers_model():
+    calls = []
+    pool = make_pool(calls)
+    assert pool.take("総合実践", "model-a") is None
+    drain(pool)
+    assert [(mode_key, model) for mode_key, model, _ in calls] == [("総合実践", "model-a")] * 2
+    assert all(name.startswith("scenario-pool") for _, _, name in calls)
+    assert pool.stats() == {"hits": 0, "misses": 1, "available": {"総合実践": 2}}
+
+
+def test_warm_up_fills_each_mode():
+    calls = []
+    pool = make_pool(calls, pool_size=1)
+    pool.warm_up({"総合実践": "model-a", "断りの意思の明確さ": "model-b"})
+    drain(pool)
+    assert sorted((mode_key, model) for mode_key, model, _ in calls) == [
+        ("断りの意思の明確さ", "model-b"), ("総合実践", "model-a")
+    ]
+    assert pool.take("断りの意思の明確さ", "model-b")["text"].startswith("断りの意思の明確さ")
+
+
+def test_expired_entries_are_not_handed_out():
+    pool = make_pool([], pool_size=1, ttl_seconds=-1)
+    pool.refill("総合実践", "model-a")
+    drain(pool)
+    assert pool.take("総合実践", "model-a") is None
@@ -0,0 +1,121 @@
+import json
+import os
+
+import pytest
+
+import storage
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "json":
+        return storage.JsonStorage(str(tmp_path))
+    return storage.SqliteStorage(str(tmp_path / "refuse_ai.db"))
+
+
+def test_live_session_is_not_shared_between_loads(store):
+    store.save_live_session("u1", {"chat_history": [{"role": "user", "content": "a"}]})
+    state = store.load_live_session("u1")
+    state["chat_history"].append({"role": "assistant", "content": "b"})
+    assert store.load_live_session("u1") == {"chat_history": [{"role": "user", "content": "a"}]}
+
+
+def test_live_session_delete(store):
+    store.save_live_session("u1", {"initial_prompt_sent": True})
+    store.delete_live_session("u1")
+    assert store.load_live_session("u1") is None
+
+
+def _write_flat_files(logs_dir):
+    (logs_dir / "element_progress_u1.json").write_text('{"相手への配慮 (Consideration)": true}', encoding="utf-8")
+    (logs_dir / "chat_logs_u1.json").write_text(
+        '[{"timestamp": "2024-01-01 10:00:00", "session_id": "s1", "history": [{"role": "user", "content": "a"}]}]',
+        encoding="utf-8"
+    )
+
+
+def test_reads_do_not_migrate_flat_layout(tmp_path):
+    _write_flat_files(tmp_path)
+    before = sorted(path.name for path in tmp_path.iterdir())
+    store = storage.JsonStorage(str(tmp_path))
+    assert store.load_progress("u1") == {"相手への配慮 (Consideration)": True}
+    assert store.list_chat_headers("u1") == (
+        [{"timestamp": "2024-01-01 10:00:00", "session_id": "s1", "message_count": 1, "offset": None}], 1
+    )
+    assert store.load_chat_session("u1", "s1")["history"] == [{"role": "user", "content": "a"}]
+    assert store.load_study_logs("u1") == {}
+    assert sorted(path.name for path in tmp_path.iterdir()) == before
+
+
+def test_write_migrates_flat_layout(tmp_path):
+    _write_flat_files(tmp_path)
+    store = storage.JsonStorage(str(tmp_path))
+    store.append_chat_session("u1", {"timestamp": "2024-01-02 10:00:00", "session_id": "s2", "history": []})
+    assert not (tmp_path / "element_progress_u1.json").exists()
+    assert not (tmp_path / "chat_logs_u1.json").exists()
+    assert store.load_progress("u1") == {"相手への配慮 (Consideration)": True}
+    headers, total = store.list_chat_headers("u1")
+    assert [header["session_id"] for header in headers] == ["s2", "s1"] and total == 2
+
+
+def make_session(number, messages=1):
+    return {
+        "timestamp": f"2024-01-01 10:{number:02d}:00",
+        "session_id": f"s{number}",
+        "history": [{"role": "user", "content": str(i)} for i in range(messages)],
+    }
+
+
+def test_chat_sessions_append_list_and_delete(store):
+    for number in range(3):
+        store.append_chat_session("u1", make_session(number, messages=number + 1))
+    store.delete_chat_session("u1", "s1")
+    assert [session["session_id"] for session in store.load_chat_sessions("u1")] == ["s0", "s2"]
+    headers, total = store.list_chat_headers("u1", limit=1)
+    assert total == 2
+    assert [(header["session_id"], header["message_count"]) for header in headers] == [("s2", 3)]
+    assert store.load_chat_session("u1", "s2") == make_session(2, messages=3)
+    assert store.load_chat_session("u1", "s1") is None
+
+
+def test_jsonl_compaction_drops_tombstones(tmp_path):
+    store = storage.JsonStorage(str(tmp_path))
+    count = storage.CHAT_LOG_COMPACT_THRESHOLD + 1
+    for number in range(count):
+        store.append_chat_session("u1", make_session(number))
+    for number in range(storage.CHAT_LOG_COMPACT_THRESHOLD - 1):
+        store.delete_chat_session("u1", f"s{number}")
+    files = store.get_user_files("u1")
+    with open(files["chat"], encoding="utf-8") as f:
+        assert sum(1 for line in f) == count + storage.CHAT_LOG_COMPACT_THRESHOLD - 1
+
+    store.delete_chat_session("u1", f"s{storage.CHAT_LOG_COMPACT_THRESHOLD - 1}")
+    with open(files["chat"], encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert [record["session_id"] for record in lines] == [f"s{count - 1}"]
+    assert all(record["op"] == "put" for record in lines)
+    headers, total = store.list_chat_headers("u1")
+    assert total == 1 and headers[0]["offset"] == 0
+    assert store.load_chat_session("u1", f"s{count - 1}") == make_session(count - 1)
+
+
+def test_chat_index_is_rebuilt_when_stale(tmp_path):
+    store = storage.JsonStorage(str(tmp_path))
+    for number in range(2):
+        store.append_chat_session("u1", make_session(number))
+    index_path = store.get_user_files("u1")["chat_index"]
+    os.remove(index_path)
+    assert store.list_chat_headers("u1")[1] == 2
+    assert not os.path.exists(index_path)
+    store.append_chat_session("u1", make_session(2))
+    assert os.path.exists(index_path)
+    assert [header["session_id"] for header in store.list_chat_headers("u1")[0]] == ["s2", "s1", "s0"]
+    assert store.load_chat_session("u1", "s0") == make_session(0)
+
+
+def test_truncated_jsonl_line_is_skipped(tmp_path):
+    store = storage.JsonStorage(str(tmp_path))
+    store.append_chat_session("u1", make_session(0))
+    with open(store.get_user_files("u1")["chat"], "a", encoding="utf-8") as f:
+        f.write('{"op": "put", "session_id": "s1", "hist')
+    assert [session["session_id"] for session in store.load_chat_sessions("u1")] == ["s0"]
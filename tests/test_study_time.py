@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+import study_time
+
+START = time.mktime((2024, 1, 1, 10, 0, 0, 0, 0, -1))
+DATE_KEY = "2024-01-01"
+
+
+@pytest.fixture
+def flushed():
+    return []
+
+
+@pytest.fixture
+def tracker(flushed):
+    tracker = study_time.StudyTimeTracker(
+        lambda user_id, date_key, seconds: flushed.append((user_id, date_key, seconds)),
+        idle_cap_seconds=120, flush_interval_seconds=3600, flush_threshold_seconds=10 ** 6
+    )
+    yield tracker
+    tracker.stop()
+
+
+def test_first_heartbeat_counts_nothing(tracker):
+    tracker.heartbeat("u1", now=START)
+    assert tracker.pending_seconds("u1", DATE_KEY) == 0
+
+
+def test_idle_gaps_are_capped(tracker):
+    tracker.heartbeat("u1", now=START)
+    tracker.heartbeat("u1", now=START + 30)
+    tracker.heartbeat("u1", now=START + 30 + 3600)
+    assert tracker.pending_seconds("u1", DATE_KEY) == 30 + 120
+
+
+def test_clock_going_backwards_counts_nothing(tracker):
+    tracker.heartbeat("u1", now=START + 60)
+    tracker.heartbeat("u1", now=START)
+    assert tracker.pending_seconds("u1", DATE_KEY) == 0
+
+
+def test_flush_writes_whole_seconds_and_carries_the_remainder(tracker, flushed):
+    tracker.heartbeat("u1", now=START)
+    tracker.heartbeat("u1", now=START + 10.75)
+    tracker.flush_all()
+    assert flushed == [("u1", DATE_KEY, 10)]
+    assert tracker.pending_seconds("u1", DATE_KEY) == pytest.approx(0.75)
+    tracker.heartbeat("u1", now=START + 11.0)
+    tracker.flush_all()
+    assert flushed == [("u1", DATE_KEY, 10), ("u1", DATE_KEY, 1)]
+    assert tracker.pending_seconds("u1", DATE_KEY) == 0
+
+
+def test_failed_flush_keeps_the_seconds():
+    calls = []
+
+    def flush(user_id, date_key, seconds):
+        calls.append(seconds)
+        if len(calls) == 1:
+            raise OSError("disk full")
+
+    tracker = study_time.StudyTimeTracker(flush, flush_interval_seconds=3600, flush_threshold_seconds=10 ** 6)
+    try:
+        tracker.heartbeat("u1", now=START)
+        tracker.heartbeat("u1", now=START + 20)
+        tracker.flush_all()
+        assert tracker.pending_seconds("u1", DATE_KEY) == 20
+        tracker.flush_all()
+        assert calls == [20, 20]
+        assert tracker.pending_seconds("u1", DATE_KEY) == 0
+    finally:
+        tracker.stop()
+
+
+def test_end_session_flushes_only_that_user(tracker, flushed):
+    for user_id in ("u1", "u2"):
+        tracker.heartbeat(user_id, now=START)
+        tracker.heartbeat(user_id, now=START + 5)
+    tracker.end_session("u1")
+    assert flushed == [("u1", DATE_KEY, 5)]
+    assert tracker.pending_seconds("u2", DATE_KEY) == 5
+    # ログアウト後の最初の操作までの間隔は数えない
+    tracker.heartbeat("u1", now=START + 100)
+    assert tracker.pending_seconds("u1", DATE_KEY) == 0
+
+
+def test_threshold_wakes_the_background_flush(flushed):
+    tracker = study_time.StudyTimeTracker(
+        lambda user_id, date_key, seconds: flushed.append((user_id, date_key, seconds)),
+        flush_interval_seconds=3600, flush_threshold_seconds=60
+    )
+    try:
+        tracker.heartbeat("u1", now=START)
+        tracker.heartbeat("u1", now=START + 90)
+        deadline = time.time() + 5
+        while not flushed and time.time() < deadline:
+            time.sleep(0.01)
+        assert flushed == [("u1", DATE_KEY, 90)]
+    finally:
+        tracker.stop()